@@ -1,17 +1,62 @@
 import os
 import mimetypes
 import pathlib
-import cv2
-import numpy as np
+import hashlib
+import threading
+import tempfile
+import time
+import asyncio
+import random
+import re
+import functools
+import importlib
+import importlib.util
+import html
+import string
+import datetime as dt
+import math
+import shutil
+import weakref
+import uuid
+import subprocess
+import itertools
+import contextvars
+import sqlite3
+import multiprocessing
+import logging
+from contextlib import contextmanager, ExitStack
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, CancelledError, as_completed
 import streamlit as st
+from streamlit import runtime
 from PIL import Image
-from google import genai
-from google.genai.types import Tool, GenerateContentConfig, GoogleSearch
 import json
 import io  # Import io
-from pdf2image import convert_from_path  # Import pdf2image
-import pdfkit
-import base64
+
+class LazyModule:
+    """Stands in for a module and imports it on first attribute access.
+
+    Keeps cold starts fast: OpenCV, NumPy, poppler/wkhtmltopdf wrappers and the GenAI
+    SDK are only loaded by the first request that actually needs them.
+    """
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+cv2 = LazyModule("cv2")
+np = LazyModule("numpy")
+genai = LazyModule("google.genai")
+genai_types = LazyModule("google.genai.types")
+genai_errors = LazyModule("google.genai.errors")
+httpx = LazyModule("httpx")
+requests = LazyModule("requests")
+pdf2image = LazyModule("pdf2image")  # Import pdf2image
+pdfkit = LazyModule("pdfkit")
+pydicom = LazyModule("pydicom")  # Optional: only needed for DICOM uploads
 
 # This section defines the system instruction for Gemini Pro.
 
@@ -125,97 +170,2680 @@ Give output in JSON format
 
 # Initialize Gemini API
 API_KEY = "your-API-KEY"  # Replace with your Gemini API Key
-client = genai.Client(api_key=API_KEY)
 
-google_search_tool = Tool(google_search=GoogleSearch())
+# Like st.cache_resource, but also shares the resource when the module is imported without
+# a Streamlit server (batch mode, benchmarks), where cache_resource does not cache at all.
+def shared_resource(func):
+    streamlit_cached = st.cache_resource(func)
+    process_cached = functools.lru_cache(maxsize=None)(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if runtime.exists():
+            return streamlit_cached(*args, **kwargs)
+        return process_cached(*args, **kwargs)
+    return wrapper
+
+# The client is built on first use and then shared by every session of the process.
+# DIAG_GEMINI_BACKEND=local runs the app against the offline stand-in in local_gemini.py.
+@shared_resource
+def get_client():
+    if os.environ.get("DIAG_GEMINI_BACKEND") == "local":
+        from local_gemini import LocalGeminiClient
+        return LocalGeminiClient.from_env()
+    return genai.Client(api_key=API_KEY)
+
+@shared_resource
+def get_google_search_tool():
+    return genai_types.Tool(google_search=genai_types.GoogleSearch())
+
+# Metrics settings. Timing spans are sampled; request and token counters are always kept.
+METRICS_SAMPLE_RATE = float(os.environ.get("DIAG_METRICS_SAMPLE_RATE", "1.0"))
+METRICS_JSON_LOG = os.environ.get("DIAG_METRICS_JSON_LOG") == "1"  # one JSON line per span/request
+METRICS_EXPORT_PATH = os.environ.get("DIAG_METRICS_EXPORT_PATH")  # Prometheus textfile, rewritten per request
+METRICS_PORT = int(os.environ.get("DIAG_METRICS_PORT", "0"))  # serve /metrics on this port (0 = off)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKEN_BUCKETS = (100, 300, 1000, 3000, 10000, 30000, 100000, 300000, 1000000)
+
+metrics_logger = logging.getLogger("diag_assist.metrics")
+
+class Metrics:
+    """Process-wide Prometheus-style counters and histograms."""
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [buckets, [0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[1][i] += 1
+            histogram[2] += value
+            histogram[3] += 1
+
+    def render_prometheus(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self._counters}):
+                lines.append(f"# TYPE {name} counter")
+                for (metric, labels), value in sorted(self._counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{label_text(labels)} {value}")
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (metric, labels), (buckets, counts, total, count) in sorted(self._histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, bucket_count in zip(buckets, counts):
+                        lines.append(f"{name}_bucket{label_text(labels, [('le', bound)])} {bucket_count}")
+                    lines.append(f"{name}_bucket{label_text(labels, [('le', '+Inf')])} {count}")
+                    lines.append(f"{name}_sum{label_text(labels)} {total}")
+                    lines.append(f"{name}_count{label_text(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+@shared_resource
+def get_metrics():
+    metrics = Metrics()
+    if METRICS_JSON_LOG and not metrics_logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        metrics_logger.addHandler(handler)
+        metrics_logger.setLevel(logging.INFO)
+    # Only the app process serves /metrics; worker processes send their timings back with their results
+    if METRICS_PORT and multiprocessing.parent_process() is None:
+        try:
+            start_metrics_server(metrics, METRICS_PORT)
+        except OSError as e:
+            print(f"Could not serve metrics on port {METRICS_PORT}:", e)
+    return metrics
+
+# Function to serve /metrics for Prometheus scrapes from a daemon thread
+def start_metrics_server(metrics, port):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.render_prometheus().encode("utf-8")
+            self.send_response(200 if self.path == "/metrics" else 404)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.end_headers()
+            if self.path == "/metrics":
+                self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass  # Scrapes every few seconds would flood the app log
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+
+# Function to write the metrics for a node_exporter textfile collector
+def export_metrics():
+    if not METRICS_EXPORT_PATH:
+        return
+    tmp_path = METRICS_EXPORT_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(get_metrics().render_prometheus())
+    os.replace(tmp_path, METRICS_EXPORT_PATH)
+
+# Spans timed by the task a worker process is running; None outside run_in_worker()
+worker_spans = None
+
+@contextmanager
+def stage_span(stage, **labels):
+    """Times one pipeline stage into diag_stage_duration_seconds (sampled by METRICS_SAMPLE_RATE)."""
+    if METRICS_SAMPLE_RATE < 1 and random.random() >= METRICS_SAMPLE_RATE:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        if worker_spans is not None:
+            worker_spans.append((stage, elapsed, labels))
+        else:
+            record_span(stage, elapsed, labels)
+
+# Function to record a timed stage in the process metrics
+def record_span(stage, elapsed, labels):
+    get_metrics().observe("diag_stage_duration_seconds", elapsed, stage=stage, **labels)
+    if METRICS_JSON_LOG:
+        metrics_logger.info(json.dumps({"event": "stage", "stage": stage, "seconds": round(elapsed, 6), **labels}))
+
+# Function to run a module-level function in a worker process; returns its result and the spans it timed
+def run_in_worker(func_name, *args):
+    global worker_spans
+    worker_spans = []
+    try:
+        return globals()[func_name](*args), worker_spans
+    finally:
+        worker_spans = None
+
+# Function to count a request's outcome and token usage from the response usage metadata
+def record_request(model, outcome, usage=None):
+    metrics = get_metrics()
+    metrics.inc("diag_requests_total", model=model, outcome=outcome)
+    tokens = {}
+    if usage is not None:
+        # Fields vary between SDK versions (1.2.0 has no per-modality details), so absent ones count as empty
+        tokens["prompt"] = getattr(usage, "prompt_token_count", None) or 0
+        tokens["output"] = getattr(usage, "candidates_token_count", None) or 0
+        if getattr(usage, "cached_content_token_count", None):
+            tokens["cached"] = usage.cached_content_token_count
+        for detail in getattr(usage, "prompt_tokens_details", None) or []:
+            modality = str(getattr(detail.modality, "value", detail.modality)).lower()
+            tokens[f"prompt_{modality}"] = detail.token_count or 0
+        for kind, count in tokens.items():
+            metrics.inc("diag_tokens_total", count, model=model, kind=kind)
+            metrics.observe("diag_request_tokens", count, buckets=TOKEN_BUCKETS, model=model, kind=kind)
+    if METRICS_JSON_LOG:
+        metrics_logger.info(json.dumps({"event": "request", "model": model, "outcome": outcome, "tokens": tokens}))
+    try:
+        export_metrics()
+    except OSError as e:
+        print("Could not export metrics:", e)
 
 # Function to get MIME type
 def get_mime_type(file_path):
     mime_type, _ = mimetypes.guess_type(file_path)
     return mime_type if mime_type else "application/octet-stream"
 
+# Upper bound on decoded previews + encoded parts kept by the shared upload cache
+UPLOAD_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+class UploadCache:
+    """Size-bounded LRU of processed uploads, keyed by the content hash of the file."""
+
+    def __init__(self, max_bytes=UPLOAD_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        with self._lock:
+            if key in self._entries:
+                self.total_bytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return  # Never let one huge upload flush everything else out
+            self._entries[key] = (value, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+# Streamlit re-executes this script on every rerun, so the cache has to live in a
+# shared resource to survive reruns and be shared by every session of the process.
+@shared_resource
+def get_upload_cache():
+    return UploadCache()
+
+# Per-session quota for uploads spilled to disk for tools that need a real path (poppler)
+SPILL_QUOTA_BYTES = int(os.environ.get("DIAG_SPILL_QUOTA_MB", "256")) * 1024 * 1024
+
+class SpillArea:
+    """Per-session temporary directory for uploads that must exist as files.
+
+    Uploads stay in memory; a file is written only when a tool needs a path. Files
+    are evicted least-recently-used beyond `quota` bytes (never while in use), and
+    the directory is removed when the owning session goes away or the process exits.
+    """
+
+    def __init__(self, quota=SPILL_QUOTA_BYTES):
+        self.quota = quota
+        self.total_bytes = 0
+        self.directory = tempfile.mkdtemp(prefix="diag_session_")
+        self._files = OrderedDict()  # key -> (path, size)
+        self._pinned = {}  # key -> number of users
+        self._lock = threading.Lock()
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.directory, ignore_errors=True)
+
+    @contextmanager
+    def path_for(self, key, buffer, suffix=""):
+        """Yields a path holding `buffer`, writing it only if it is not spilled already."""
+        with self._lock:
+            entry = self._files.get(key)
+            if entry is None:
+                path = os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest()[:32] + suffix)
+                with stage_span("upload_spill"):
+                    with open(path, "wb") as f:
+                        f.write(buffer)  # A memoryview is written without copying
+                entry = (path, len(buffer))
+                self.total_bytes += entry[1]
+            self._files[key] = entry
+            self._files.move_to_end(key)
+            self._pinned[key] = self._pinned.get(key, 0) + 1
+            self._evict()
+        try:
+            yield entry[0]
+        finally:
+            with self._lock:
+                self._pinned[key] -= 1
+                if not self._pinned[key]:
+                    del self._pinned[key]
+                self._evict()
+
+    def _evict(self):
+        for key in list(self._files):
+            if self.total_bytes <= self.quota:
+                break
+            if key in self._pinned:
+                continue
+            path, size = self._files.pop(key)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.total_bytes -= size
+
+    def cleanup(self):
+        self._finalizer()
+
+# Function to get this session's spill area; it is cleaned up with the session state
+def get_spill_area():
+    if "spill_area" not in st.session_state:
+        st.session_state.spill_area = SpillArea()
+    return st.session_state.spill_area
+
+# Function to hash an uploaded file's bytes. The poll loop reruns the script twice a second while a
+# job runs, so in a session each upload (by Streamlit file id and size) is hashed only the first time
+def file_digest(file):
+    file_id = getattr(file, "file_id", None)
+    if file_id is None or not runtime.exists():
+        return hashlib.sha256(file.getbuffer()).hexdigest()
+    digests = st.session_state.setdefault("upload_digests", {})
+    memo_key = (file_id, file.size)
+    if memo_key not in digests:
+        digests[memo_key] = hashlib.sha256(file.getbuffer()).hexdigest()
+    return digests[memo_key]
+
+# Function to build the cache key of an uploaded file
+def upload_cache_key(file, mime_type, pdf_options=None):
+    digest = file_digest(file)
+    if mime_type == "application/pdf" and pdf_options:
+        # The same PDF rasterized at another DPI, page range or text layer setting is a different entry
+        return (f"{digest}:{mime_type}:{pdf_options['dpi']}:{pdf_options['first_page']}-{pdf_options['last_page']}"
+                f":{pdf_options.get('text_layer', PDF_TEXT_LAYER)}")
+    return f"{digest}:{mime_type}"
+
+# Function to build the cache key of a set of DICOM files (from their own keys), which are rendered together as series
+def dicom_cache_key(file_keys, dicom_options):
+    digest = hashlib.sha256("|".join(sorted(file_keys)).encode()).hexdigest()
+    return f"{digest}:application/dicom:{dicom_options['window']}:{dicom_options['slices']}"
+
+# Function to approximate the memory held by a list of (image, part, thumbnail) entries
+def upload_entries_size(entries):
+    size = 0
+    for image, image_part, thumbnail in entries:
+        size += image.width * image.height * len(image.getbands())
+        size += part_size(image_part) + len(thumbnail)
+    return size
+
+# Thumbnail grid settings for the "Image & Analysis" tab
+THUMBNAIL_SIZE = (256, 256)
+THUMBNAIL_COLUMNS = 4
+THUMBNAILS_PER_PAGE = 12
+
+# Function to pre-encode a small JPEG thumbnail of an image
+def make_thumbnail(image):
+    thumbnail = image.copy()
+    thumbnail.thumbnail(THUMBNAIL_SIZE)
+    if thumbnail.mode not in ("L", "RGB"):
+        thumbnail = thumbnail.convert("RGB")
+    buffer = io.BytesIO()
+    thumbnail.save(buffer, format="JPEG", quality=80)
+    return buffer.getvalue()
+
+# Gemini fits every image inside this box before tokenizing it, so extra pixels are wasted bytes
+MODEL_MAX_IMAGE_DIM = 3072
+# Never shrink an image below this when squeezing a request into its byte budget
+MIN_IMAGE_DIM = 384
+# Upper bound on the image bytes inlined in one request (the API rejects inline payloads over 20 MB)
+REQUEST_BYTE_BUDGET = 15 * 1024 * 1024
+JPEG_QUALITY = 85
+MIN_JPEG_QUALITY = 50
+# Max per-pixel channel spread for an RGB image to still count as a grayscale scan
+GRAYSCALE_TOLERANCE = 8
+# Images with fewer distinct values than this are documents/line art and stay lossless
+LOSSLESS_MAX_COLORS = 64
+
+# Function to convert a PIL image to an 8-bit array ready for OpenCV (grayscale or BGR)
+def image_to_array(image):
+    if image.mode in ("I", "I;16", "I;16B", "F"):
+        # High bit-depth scans: stretch the used range into 8 bits instead of clipping it
+        array = np.asarray(image, dtype=np.float32)
+        return cv2.normalize(array, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    if image.mode not in ("L", "RGB"):
+        image = image.convert("RGB")
+    array = np.asarray(image)
+    if array.ndim == 2:
+        return array
+    # Check a subsample of pixels: scanned films and reports are often saved as RGB
+    sample = array[::4, ::4].astype(np.int16)
+    spread = np.abs(sample[..., 0] - sample[..., 1]).max(initial=0)
+    spread = max(spread, np.abs(sample[..., 1] - sample[..., 2]).max(initial=0))
+    if spread <= GRAYSCALE_TOLERANCE:
+        return cv2.cvtColor(array, cv2.COLOR_RGB2GRAY)
+    return cv2.cvtColor(array, cv2.COLOR_RGB2BGR)
+
+# Function to shrink an array so its longest side is at most max_dim
+def downscale_array(array, max_dim):
+    height, width = array.shape[:2]
+    scale = max_dim / max(height, width)
+    if scale >= 1:
+        return array
+    new_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(array, new_size, interpolation=cv2.INTER_AREA)
+
+# Function to choose between lossless PNG and lossy JPEG for an image
+def choose_codec(array):
+    sample = array[::4, ::4].astype(np.uint32)
+    if sample.ndim == 3:
+        sample = (sample[..., 0] << 16) | (sample[..., 1] << 8) | sample[..., 2]  # One int per color
+    distinct = len(np.unique(sample))
+    return "png" if distinct <= LOSSLESS_MAX_COLORS else "jpeg"
+
+# Function to preprocess a PIL image into compact bytes for Gemini
+def preprocess_image(image, max_dim=MODEL_MAX_IMAGE_DIM, quality=JPEG_QUALITY):
+    """Downscales, drops redundant color channels and picks a codec; returns (bytes, mime_type)."""
+    array = downscale_array(image_to_array(image), max_dim)
+    if choose_codec(array) == "png":
+        ok, encoded = cv2.imencode(".png", array, [cv2.IMWRITE_PNG_COMPRESSION, 6])
+        mime_type = "image/png"
+    else:
+        ok, encoded = cv2.imencode(".jpg", array, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        mime_type = "image/jpeg"
+    if not ok:
+        raise ValueError("OpenCV could not encode the image")
+    return encoded.tobytes(), mime_type
+
+# Function to encode a PIL image as a Gemini part
+def image_to_part(image, max_dim=MODEL_MAX_IMAGE_DIM, quality=JPEG_QUALITY):
+    data, mime_type = preprocess_image(image, max_dim, quality)
+    return genai.types.Part.from_bytes(
+        data=data,
+        mime_type=mime_type
+    )
+
+# Function to tell text parts (PDF pages sent as their text layer) from image parts
+def is_text_part(part):
+    return part.inline_data is None and part.text is not None
+
+# Function to get the request bytes of a part
+def part_size(part):
+    return len(part.text.encode("utf-8")) if is_text_part(part) else len(part.inline_data.data)
+
+# Function to fit the image parts of one request into the byte budget
+def enforce_byte_budget(images, budget=REQUEST_BYTE_BUDGET):
+    """Re-encodes the largest image smaller until the request fits; returns the new list."""
+    images = list(images)
+    max_dims = [min(max(img[0].size), MODEL_MAX_IMAGE_DIM) for img in images]
+    total = sum(part_size(img[1]) for img in images)
+    image_indexes = [i for i, img in enumerate(images) if not is_text_part(img[1])]  # Text can't be shrunk
+    while total > budget and image_indexes:
+        index = max(image_indexes, key=lambda i: len(images[i][1].inline_data.data))
+        max_dims[index] = int(max_dims[index] * 0.75)
+        if max_dims[index] < MIN_IMAGE_DIM:
+            notify("warning", "Uploads are too large to fit in one request even after downscaling.")
+            break
+        image, image_part = images[index][:2]
+        new_part = image_to_part(image, max_dims[index], MIN_JPEG_QUALITY)
+        total += len(new_part.inline_data.data) - len(image_part.inline_data.data)
+        images[index] = (image, new_part) + images[index][2:]
+    return images
+
+# Function to decode a file (a path, or a file object for images) into (image, part) entries
+def encode_file(source, mime_type, pdf_options=None):
+    if mime_type in ["image/png", "image/jpg", "image/jpeg"]:
+        with stage_span("decode"):
+            image = Image.open(source)
+            image.load()
+        with stage_span("encode"):
+            return [(image, image_to_part(image))]
+    if mime_type == "application/dicom":
+        return encode_dicom_series([source])
+    options = dict(pdf_options or {})
+    if not options.pop("text_layer", PDF_TEXT_LAYER):
+        return rasterize_pdf(source, **options)
+    try:
+        page_count = pdf2image.pdfinfo_from_path(source)["Pages"]
+    except Exception as e:
+        raise RuntimeError(f"Error converting PDF to images: {e}. Is Poppler installed?") from e
+    first_page = max(1, options.pop("first_page", None) or 1)
+    last_page = min(page_count, options.pop("last_page", None) or page_count)
+    text_pages = pdf_text_layer(source, first_page, last_page)
+    entries = []
+    # Consecutive pages of the same kind are handled together, keeping the page order
+    for is_text, run in itertools.groupby(range(first_page, last_page + 1), key=lambda page: page in text_pages):
+        run = list(run)
+        if not is_text:
+            entries.extend(rasterize_pdf(source, first_page=run[0], last_page=run[-1], **options))
+            continue
+        try:
+            # Text pages are only rendered at thumbnail size, for the image grid
+            previews = pdf2image.convert_from_path(source, first_page=run[0], last_page=run[-1], size=THUMBNAIL_SIZE[0])
+        except Exception as e:
+            print("Could not render text page previews:", e)
+            previews = [Image.new("RGB", THUMBNAIL_SIZE, "white") for _ in run]
+        for page, preview in zip(run, previews):
+            text_part = genai_types.Part(text=f"[PDF page {page} of {page_count}, text layer]\n{text_pages[page]}")
+            entries.append((preview, text_part))
+    return entries
+
+# Function to rasterize PDF pages into (preview, part) entries
+def rasterize_pdf(pdf_path, **pdf_options):
+    entries = []
+    # Pages arrive one at a time; only the encoded part and a reduced preview are kept
+    for img in pdf_to_images(pdf_path, **pdf_options):
+        with stage_span("encode"):
+            image_part = image_to_part(img)
+        preview = img.copy()
+        preview.thumbnail(PDF_PREVIEW_MAX_SIZE)
+        img.close()
+        entries.append((preview, image_part))
+    return entries
+
+# Text layer settings
+PDF_TEXT_LAYER = os.environ.get("DIAG_PDF_TEXT_LAYER", "1") != "0"  # Default of the PDF option
+MIN_TEXT_LAYER_CHARS = 200  # Non-space characters a page needs to be sent as text
+MIN_EMBEDDED_IMAGE_DIM = 200  # Embedded images this large (scans, imaging) make a page graphical
+PDF_TOOL_TIMEOUT = 60  # seconds
+# Vector drawings (ECG tracings, charts) have no text or embedded image, so text pages are also
+# rendered at 1 px per point and checked for ink outside the words that isn't a table rule
+PDF_DRAWING_DPI = 72
+PDF_RULE_MIN_LENGTH = 24  # px; straight runs at least this long...
+PDF_RULE_MAX_WIDTH = 3  # ...and at most this thick are table rules or form lines, not drawings
+PDF_DRAWING_CELL = 8  # px
+PDF_MAX_DRAWN_FRACTION = 0.01  # Pages with more of their cells drawn than this are rasterized
+
+# Function to find the PDF pages that can be sent as text instead of an image
+def pdf_text_layer(pdf_path, first_page, last_page):
+    """Returns {page number: text} for born-digital pages.
+
+    A page qualifies when poppler extracts enough text from it, it embeds no
+    sizeable image and it has no vector drawing beside its text, so scans (even
+    with an OCR layer), pages with imaging and ECG tracings or charts are still
+    rasterized. `pdftotext -layout` keeps columns and table rows aligned.
+    """
+    page_range = ["-f", str(first_page), "-l", str(last_page)]
+    try:
+        with stage_span("pdf_text_extract"):
+            text = subprocess.run(["pdftotext", "-layout", *page_range, pdf_path, "-"],
+                                  capture_output=True, check=True, timeout=PDF_TOOL_TIMEOUT).stdout
+            listing = subprocess.run(["pdfimages", "-list", *page_range, pdf_path],
+                                     capture_output=True, check=True, timeout=PDF_TOOL_TIMEOUT).stdout
+    except (OSError, subprocess.SubprocessError) as e:
+        print("No text layer available, rasterizing every page:", e)
+        return {}
+
+    graphical = set()
+    for line in listing.decode("utf-8", "replace").splitlines()[2:]:  # After the two header lines
+        fields = line.split()
+        if len(fields) > 4 and fields[3].isdigit() and fields[4].isdigit():
+            if int(fields[3]) >= MIN_EMBEDDED_IMAGE_DIM and int(fields[4]) >= MIN_EMBEDDED_IMAGE_DIM:
+                graphical.add(int(fields[0]))
+
+    pages = {}
+    # pdftotext ends every page with a form feed
+    for page, page_text in zip(range(first_page, last_page + 1), text.decode("utf-8", "replace").split("\f")):
+        if page not in graphical and len("".join(page_text.split())) >= MIN_TEXT_LAYER_CHARS:
+            pages[page] = page_text.rstrip()
+    drawn = pdf_drawn_pages(pdf_path, list(pages))
+    return {page: page_text for page, page_text in pages.items() if page not in drawn}
+
+# Function to find the pages among `pages` that carry vector drawings next to their text
+def pdf_drawn_pages(pdf_path, pages):
+    drawn = set()
+    # Consecutive pages are rendered with one poppler call
+    for _, run in itertools.groupby(enumerate(pages), key=lambda item: item[1] - item[0]):
+        run = [page for _, page in run]
+        page_range = ["-f", str(run[0]), "-l", str(run[-1])]
+        try:
+            with stage_span("pdf_drawing_check"):
+                words = subprocess.run(["pdftotext", "-bbox", *page_range, pdf_path, "-"],
+                                       capture_output=True, check=True, timeout=PDF_TOOL_TIMEOUT).stdout
+                renders = pdf2image.convert_from_path(pdf_path, dpi=PDF_DRAWING_DPI, first_page=run[0],
+                                                      last_page=run[-1], grayscale=True)
+        except Exception as e:
+            print("Could not check pages for drawings, rasterizing them:", e)
+            drawn.update(run)
+            continue
+        word_pages = words.decode("utf-8", "replace").split("<page ")[1:]
+        for page, render, word_page in zip(run, renders, word_pages):
+            boxes = [tuple(float(value) for value in box) for box in re.findall(
+                r'<word xMin="([\d.]+)" yMin="([\d.]+)" xMax="([\d.]+)" yMax="([\d.]+)"', word_page)]
+            fraction = drawn_fraction(render, boxes, PDF_DRAWING_DPI / 72)
+            if fraction > PDF_MAX_DRAWN_FRACTION:
+                print(f"PDF page {page} has drawings ({fraction:.1%} of the page), rasterizing it")
+                drawn.add(page)
+    return drawn
+
+# Function to mark the pixels of `mask` that lie on straight runs at least `length` long along `axis`
+def straight_runs(mask, length, axis):
+    windows = np.lib.stride_tricks.sliding_window_view(mask, length, axis=axis).all(axis=-1)
+    runs = np.zeros_like(mask)
+    for offset in range(length):
+        index = [slice(None), slice(None)]
+        index[axis] = slice(offset, offset + windows.shape[axis])
+        runs[tuple(index)] |= windows
+    return runs
+
+# Function to measure the fraction of a page drawn outside its words (in points, times `scale`) and thin rules
+def drawn_fraction(image, word_boxes, scale=1.0):
+    pixels = np.asarray(image.convert("L"), dtype=np.int16)
+    ink = np.abs(pixels - int(np.median(pixels[::8, ::8]))) > INK_CONTRAST
+    for x0, y0, x1, y1 in word_boxes:
+        ink[max(0, int(y0 * scale) - 1):int(math.ceil(y1 * scale)) + 1,
+            max(0, int(x0 * scale) - 1):int(math.ceil(x1 * scale)) + 1] = False
+    if min(ink.shape) > PDF_RULE_MIN_LENGTH:
+        rules = np.zeros_like(ink)
+        for along, across in ((1, 0), (0, 1)):  # Both directions on the original, so crossings go too
+            runs = straight_runs(ink, PDF_RULE_MIN_LENGTH, along)
+            rules |= runs & ~straight_runs(runs, PDF_RULE_MAX_WIDTH + 1, across)  # Thick runs are bars and fills
+        ink &= ~rules
+    cell = PDF_DRAWING_CELL
+    height, width = ink.shape[0] // cell * cell, ink.shape[1] // cell * cell
+    if not height or not width:
+        return 0.0
+    counts = ink[:height, :width].reshape(height // cell, cell, width // cell, cell).sum(axis=(1, 3))
+    return float(np.count_nonzero(counts >= cell // 2)) / counts.size
+
+# DICOM settings
+DICOM_SLICES_PER_SERIES = int(os.environ.get("DIAG_DICOM_SLICES", "8"))  # Representative slices sent per series
+DICOM_MAX_DIM = 1536  # CT/MR slices are 512px; radiographs are block-averaged down to this
+DICOM_SAMPLE_DIM = 64  # Slices are scored on a strided sample about this size
+DICOM_MIN_SLICE_STD = 4.0  # Windowed slices more uniform than this (air, padding) are not picked
+# Window presets as (center, width) in Hounsfield units; None uses the file's own window
+DICOM_WINDOWS = {
+    "From file": None,
+    "Soft tissue": (40, 400),
+    "Lung": (-600, 1500),
+    "Bone": (400, 1800),
+    "Brain": (40, 80),
+}
+PIXEL_DATA_TAG = 0x7FE00010
+mimetypes.add_type("application/dicom", ".dcm")
+
+# Function to read a numeric DICOM attribute, also from the shared functional groups of enhanced multi-frame files
+def dicom_value(ds, keyword, default=None):
+    value = ds.get(keyword)
+    if value is None:
+        for group in ds.get("SharedFunctionalGroupsSequence") or []:
+            for element in group:
+                if element.VR == "SQ" and element.value and keyword in element.value[0]:
+                    value = element.value[0].get(keyword)
+    if value is None or value == "":
+        return default
+    if not isinstance(value, (str, bytes)) and hasattr(value, "__len__"):
+        value = value[0]  # Multi-valued windows: the first one is the primary
+    return float(value)
+
+# Function to open the pixel data of a DICOM file as a (frames, rows, columns[, samples]) array
+def dicom_frames(path):
+    """Returns (dataset, frames). Uncompressed pixel data is memory-mapped from the file,
+    so only the slices that are sampled or encoded are ever read; compressed transfer
+    syntaxes have to be decoded in full by pydicom.
+    """
+    with open(path, "rb") as f:
+        ds = pydicom.dcmread(f, stop_before_pixels=True)  # Leaves the file at the pixel data element
+        syntax = ds.file_meta.get("TransferSyntaxUID")
+        # The element header is tag + length with implicit VR, tag + VR + reserved + length with explicit VR
+        header = f.read(8 if syntax is None or syntax.is_implicit_VR else 12)
+        offset = f.tell()
+    byteorder = "little" if syntax is None or syntax.is_little_endian else "big"
+    tag = int.from_bytes(header[:2], byteorder) << 16 | int.from_bytes(header[2:4], byteorder)
+    length = int.from_bytes(header[-4:], byteorder)
+    frames = int(ds.get("NumberOfFrames") or 1)
+    samples = int(ds.get("SamplesPerPixel") or 1)
+    shape = (frames, int(ds.Rows), int(ds.Columns))
+    bits = int(ds.get("BitsAllocated") or 0)
+    if (syntax is None or syntax.is_compressed or tag != PIXEL_DATA_TAG or length == 0xFFFFFFFF  # Encapsulated
+            or bits not in (8, 16, 32) or ds.get("PhotometricInterpretation") not in ("MONOCHROME1", "MONOCHROME2", "RGB")):
+        ds = pydicom.dcmread(path)
+        return ds, ds.pixel_array.reshape(shape + ((samples,) if samples > 1 else ()))
+    dtype = np.dtype(("<" if byteorder == "little" else ">") + ("i" if ds.get("PixelRepresentation") == 1 else "u") + str(bits // 8))
+    planar = samples > 1 and ds.get("PlanarConfiguration") == 1
+    shape = (frames, samples) + shape[1:] if planar else shape + ((samples,) if samples > 1 else ())
+    array = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape)
+    return ds, array.transpose(0, 2, 3, 1) if planar else array
+
+# Function to shrink a frame by an integer factor by averaging blocks of pixels
+def block_downsample(frame, max_dim):
+    factor = math.ceil(max(frame.shape[:2]) / max_dim)
+    if factor <= 1:
+        return frame.astype(np.float32)
+    height, width = frame.shape[0] // factor * factor, frame.shape[1] // factor * factor
+    blocks = frame[:height, :width].reshape(height // factor, factor, width // factor, factor, *frame.shape[2:])
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+# Function to map stored values to 8-bit display values with the modality rescale and a window
+def apply_window(values, ds, window):
+    """`values` is a float array; `window` is (center, width) in rescaled units."""
+    if int(ds.get("SamplesPerPixel") or 1) > 1:
+        return np.clip(values, 0, 255).astype(np.uint8)  # Color images are not windowed
+    values = values * dicom_value(ds, "RescaleSlope", 1.0) + dicom_value(ds, "RescaleIntercept", 0.0)
+    center, width = window
+    # Linear VOI function of PS3.3 C.11.2.1.2
+    display = np.clip((values - (center - 0.5)) / max(width - 1, 1) + 0.5, 0, 1) * 255
+    if ds.PhotometricInterpretation == "MONOCHROME1":
+        display = 255 - display  # Stored inverted: low values are white
+    return display.astype(np.uint8)
+
+# Function to work out the window of a series: a preset, the file's own, or the range of sampled values
+def series_window(ds, samples, preset=None):
+    if preset is not None:
+        return preset
+    center, width = dicom_value(ds, "WindowCenter"), dicom_value(ds, "WindowWidth")
+    if center is not None and width is not None and width > 0:
+        return center, width
+    values = np.concatenate([sample.ravel() for sample in samples]) * dicom_value(ds, "RescaleSlope", 1.0) \
+        + dicom_value(ds, "RescaleIntercept", 0.0)
+    low, high = np.percentile(values, (0.5, 99.5))
+    return (low + high) / 2, max(high - low, 1)
+
+# Function to find where a single-frame slice sits along its series' axis
+def slice_position(ds):
+    position, orientation = ds.get("ImagePositionPatient"), ds.get("ImageOrientationPatient")
+    if position is not None and orientation is not None and len(orientation) == 6:
+        normal = np.cross([float(v) for v in orientation[:3]], [float(v) for v in orientation[3:]])
+        return float(np.dot(normal, [float(v) for v in position]))
+    return float(ds.get("InstanceNumber") or 0)
+
+# Function to group DICOM files into series and pick the slices worth sending; runs in a worker process
+def select_dicom_slices(paths, dicom_options=None):
+    """Returns one dict per series with its description, window and chosen (path, frame) slices.
+
+    Slices are ordered along the patient axis and scored on a strided sample of
+    their windowed pixels; nearly uniform slices are skipped and the rest are
+    picked evenly spaced, so a 500-slice CT contributes a handful of slices from
+    across the anatomy without being loaded into memory.
+    """
+    options = dict(dicom_options or {})
+    preset = DICOM_WINDOWS.get(options.get("window"))
+    count = options.get("slices") or DICOM_SLICES_PER_SERIES
+    series = {}
+    for path in paths:
+        ds, frames = dicom_frames(path)
+        uid = str(ds.get("SeriesInstanceUID") or path)
+        position = slice_position(ds)
+        step = max(1, max(frames.shape[1:3]) // DICOM_SAMPLE_DIM)
+        samples = np.asarray(frames[:, ::step, ::step], dtype=np.float32)  # Only the sampled rows are read
+        for frame, sample in enumerate(samples):
+            series.setdefault(uid, []).append((position, frame, path, ds, sample))
+        del frames  # Releases the memory map
+
+    selected = []
+    for uid, slices in series.items():
+        slices.sort(key=lambda entry: entry[:2])
+        ds = slices[0][3]
+        window = series_window(ds, [entry[4] for entry in slices], preset)
+        scores = np.array([apply_window(sample, slice_ds, window).std() for _, _, _, slice_ds, sample in slices])
+        candidates = np.flatnonzero(scores >= DICOM_MIN_SLICE_STD)
+        if not len(candidates):
+            candidates = np.arange(len(slices))
+        picks = candidates[np.unique(np.linspace(0, len(candidates) - 1, min(count, len(candidates))).round().astype(int))]
+        description = " ".join(str(ds.get(keyword) or "") for keyword in ("Modality", "BodyPartExamined", "SeriesDescription"))
+        selected.append({
+            "description": " ".join(description.split()) or "DICOM series",
+            "window": tuple(float(value) for value in window),
+            "slices": [(slices[index][2], slices[index][1]) for index in picks],
+            "total": len(slices),
+        })
+    return selected
+
+# Function to render and encode chosen DICOM slices into (preview, part) entries; runs in a worker process
+def encode_dicom_slices(slices, window):
+    entries = []
+    for path, frame in slices:
+        ds, frames = dicom_frames(path)
+        with stage_span("encode"):
+            display = apply_window(block_downsample(frames[frame], DICOM_MAX_DIM), ds, window)
+            image = Image.fromarray(display)
+            entries.append((image, image_to_part(image)))
+        del frames
+    return entries
+
+# Function to encode the representative slices of every series in a set of DICOM files
+def encode_dicom_series(paths, dicom_options=None):
+    entries = []
+    for series in select_dicom_slices(paths, dicom_options):
+        print(f"DICOM {series['description']}: sending {len(series['slices'])} of {series['total']} slices")
+        entries.extend(encode_dicom_slices(series["slices"], series["window"]))
+    return entries
+
+# Background job settings
+JOB_PROCESSES = int(os.environ.get("DIAG_JOB_PROCESSES", str(min(4, os.cpu_count() or 1))))
+JOB_THREADS = int(os.environ.get("DIAG_JOB_THREADS", "32"))  # Job coordinators; model calls run on the shared event loop
+JOB_PDF_PAGES = 4  # PDF pages per worker-process task, so progress moves in small steps
+JOB_RESULT_TTL = 15 * 60  # seconds a finished job is kept for its session to collect
+JOB_POLL_SECONDS = 0.5
+
+class Job:
+    """Background work for one session and case, with progress the UI can poll."""
+
+    def __init__(self, key):
+        self.key = key
+        self.progress = 0.0
+        self.message = "Queued"
+        self.partial = None  # Sections of a streaming diagnosis received so far
+        self.models = []  # Models whose answers make up the result
+        self.messages = []  # (level, text) for the page to show: job threads can't call st.error
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.finished_at = None
+        self.future = None
+
+    @property
+    def done(self):
+        return self.finished_at is not None
+
+    def update(self, progress, message=None):
+        self.progress = min(1.0, max(0.0, progress))
+        if message:
+            self.message = message
+
+# The job the current thread works for; copied into helper threads with contextvars.copy_context()
+current_job = contextvars.ContextVar("current_job", default=None)
+
+# Messages held back by held_notices() in the current context; None when they are shown
+notice_hold = contextvars.ContextVar("notice_hold", default=None)
+
+@contextmanager
+def held_notices():
+    """Collects the (level, message) pairs notify() is given instead of showing them."""
+    held = []
+    token = notice_hold.set(held)
+    try:
+        yield held
+    finally:
+        notice_hold.reset(token)
+
+# Function to show an error or warning, or keep it on the job when called from a background job
+def notify(level, message):
+    held = notice_hold.get()
+    if held is not None:
+        held.append((level, message))
+        return
+    job = current_job.get()
+    if job is None:
+        getattr(st, level)(message)
+    else:
+        job.messages.append((level, message))
+
+# Function to show what a finished job reported
+def show_job_messages(job):
+    for level, message in dict.fromkeys(job.messages):  # Split requests may repeat a message
+        getattr(st, level)(message)
+
+class JobQueue:
+    """Runs jobs off the Streamlit script thread so no session blocks another.
+
+    Each job is coordinated on a thread; CPU-bound steps (rasterizing, decoding,
+    encoding) go to a process pool via run_cpu(), and model calls go through the
+    async client on the background event loop. Jobs are keyed by (session, case),
+    and submitting a case that is already queued returns the existing job.
+    """
+
+    def __init__(self, processes=JOB_PROCESSES, threads=JOB_THREADS):
+        self._process_count = processes
+        self._processes = None
+        self._threads = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="diag_job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, session_id, case, func, *args):
+        key = (session_id, case)
+        with self._lock:
+            self._prune()
+            job = self._jobs.get(key)
+            if job is not None and not job.error:
+                return job
+            job = self._jobs[key] = Job(key)
+            job.future = self._threads.submit(self._run, job, func, args)
+            return job
+
+    def _run(self, job, func, args):
+        token = current_job.set(job)
+        try:
+            job.result = func(job, *args)
+        except Exception as e:
+            job.error = f"{type(e).__name__}: {e}"
+            print(f"Job {job.key[1]} failed:", job.error)
+        finally:
+            current_job.reset(token)
+            job.progress = 1.0
+            job.finished_at = time.time()
+
+    def _prune(self):
+        now = time.time()
+        for key in [key for key, job in self._jobs.items() if job.done and now - job.finished_at > JOB_RESULT_TTL]:
+            del self._jobs[key]
+
+    def get(self, session_id, case):
+        with self._lock:
+            return self._jobs.get((session_id, case))
+
+    def pop(self, session_id, case):
+        with self._lock:
+            return self._jobs.pop((session_id, case), None)
+
+    def pending(self, session_id):
+        with self._lock:
+            return [job for key, job in self._jobs.items() if key[0] == session_id and not job.done]
+
+    def run_cpu(self, func_name, *args):
+        """Runs the module-level function `func_name` in the process pool and returns its future.
+        The stages it times are recorded in this process's metrics when it finishes."""
+        with self._lock:
+            if self._processes is None:
+                # spawn: forking a process that runs Streamlit's threads is unsafe
+                self._processes = ProcessPoolExecutor(self._process_count, mp_context=multiprocessing.get_context("spawn"))
+        # Under `streamlit run` this script is __main__, which worker processes cannot
+        # import; the functions are looked up on the importable Diag_Assist module instead.
+        future = Future()
+
+        def unpack(done):
+            try:
+                result, spans = done.result()
+            except BaseException as e:
+                future.set_exception(e)
+                return
+            for stage, elapsed, labels in spans:
+                record_span(stage, elapsed, labels)
+            future.set_result(result)
+
+        self._processes.submit(importlib.import_module("Diag_Assist").run_in_worker, func_name, *args).add_done_callback(unpack)
+        return future
+
+@shared_resource
+def get_job_queue():
+    return JobQueue()
+
+# Function to get an id for the current browser session
+def get_session_id():
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    return st.session_state.session_id
+
+# Function to decode and encode an uploaded image; runs in a worker process
+def encode_image_bytes(data, mime_type):
+    return [(image, image_part, make_thumbnail(image)) for image, image_part in encode_file(io.BytesIO(data), mime_type)]
+
+# Function to rasterize and encode a range of PDF pages; runs in a worker process
+def encode_pdf_pages(pdf_path, pdf_options, first_page, last_page):
+    options = dict(pdf_options or {}, first_page=first_page, last_page=last_page, thread_count=1)
+    return [(preview, image_part, make_thumbnail(preview)) for preview, image_part in encode_file(pdf_path, "application/pdf", options)]
+
+# Function to render and encode a batch of DICOM slices; runs in a worker process
+def encode_dicom_batch(slices, window):
+    return [(image, image_part, make_thumbnail(image)) for image, image_part in encode_dicom_slices(slices, window)]
+
+# Job: turn one upload into cached (image, part, thumbnail) entries
+def process_upload(job, file, key, mime_type, pdf_options, spill_area):
+    queue = get_job_queue()
+    with stage_span("upload_job"):
+        if mime_type != "application/pdf":
+            job.update(0.1, f"Encoding {file.name}")
+            entries = queue.run_cpu("encode_image_bytes", file.getvalue(), mime_type).result()
+        else:
+            entries = []
+            # Poppler only reads files, so PDFs are spilled to the session's temp area
+            with spill_area.path_for(key, file.getbuffer(), ".pdf") as pdf_path:
+                page_count = pdf2image.pdfinfo_from_path(pdf_path)["Pages"]
+                first_page = max(1, (pdf_options or {}).get("first_page") or 1)
+                last_page = min(page_count, (pdf_options or {}).get("last_page") or page_count)
+                batches = [(start, min(start + JOB_PDF_PAGES - 1, last_page))
+                           for start in range(first_page, last_page + 1, JOB_PDF_PAGES)]
+                futures = [queue.run_cpu("encode_pdf_pages", pdf_path, pdf_options, start, end) for start, end in batches]
+                for done, (future, (_, end)) in enumerate(zip(futures, batches), 1):
+                    entries.extend(future.result())  # In page order
+                    job.update(done / len(futures), f"{file.name}: page {end} of {last_page}")
+    if not entries:
+        raise ValueError(f"No pages could be read from {file.name}. Is Poppler installed?")
+    get_upload_cache().put(key, entries, upload_entries_size(entries))
+    return entries
+
+# Job: turn a set of DICOM files into cached entries for the representative slices of each series
+def process_dicom_upload(job, files, file_keys, key, dicom_options, spill_area):
+    queue = get_job_queue()
+    entries = []
+    with stage_span("upload_job"), ExitStack() as stack:
+        # Spilled files are memory-mapped by the workers instead of being pickled over to them
+        paths = [stack.enter_context(spill_area.path_for(file_key, file.getbuffer(), ".dcm"))
+                 for file, file_key in zip(files, file_keys)]
+        job.update(0.1, f"Choosing slices from {len(paths)} DICOM file(s)")
+        series = queue.run_cpu("select_dicom_slices", paths, dicom_options).result()
+        batches = [(entry["slices"][start:start + JOB_PDF_PAGES], entry["window"])
+                   for entry in series for start in range(0, len(entry["slices"]), JOB_PDF_PAGES)]
+        futures = [queue.run_cpu("encode_dicom_batch", slices, window) for slices, window in batches]
+        for done, future in enumerate(futures, 1):
+            entries.extend(future.result())  # In series and slice order
+            job.update(0.1 + 0.9 * done / len(futures), f"DICOM: {done} of {len(futures)} batches encoded")
+    if not entries:
+        raise ValueError("No slices could be read from the DICOM files")
+    get_upload_cache().put(key, entries, upload_entries_size(entries))
+    return entries
+
+# Job: run a planned diagnosis request
+def diagnose_job(job, prompt, images, plan, use_cache, stream):
+    job.update(0.05, "Waiting for the model")
+
+    def on_partial(partial):
+        job.partial = dict(partial)
+        if partial:
+            job.update(job.progress + 0.05, f"Received {len(partial)} section(s)")
+        else:
+            job.update(job.progress, "Asking a stronger model")
+
+    def on_progress(done, total):
+        job.update(done / total, f"{done} of {total} calls finished")
+
+    def on_route(route):
+        job.models.append(route["model"])
+
+    return run_plan(prompt, images, plan, use_cache, on_partial if stream else None, on_progress, on_route)
+
+# Function to pick the rasterization settings for uploaded PDFs
+def pdf_upload_options():
+    with st.expander("PDF options"):
+        dpi = st.select_slider("Rasterization DPI", options=[72, 100, 150, 200, 300], value=PDF_DPI)
+        first_page = st.number_input("First page", min_value=1, value=1, step=1)
+        last_page = st.number_input("Last page (0 = until the end)", min_value=0, value=0, step=1)
+        text_layer = st.checkbox("Send text-only pages as text", value=PDF_TEXT_LAYER,
+                                 help="Born-digital pages without images are sent as their text instead of a bitmap.")
+    return {
+        "dpi": dpi,
+        "first_page": int(first_page),
+        "last_page": int(last_page) or None,
+        "text_layer": text_layer,
+    }
+
+# Function to pick how uploaded DICOM series are rendered
+def dicom_upload_options():
+    with st.expander("DICOM options"):
+        window = st.selectbox("Window", list(DICOM_WINDOWS),
+                              help="Window/level applied to the slices; presets are in Hounsfield units for CT.")
+        slices = st.slider("Slices per series", min_value=1, max_value=32, value=DICOM_SLICES_PER_SERIES,
+                           help="Representative slices are picked evenly across each series, skipping empty ones.")
+    return {"window": window, "slices": slices}
+
+# Function to turn the uploaded DICOM files into image entries, via a background job
+def dicom_upload(files, dicom_options):
+    if importlib.util.find_spec("pydicom") is None:
+        st.error("DICOM uploads need pydicom. Install it with `pip install pydicom`.")
+        return []
+    cache = get_upload_cache()
+    file_keys = [upload_cache_key(file, "application/dicom") for file in files]
+    key = dicom_cache_key(file_keys, dicom_options)
+    entries = cache.get(key)
+    if entries is None:
+        jobs = get_job_queue()
+        session_id = get_session_id()
+        job = jobs.submit(session_id, key, process_dicom_upload, files, file_keys, key, dicom_options, get_spill_area())
+        if not job.done:
+            st.progress(job.progress, text=f"Processing {len(files)} DICOM file(s): {job.message}")
+            return []
+        jobs.pop(session_id, key)
+        if job.error:
+            st.error(f"Could not process the DICOM files: {job.error}")
+            return []
+        entries = job.result
+    return [(image, image_part, "dicom slice", thumbnail, f"{key}#{index}")
+            for index, (image, image_part, thumbnail) in enumerate(entries)]
+
 # Function to upload and process images
 def image_upload():
     images = []
-    uploaded_files = st.file_uploader("Reports & Scans", type=["png", "jpg", "jpeg", "pdf"], accept_multiple_files=True)
+    uploaded_files = st.file_uploader("Reports & Scans", type=["png", "jpg", "jpeg", "pdf", "dcm"], accept_multiple_files=True)
 
     if uploaded_files:
+        cache = get_upload_cache()
+        jobs = get_job_queue()
+        session_id = get_session_id()
+        pdf_options = None
+        if any(file.name.lower().endswith(".pdf") for file in uploaded_files):
+            pdf_options = pdf_upload_options()
+        # A DICOM series spans many files, so they are rendered together
+        dicom_files = [file for file in uploaded_files if mimetypes.guess_type(file.name)[0] == "application/dicom"]
         for file in uploaded_files:
-            file_path = os.path.join("uploads", file.name)
-            os.makedirs("uploads", exist_ok=True)
-            with open(file_path, "wb") as f:
-                f.write(file.getbuffer())
-            mime_type = mimetypes.guess_type(file_path)[0]
-            if mime_type in ["image/png", "image/jpg", "image/jpeg"]:
-                image = Image.open(file)
-                img_byte_arr = io.BytesIO()
-                image.save(img_byte_arr, format='PNG')
-                img_byte_arr = img_byte_arr.getvalue()
-                image_part = genai.types.Part.from_bytes(
-                    data=img_byte_arr,
-                    mime_type="image/png"
-                )
-                images.append((image, image_part, file_path))
-            elif mime_type == "application/pdf":
-                pdf_images = pdf_to_images(file_path)
-                for img in pdf_images:
-                    img_byte_arr = io.BytesIO()
-                    img.save(img_byte_arr, format='PNG')
-                    img_byte_arr = img_byte_arr.getvalue()
-                    image_part = genai.types.Part.from_bytes(
-                        data=img_byte_arr,
-                        mime_type="image/png"
-                    )
-                    images.append((img, image_part, "pdf page"))
-            else:
+            mime_type = mimetypes.guess_type(file.name)[0]
+            if mime_type == "application/dicom":
+                continue
+            if mime_type not in ["image/png", "image/jpg", "image/jpeg", "application/pdf"]:
                 st.warning(f"Unsupported file type: {mime_type}")
+                continue
+            key = upload_cache_key(file, mime_type, pdf_options)
+            entries = cache.get(key)
+            if entries is None:
+                job = jobs.submit(session_id, key, process_upload, file, key, mime_type, pdf_options, get_spill_area())
+                if not job.done:
+                    st.progress(job.progress, text=f"Processing {file.name}: {job.message}")
+                    continue
+                jobs.pop(session_id, key)
+                if job.error:  # A failed conversion is not cached, so re-uploading retries it
+                    st.error(f"Could not process {file.name}: {job.error}")
+                    continue
+                entries = job.result
+            label = file.name if mime_type != "application/pdf" else "pdf page"
+            for index, (image, image_part, thumbnail) in enumerate(entries):
+                images.append((image, image_part, label, thumbnail, f"{key}#{index}"))  # The page key
+        if dicom_files:
+            images.extend(dicom_upload(dicom_files, dicom_upload_options()))
     return images
 
+GEMINI_MODEL = 'gemini-2.0-flash'
+
+# Response cache settings
+RESPONSE_CACHE_DIR = os.path.join(".cache", "responses")
+RESPONSE_CACHE_TTL = 24 * 60 * 60  # seconds
+RESPONSE_CACHE_MAX_ENTRIES = 256  # in memory
+RESPONSE_CACHE_MAX_DISK_BYTES = 256 * 1024 * 1024
+
+class ResponseCache:
+    """Two-tier cache of raw Gemini responses: an in-memory LRU in front of a directory of JSON files."""
+
+    def __init__(self, directory=RESPONSE_CACHE_DIR, ttl=RESPONSE_CACHE_TTL,
+                 max_entries=RESPONSE_CACHE_MAX_ENTRIES, max_disk_bytes=RESPONSE_CACHE_MAX_DISK_BYTES):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _read_disk(self, key):
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                entry = json.load(f)
+            return entry["stored_at"], entry["text"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def get(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                entry = self._read_disk(key)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                self._memory.pop(key, None)
+                self.misses += 1
+                return None
+            self._remember(key, entry)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, text):
+        entry = (time.time(), text)
+        with self._lock:
+            self._remember(key, entry)
+            tmp_path = self._path(key) + ".tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump({"stored_at": entry[0], "text": text}, f)
+                os.replace(tmp_path, self._path(key))  # Readers never see a half-written entry
+                self._prune_disk()
+            except OSError as e:
+                print("Could not write response cache entry:", e)
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _prune_disk(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries_in_memory": len(self._memory)}
+
+@shared_resource
+def get_response_cache():
+    return ResponseCache()
+
+# Function to hash everything that determines a Gemini response
+def response_cache_key(contents, sys_ins, model, config):
+    digest = hashlib.sha256()
+    for item in contents:
+        if isinstance(item, str):
+            digest.update(b"text\0" + item.encode("utf-8"))
+        elif item.inline_data is not None:
+            digest.update(b"blob\0" + item.inline_data.mime_type.encode("utf-8") + b"\0")
+            digest.update(item.inline_data.data)
+        else:
+            digest.update(b"part\0" + item.model_dump_json(exclude_none=True).encode("utf-8"))
+    digest.update(b"sys_ins\0" + sys_ins.encode("utf-8"))
+    digest.update(b"model\0" + model.encode("utf-8"))
+    digest.update(b"config\0" + config.model_dump_json(exclude_none=True).encode("utf-8"))
+    return digest.hexdigest()
+
+# Async client settings
+GEMINI_CALL_TIMEOUT = 90  # seconds per attempt
+GEMINI_MAX_RETRIES = 4
+GEMINI_BACKOFF_BASE = 1.0  # seconds, doubled on every retry
+GEMINI_BACKOFF_MAX = 30.0
+GEMINI_MAX_CONCURRENCY = 8  # in-flight requests per API key
+GEMINI_REQUESTS_PER_MINUTE = float(os.environ.get("DIAG_GEMINI_RPM", "0"))  # request starts per API key (0 = unlimited)
+# Send a second, hedged request once the first is slower than this latency percentile (None = off).
+# google-genai 1.2.0 runs aio requests in worker threads (asyncio.to_thread), so cancelling the losing
+# request only abandons it: the HTTP call still completes and is billed, and briefly uses a thread
+# beyond the concurrency limit. Hedging is capped at one extra request per call for that reason.
+GEMINI_HEDGE_PERCENTILE = 95
+GEMINI_HEDGE_MIN_SAMPLES = 20  # latencies to observe before hedging kicks in
+GEMINI_LATENCY_WINDOW = 200
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+# Function to tell transient API failures from permanent ones
+def is_retryable_error(error):
+    if isinstance(error, genai_errors.APIError):
+        return error.code in RETRYABLE_STATUS_CODES
+    if isinstance(error, (asyncio.TimeoutError, httpx.TransportError)):
+        return True
+    # google-genai 1.2.0 sends requests with the requests library, so network failures surface as its exceptions
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                              requests.exceptions.ChunkedEncodingError))
+
+# Function to iterate an async stream on a reader thread. google-genai's async stream reads
+# the HTTP body with blocking calls, which would stall every other request on the shared loop
+async def read_in_thread(stream):
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stopped = threading.Event()
+
+    async def pump():
+        try:
+            async for item in stream:
+                if stopped.is_set():
+                    return  # The consumer gave up (timeout or cancel); abandon the rest
+                loop.call_soon_threadsafe(queue.put_nowait, ("item", item))
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, ("error", e))
+        else:
+            loop.call_soon_threadsafe(queue.put_nowait, ("end", None))
+
+    threading.Thread(target=asyncio.run, args=(pump(),), name="gemini-stream-reader", daemon=True).start()
+    try:
+        while True:
+            kind, value = await queue.get()
+            if kind == "error":
+                raise value
+            if kind == "end":
+                return
+            yield value
+    finally:
+        stopped.set()
+
+class AsyncGeminiClient:
+    """asyncio layer over client.aio with per-call deadlines, jittered retries, a per-key
+    concurrency limit and request rate, and optional hedged requests to trim tail latency."""
+
+    def __init__(self, genai_client, max_concurrency=GEMINI_MAX_CONCURRENCY, timeout=GEMINI_CALL_TIMEOUT,
+                 max_retries=GEMINI_MAX_RETRIES, hedge_percentile=GEMINI_HEDGE_PERCENTILE,
+                 requests_per_minute=GEMINI_REQUESTS_PER_MINUTE):
+        self._client = genai_client
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.hedge_percentile = hedge_percentile
+        self._latencies = deque(maxlen=GEMINI_LATENCY_WINDOW)
+        self.set_rate_limit(requests_per_minute)
+
+    def set_rate_limit(self, requests_per_minute):
+        """Spaces request starts so that no more than `requests_per_minute` begin in any minute (0 = unlimited).
+        Every attempt counts: retries, hedges, follow-up fields, escalations and reference lookups."""
+        self._interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+        self._next_slot = time.monotonic()
+
+    async def _wait_for_slot(self):
+        # Only the loop thread runs this, so reserving the slot needs no lock
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self._interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def hedge_delay(self):
+        if self.hedge_percentile is None or len(self._latencies) < GEMINI_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))]
+
+    async def _send(self, model, contents, config):
+        async with self._semaphore:
+            started = time.perf_counter()
+            response = await self._client.aio.models.generate_content(model=model, contents=contents, config=config)
+            self._latencies.append(time.perf_counter() - started)
+            return response
+
+    async def _hedged_send(self, model, contents, config):
+        delay = self.hedge_delay()
+        tasks = [asyncio.ensure_future(self._send(model, contents, config))]
+        try:
+            if delay is None:
+                return await tasks[0]
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                await self._wait_for_slot()
+                tasks.append(asyncio.ensure_future(self._send(model, contents, config)))
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()  # No-op for finished tasks; abandons the losing request (its thread runs to completion)
+
+    async def generate_content(self, model, contents, config, deadline=None):
+        """Calls the model, retrying retryable errors until `deadline` seconds have passed."""
+        deadline_at = time.monotonic() + deadline if deadline else None
+        for attempt in range(self.max_retries + 1):
+            await self._wait_for_slot()  # Outside the timeout: waiting for a slot is not a slow response
+            timeout = self.timeout
+            if deadline_at is not None:
+                timeout = min(timeout, deadline_at - time.monotonic())
+                if timeout <= 0:
+                    raise asyncio.TimeoutError("Gemini call deadline exceeded")
+            try:
+                return await asyncio.wait_for(self._hedged_send(model, contents, config), timeout)
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable_error(e):
+                    raise
+                # Full jitter keeps many clients from retrying in lockstep after a 429
+                backoff = random.uniform(0, min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * 2 ** attempt))
+                if deadline_at is not None and time.monotonic() + backoff >= deadline_at:
+                    raise
+                print(f"Retrying Gemini call in {backoff:.1f}s after: {e}")
+                await asyncio.sleep(backoff)
+
+    async def _send_stream(self, model, contents, config, on_chunk, received):
+        async with self._semaphore:
+            stream = await self._client.aio.models.generate_content_stream(model=model, contents=contents, config=config)
+            async for chunk in read_in_thread(stream):
+                received.append(True)
+                on_chunk(chunk)
+
+    async def generate_content_stream(self, model, contents, config, on_chunk, deadline=None):
+        """Streams the model's answer to on_chunk (called on the loop thread), with the same
+        concurrency limit, per-attempt timeout and retries as generate_content.
+
+        A failed attempt is only retried before its first chunk: once text has been
+        passed on, starting over would repeat it. Streams are not hedged.
+        """
+        deadline_at = time.monotonic() + deadline if deadline else None
+        for attempt in range(self.max_retries + 1):
+            await self._wait_for_slot()  # Outside the timeout: waiting for a slot is not a slow response
+            timeout = self.timeout
+            if deadline_at is not None:
+                timeout = min(timeout, deadline_at - time.monotonic())
+                if timeout <= 0:
+                    raise asyncio.TimeoutError("Gemini call deadline exceeded")
+            received = []
+            try:
+                return await asyncio.wait_for(self._send_stream(model, contents, config, on_chunk, received), timeout)
+            except Exception as e:
+                if received or attempt == self.max_retries or not is_retryable_error(e):
+                    raise
+                backoff = random.uniform(0, min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * 2 ** attempt))
+                if deadline_at is not None and time.monotonic() + backoff >= deadline_at:
+                    raise
+                print(f"Retrying Gemini stream in {backoff:.1f}s after: {e}")
+                await asyncio.sleep(backoff)
+
+class BackgroundEventLoop:
+    """An asyncio loop running in a daemon thread, so synchronous code can share async clients."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="gemini-event-loop", daemon=True)
+        self._thread.start()
+
+    def run(self, coro, timeout=None, scope=None):
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        if scope is not None:
+            scope.attach(future)
+        return future.result(timeout)
+
+class CancelScope:
+    """Lets another thread cancel a model call that is running on the background loop."""
+
+    def __init__(self):
+        self.cancelled = False
+        self._future = None
+        self._lock = threading.Lock()
+
+    def attach(self, future):
+        with self._lock:
+            self._future = future
+            if self.cancelled:
+                future.cancel()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            if self._future is not None:
+                self._future.cancel()  # Also cancels the task on the loop, so the request is abandoned
+
+@shared_resource
+def get_event_loop():
+    return BackgroundEventLoop()
+
+# One async client (and so one concurrency limit) per API key, shared by the whole process
+@shared_resource
+def get_async_gemini_client(api_key=API_KEY):
+    genai_client = get_client() if api_key == API_KEY else genai.Client(api_key=api_key)
+    return AsyncGeminiClient(genai_client)
+
+# Upload-once settings: inline parts larger than the threshold are sent as file handles
+USE_FILE_UPLOADS = os.environ.get("DIAG_FILE_UPLOADS", "1") != "0"
+FILE_UPLOAD_THRESHOLD = 256 * 1024  # bytes
+FILE_HANDLE_SAFETY_MARGIN = 10 * 60  # seconds; don't reference a handle this close to expiry
+FILE_UPLOAD_WORKERS = 8
+FILE_PROCESSING_TIMEOUT = 60  # seconds to wait for an uploaded file to become ACTIVE
+FILE_HANDLE_DEFAULT_TTL = 48 * 60 * 60  # used when the service reports no expiry
+
+@shared_resource
+def get_file_service():
+    if os.environ.get("DIAG_FILE_SERVICE") == "local":
+        from local_gemini import LocalFileService
+        return LocalFileService()
+    return get_client().files
+
+class FileHandleCache:
+    """Maps content hashes to uploaded file handles (uri, mime type, expiry timestamp)."""
+
+    def __init__(self):
+        self._handles = {}
+        self._lock = threading.Lock()
+
+    def get(self, digest):
+        with self._lock:
+            handle = self._handles.get(digest)
+            if handle is None:
+                return None
+            if handle[2] - FILE_HANDLE_SAFETY_MARGIN <= time.time():
+                del self._handles[digest]
+                return None
+            return handle
+
+    def put(self, digest, uri, mime_type, expires_at):
+        with self._lock:
+            self._handles[digest] = (uri, mime_type, expires_at)
+
+@shared_resource
+def get_file_handle_cache():
+    return FileHandleCache()
+
+# Function to upload one blob once and return a Part that references it
+def file_handle_part(data, mime_type):
+    digest = hashlib.sha256(data).hexdigest()
+    cache = get_file_handle_cache()
+    handle = cache.get(digest)
+    if handle is None:
+        service = get_file_service()
+        uploaded = service.upload(file=io.BytesIO(data), config={"mime_type": mime_type, "display_name": digest[:16]})
+        waited = 0
+        while uploaded.state == "PROCESSING" and waited < FILE_PROCESSING_TIMEOUT:
+            time.sleep(1)
+            waited += 1
+            uploaded = service.get(name=uploaded.name)
+        expires_at = uploaded.expiration_time.timestamp() if uploaded.expiration_time else time.time() + FILE_HANDLE_DEFAULT_TTL
+        handle = (uploaded.uri, uploaded.mime_type or mime_type, expires_at)
+        cache.put(digest, *handle)
+    return genai.types.Part.from_uri(file_uri=handle[0], mime_type=handle[1])
+
+# Function to swap large inline parts for uploaded file handles
+def resolve_file_handles(contents, threshold=FILE_UPLOAD_THRESHOLD):
+    if not USE_FILE_UPLOADS:
+        return contents
+
+    def resolve(item):
+        if isinstance(item, str) or item.inline_data is None or len(item.inline_data.data) <= threshold:
+            return item
+        try:
+            return file_handle_part(item.inline_data.data, item.inline_data.mime_type)
+        except Exception as e:
+            print("File upload failed, sending inline instead:", e)
+            return item
+
+    with ThreadPoolExecutor(max_workers=FILE_UPLOAD_WORKERS) as pool:
+        return list(pool.map(resolve, contents))
+
+# Function to build the generation config used for diagnoses
+def gemini_config(sys_ins):
+    return genai_types.GenerateContentConfig(
+        system_instruction=sys_ins,
+        temperature=1,
+        # With the reference cache on, articles are looked up after the diagnosis, and only on a cache miss
+        tools=None if REFERENCE_CACHE_ENABLED else [get_google_search_tool()],
+    )
+
+# Function to strip the markdown fence Gemini tends to wrap JSON in
+def clean_response_text(r):
+    a = r.strip('```')
+    if a.startswith("json"):
+        return a[4:].strip()  # Remove "json" and any leading/trailing whitespace
+    return a
+
 # Function to call Gemini API
-def call_gemini(contents, sys_ins):
+def call_gemini(contents, sys_ins, use_cache=True, model=GEMINI_MODEL, scope=None):
+    config = gemini_config(sys_ins)
+    cache = get_response_cache()
+    key = response_cache_key(contents, sys_ins, model, config)
+    if use_cache:
+        cached = cache.get(key)
+        if cached is not None:
+            record_request(model, "cache_hit")
+            return cached
     try:
-        response = client.models.generate_content(
-            model='gemini-2.0-flash',
-            contents=contents,
-            config=GenerateContentConfig(
-                system_instruction=sys_ins,
-                temperature=1,
-                tools=[google_search_tool],
-            ),
-        )
+        with stage_span("gemini_call", model=model):
+            response = get_event_loop().run(
+                get_async_gemini_client().generate_content(model, resolve_file_handles(contents), config), scope=scope
+            )
+        record_request(model, "ok", response.usage_metadata)
+        if response.usage_metadata is not None:
+            get_token_calibration().update(estimate_contents_tokens(contents, sys_ins), response.usage_metadata.prompt_token_count)
+
+        json_string = clean_response_text(response.text)
+        print("The json is:", json_string)
+        if parses_as_json(json_string):  # A bypassed call still refreshes the cache; unusable answers are never stored
+            cache.put(key, json_string)
+        return json_string
+    except CancelledError:
+        record_request(model, "cancelled")
+        return None
+    except Exception as e:
+        record_request(model, "error")
+        notify("error", f"\u274C Error calling Gemini API: {e}")
+        return None
 
-        r = response.text        
-        a = r.strip('```')
-        if a.startswith("json"):
-            json_string = a[4:].strip()  # Remove "json" and any leading/trailing whitespace
-        else:
-            json_string = a
+class IncrementalJSONParser:
+    """Scans a JSON object as it streams in and reports pieces as soon as they are complete.
+
+    feed() returns events: ("section", key, value) when a top-level value closes, and
+    ("item", key, index, value) for each element of a top-level array as it closes.
+    Text before the first '{' (such as a ```json fence) is ignored.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self._pos = 0
+        self._stack = []  # Open '{' / '[' brackets
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._key = None
+        self._expecting_key = True
+        self._value_start = None
+        self._item_start = None
+        self._item_index = 0
+        self.done = False
+
+    def _decode(self, text):
+        try:
+            return True, json.loads(text)
+        except ValueError:
+            return False, None
+
+    def _finish_value(self, end, events):
+        ok, value = self._decode(self.buffer[self._value_start:end])
+        if ok and self._key is not None:
+            events.append(("section", self._key, value))
+        self._value_start = None
+        self._key = None
+
+    def _finish_item(self, end, events):
+        ok, value = self._decode(self.buffer[self._item_start:end])
+        if ok:
+            events.append(("item", self._key, self._item_index, value))
+        self._item_index += 1
+        self._item_start = None
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        events = []
+        while self._pos < len(self.buffer) and not self.done:
+            i = self._pos
+            c = self.buffer[i]
+            self._pos += 1
+            depth = len(self._stack)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if depth == 1 and self._expecting_key:
+                        ok, self._key = self._decode(self.buffer[self._string_start:i + 1])
+                    elif depth == 1:
+                        self._finish_value(i + 1, events)
+                    elif depth == 2 and self._stack[-1] == "[" and self._item_start == self._string_start:
+                        self._finish_item(i + 1, events)
+                continue
+            if depth == 0:
+                if c == "{":
+                    self._stack.append(c)
+                continue
+            if c == '"':
+                self._in_string = True
+                self._string_start = i
+                if depth == 1 and not self._expecting_key and self._value_start is None:
+                    self._value_start = i
+                elif depth == 2 and self._stack[-1] == "[" and self._item_start is None:
+                    self._item_start = i
+            elif c in "{[":
+                if depth == 1 and self._value_start is None:
+                    self._value_start = i
+                    self._item_index = 0
+                elif depth == 2 and self._stack[-1] == "[" and self._item_start is None:
+                    self._item_start = i
+                self._stack.append(c)
+            elif c in "}]":
+                if depth == 1 and self._value_start is not None:
+                    self._finish_value(i, events)  # Trailing scalar such as confidence_level
+                elif depth == 2 and self._stack[-1] == "[" and self._item_start is not None:
+                    self._finish_item(i, events)  # Trailing scalar array element
+                self._stack.pop()
+                depth -= 1
+                if depth == 0:
+                    self.done = True
+                elif depth == 1 and self._value_start is not None:
+                    self._finish_value(i + 1, events)
+                elif depth == 2 and self._stack[-1] == "[" and self._item_start is not None:
+                    self._finish_item(i + 1, events)
+            elif c == ":":
+                if depth == 1:
+                    self._expecting_key = False
+            elif c == ",":
+                if depth == 1:
+                    if self._value_start is not None:
+                        self._finish_value(i, events)
+                    self._expecting_key = True
+                elif depth == 2 and self._stack[-1] == "[" and self._item_start is not None:
+                    self._finish_item(i, events)  # Scalar array element
+            elif not c.isspace():
+                if depth == 1 and not self._expecting_key and self._value_start is None:
+                    self._value_start = i
+                elif depth == 2 and self._stack[-1] == "[" and self._item_start is None:
+                    self._item_start = i
+        return events
+
+# Labels for sections shown while a streamed diagnosis is still arriving, in display order
+STREAM_SECTION_TITLES = {
+    "patient_information": "Patient Information",
+    "IMAGE_ANALYSIS": "Image Analysis",
+    "ans_to_ques": "Answer to Question",
+    "differential_diagnosis": "Differential Diagnosis",
+    "alternative_diagnoses": "Alternative Diagnoses",
+    "follow_up_recommendations": "Follow-Up Recommendations",
+    "biases": "Biases",
+    "articles": "Articles",
+    "confidence_level": "Confidence Level",
+}
+
+# Function to render the sections of a diagnosis received so far
+def render_partial_result(placeholder, partial):
+    with placeholder.container():
+        st.caption("Generating diagnosis\u2026 sections appear as soon as they are complete.")
+        for key, title in STREAM_SECTION_TITLES.items():
+            if key not in partial:
+                continue
+            value = partial[key]
+            st.markdown(f"**{title}**")
+            if isinstance(value, dict):
+                for name, detail in value.items():
+                    st.write(f"- **{name}:** {detail}")
+            elif isinstance(value, list):
+                for entry in value:
+                    if isinstance(entry, dict) and "diagnosis" in entry:
+                        probability = entry.get("probability")
+                        st.write(f"- {entry['diagnosis']}" + (f" ({probability}%)" if probability is not None else ""))
+                    elif isinstance(entry, dict):
+                        st.write("- " + "; ".join(str(v) for v in entry.values()))
+                    else:
+                        st.write(f"- {entry}")
+            else:
+                st.write(value)
+
+# Function to call Gemini API in streaming mode, passing the sections to on_partial as they complete
+def call_gemini_stream(contents, sys_ins, on_partial, use_cache=True, model=GEMINI_MODEL):
+    config = gemini_config(sys_ins)
+    cache = get_response_cache()
+    key = response_cache_key(contents, sys_ins, model, config)
+    if use_cache:
+        cached = cache.get(key)
+        if cached is not None:
+            record_request(model, "cache_hit")
+            return cached
+    parser = IncrementalJSONParser()
+    partial = {}
+    usage = None
+    started = time.perf_counter()
+    first_chunk_at = None
+
+    def on_chunk(chunk):
+        nonlocal usage, first_chunk_at
+        if first_chunk_at is None:
+            first_chunk_at = time.perf_counter()
+            get_metrics().observe("diag_time_to_first_chunk_seconds", first_chunk_at - started, model=model)
+        usage = chunk.usage_metadata or usage  # The last chunk carries the final counts
+        events = parser.feed(chunk.text or "")
+        for event in events:
+            if event[0] == "section":
+                partial[event[1]] = event[2]
+            else:
+                _, section, index, value = event
+                items = partial.setdefault(section, [])
+                if isinstance(items, list) and index == len(items):
+                    items.append(value)
+        if events:
+            on_partial(partial)
+
+    try:
+        get_event_loop().run(
+            get_async_gemini_client().generate_content_stream(model, resolve_file_handles(contents), config, on_chunk)
+        )
+        get_metrics().observe("diag_stage_duration_seconds", time.perf_counter() - started, stage="gemini_call", model=model)
+        record_request(model, "ok", usage)
+        json_string = clean_response_text(parser.buffer)
         print("The json is:", json_string)
+        if parses_as_json(json_string):
+            cache.put(key, json_string)
         return json_string
     except Exception as e:
-        st.error(f"\u274C Error calling Gemini API: {e}")
+        record_request(model, "error")
+        notify("error", f"\u274C Error calling Gemini API: {e}")
         return None
 
-def parse_gemini_response(response_text):
-    """Parses the Gemini response, tries harder to fix, and returns None on failure."""
-    response_text = response_text.strip()  # Remove leading/trailing whitespace
-    response_text = response_text.replace("\n", "")  # Remove newlines
-    response_text = response_text.replace("\\", "") #Remove escape characters
-    response_text = response_text.replace('`', "")  # Remove backticks
-    response_text = response_text.replace("...", "")  # Remove ellipses.
+# Function to cut the JSON object out of fenced or prose-wrapped model output
+def extract_json_body(text):
+    fence = re.search(r"```(?:json)?\s*(.*?)(?:```|$)", text, re.DOTALL)
+    if fence and "{" in fence.group(1):
+        text = fence.group(1)
+    start = text.find("{")
+    if start == -1:
+        return text.strip()
+    depth = 0
+    in_string = escape = False
+    for i in range(start, len(text)):
+        c = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif c == "\\":
+                escape = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c in "{[":
+            depth += 1
+        elif c in "}]":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return text[start:]  # Truncated output; repair_json closes it
+
+# Python literals the model sometimes emits instead of JSON ones
+_PYTHON_LITERALS = {"None": "null", "True": "true", "False": "false"}
+_JSON_SCALAR = re.compile(r"-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?|true|false|null|None|True|False")
+
+# Function to fix the JSON defects Gemini commonly produces, without touching string contents
+def repair_json(text):
+    """Drops `...` placeholders and trailing commas, inserts missing commas, maps Python
+    literals, escapes raw newlines inside strings and closes truncated output (dropping
+    a key the output was cut off in or after)."""
+    out = []
+    stack = []
+    in_string = escape = False
+    after_value = False  # The last token closed a value, so a new value needs a comma first
+    expect_key = False  # Inside an object, the next string is a key
+    key_start = None  # Where in `out` the innermost object's key without a value yet begins
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif c == "\\":
+                escape = True
+            elif c == '"':
+                in_string = False
+                after_value = True
+            elif c in "\n\r\t":
+                c = {"\n": "\\n", "\r": "\\r", "\t": "\\t"}[c]
+            out.append(c)
+            i += 1
+            continue
+        if c.isspace():
+            out.append(c)
+            i += 1
+            continue
+        if text.startswith("...", i):
+            i += 3
+            continue
+        token = _JSON_SCALAR.match(text, i)
+        starts_value = token is not None or c in '"{['
+        if starts_value and after_value:
+            out.append(",")  # Two values in a row: the model forgot the comma
+            expect_key = bool(stack) and stack[-1] == "}"
+        if starts_value and expect_key and c == '"':
+            key_start = len(out)
+        elif starts_value:
+            key_start = None
+        if token is not None:
+            out.append(_PYTHON_LITERALS.get(token.group(), token.group()))
+            i = token.end()
+            after_value = True
+            continue
+        if c in "}]":
+            while out and (out[-1].isspace() or out[-1] == ","):
+                out.pop()  # Trailing comma
+            if stack:
+                stack.pop()
+            after_value = True
+            expect_key = False
+            key_start = None
+        elif c in "{[":
+            stack.append("}" if c == "{" else "]")
+            after_value = False
+            expect_key = c == "{"
+        elif c == '"':
+            in_string = True
+            expect_key = False
+        else:
+            after_value = False  # ',' or ':'
+            expect_key = c == "," and bool(stack) and stack[-1] == "}"
+        out.append(c)
+        i += 1
+    if key_start is not None:
+        del out[key_start:]  # Cut off in or after a key: there is no value to keep
+    elif in_string:
+        cut = "".join(out)
+        # A lone backslash or a cut-off \uXXXX escape would break the closing quote
+        partial_escape = re.search(r"(\\+)(u[0-9a-fA-F]{0,3})?$", cut)
+        if partial_escape and len(partial_escape.group(1)) % 2:
+            cut = cut[:partial_escape.start() + len(partial_escape.group(1)) - 1]
+        out = [cut, '"']
+    while out and (out[-1].isspace() or out[-1] in ",:"):
+        out.pop()
+    out.extend(reversed(stack))
+    repaired = "".join(out)
+    # {"text"} where an object was expected (the schema's own ans_to_ques example)
+    return re.sub(r'\{\s*("(?:[^"\\]|\\.)*")\s*\}', r'{"Answer": \1}', repaired)
+
+class _Record:
+    """Base for the compact, slot-based records a parsed diagnosis is made of."""
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+    @classmethod
+    def from_dict(cls, data):
+        data = data if isinstance(data, dict) else {}
+        return cls(**{name: data.get(name) for name in cls.__slots__})
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+class PatientInformation(_Record):
+    __slots__ = ("age", "symptoms", "relevant_details")
+
+class ImageAnalysis(_Record):
+    __slots__ = ("image_type", "image_analysis")
+
+class Diagnosis(_Record):
+    __slots__ = ("diagnosis", "probability", "reasoning", "severity", "risk_factors")
+
+class AlternativeDiagnosis(_Record):
+    __slots__ = ("diagnosis", "reasoning_against")
+
+class Bias(_Record):
+    __slots__ = ("bias", "recommendation")
+
+# Top-level keys of the schema in sys_ins: (expected JSON type, record class for list items)
+DIAGNOSIS_SCHEMA = {
+    "patient_information": (dict, PatientInformation),
+    "IMAGE_ANALYSIS": (dict, ImageAnalysis),
+    "ans_to_ques": (dict, None),
+    "differential_diagnosis": (list, Diagnosis),
+    "alternative_diagnoses": (list, AlternativeDiagnosis),
+    "follow_up_recommendations": (list, None),
+    "biases": (list, Bias),
+    "articles": (list, None),
+    "confidence_level": ((int, float), None),
+    "important_note": (str, None),
+}
+
+class DiagnosisResult:
+    """A validated diagnosis. `missing_fields` lists schema keys the model did not provide."""
+    __slots__ = ("patient_information", "image_analysis", "ans_to_ques", "differential_diagnosis",
+                 "alternative_diagnoses", "follow_up_recommendations", "biases", "articles",
+                 "confidence_level", "important_note", "missing_fields", "repaired")
+
+    @classmethod
+    def from_dict(cls, data, repaired=False):
+        result = cls()
+        result.patient_information = PatientInformation.from_dict(data.get("patient_information"))
+        result.image_analysis = ImageAnalysis.from_dict(data.get("IMAGE_ANALYSIS"))
+        result.ans_to_ques = data.get("ans_to_ques") or {}
+        result.differential_diagnosis = [Diagnosis.from_dict(d) for d in data.get("differential_diagnosis") or []]
+        result.alternative_diagnoses = [AlternativeDiagnosis.from_dict(d) for d in data.get("alternative_diagnoses") or []]
+        result.follow_up_recommendations = list(data.get("follow_up_recommendations") or [])
+        result.biases = [Bias.from_dict(b) for b in data.get("biases") or []]
+        result.articles = list(data.get("articles") or [])
+        result.confidence_level = data.get("confidence_level")
+        result.important_note = data.get("important_note")
+        result.missing_fields = [key for key in DIAGNOSIS_SCHEMA if key not in data]
+        result.repaired = repaired
+        return result
+
+    def to_dict(self):
+        """Returns the result in the JSON shape of sys_ins, as used by the UI and reports."""
+        return {
+            "patient_information": self.patient_information.to_dict(),
+            "IMAGE_ANALYSIS": self.image_analysis.to_dict(),
+            "ans_to_ques": self.ans_to_ques,
+            "differential_diagnosis": [d.to_dict() for d in self.differential_diagnosis],
+            "alternative_diagnoses": [d.to_dict() for d in self.alternative_diagnoses],
+            "follow_up_recommendations": self.follow_up_recommendations,
+            "biases": [b.to_dict() for b in self.biases],
+            "articles": self.articles,
+            "confidence_level": self.confidence_level,
+            "important_note": self.important_note,
+        }
 
-    # Add missing braces if necessary
-    if not response_text.startswith("{"):
-        response_text = "{" + response_text
-    if not response_text.endswith("}"):
-        response_text = response_text + "}"
+# Function to turn "60%" / "60" / 0.6-style values into a 0-100 number
+def coerce_percentage(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    match = re.search(r"-?\d+(?:\.\d+)?", str(value or ""))
+    if not match:
+        return None
+    number = float(match.group())
+    return int(number) if number.is_integer() else number
+
+# Function to coerce a decoded response to the schema; drops keys that cannot be salvaged
+def validate_diagnosis_data(data):
+    data = dict(data)
+    if isinstance(data.get("ans_to_ques"), str):
+        data["ans_to_ques"] = {"Answer": data["ans_to_ques"]}
+    if "confidence_level" in data:
+        data["confidence_level"] = coerce_percentage(data["confidence_level"])
+    for entry in data.get("differential_diagnosis") or []:
+        if isinstance(entry, dict):  # The UI ranks diagnoses by probability, so it must be a number
+            entry["probability"] = coerce_percentage(entry.get("probability")) or 0
+    for key, (expected_type, record_class) in DIAGNOSIS_SCHEMA.items():
+        if key not in data:
+            continue
+        value = data[key]
+        if not isinstance(value, expected_type) or isinstance(value, bool):
+            del data[key]  # Reported as missing, so it can be requested on its own
+        elif record_class is not None and expected_type is list:
+            data[key] = [item for item in value if isinstance(item, dict)]
+    return data
+
+# Function to decode the model's text into a dict, repairing it locally if needed
+def decode_response_json(response_text):
+    body = extract_json_body(response_text)
+    try:
+        return json.loads(body), False
+    except json.JSONDecodeError:
+        pass
+    try:
+        return json.loads(repair_json(body)), True
+    except json.JSONDecodeError:
+        return None, True
+
+# Function to tell whether a response decodes (after repair) to a JSON object, and so is worth caching
+def parses_as_json(response_text):
+    return isinstance(decode_response_json(response_text)[0], dict)
+
+# Function to ask the model for only the fields missing from an otherwise usable result
+def request_missing_fields(contents, sys_ins, fields, use_cache=True):
+    question = (
+        "Your previous answer for this case was missing these fields: " + ", ".join(fields) + ". "
+        "Return ONLY a JSON object containing exactly these keys, following the schema in your instructions."
+    )
+    response_text = call_gemini(list(contents) + [question], sys_ins, use_cache=use_cache)
+    if response_text is None:
+        return {}
+    data, _ = decode_response_json(response_text)
+    if not isinstance(data, dict):
+        return {}
+    data = validate_diagnosis_data(data)
+    return {key: data[key] for key in fields if key in data}
+
+def parse_gemini_response(response_text, contents=None, use_cache=True):
+    """Parses the Gemini response into a DiagnosisResult, or returns None on failure.
+
+    The JSON body is extracted from any fence or prose around it and repaired locally
+    if it does not decode. When `contents` is given, fields that are still missing are
+    requested from the model on their own instead of regenerating the whole answer.
+    """
+    if not response_text:
+        return None
+    data, repaired = decode_response_json(response_text)
+    if not isinstance(data, dict):
+        notify("error", "❌ JSON Decode Error: the model's response could not be parsed or repaired.  Check the prompt and model behavior.  Returning None.")
+        return None
+    data = validate_diagnosis_data(data)
+    missing = [key for key in DIAGNOSIS_SCHEMA if key not in data and key != "important_note"]
+    if missing and contents is not None:
+        data.update(request_missing_fields(contents, sys_ins, missing, use_cache))
+    return DiagnosisResult.from_dict(data, repaired)
+
+# Model routing settings: a fast triage model answers first and a stronger model is used only when needed
+ROUTING_ENABLED = os.environ.get("DIAG_ROUTING", "1") != "0"
+TRIAGE_MODEL = os.environ.get("DIAG_TRIAGE_MODEL", "gemini-2.0-flash-lite")
+ESCALATION_MODEL = os.environ.get("DIAG_ESCALATION_MODEL", GEMINI_MODEL)
+ROUTE_MIN_CONFIDENCE = float(os.environ.get("DIAG_ROUTE_MIN_CONFIDENCE", "70"))  # percent
+ROUTE_MIN_PROBABILITY_SPREAD = float(os.environ.get("DIAG_ROUTE_MIN_SPREAD", "20"))  # top two diagnoses, in points
+ROUTING_SPECULATIVE = os.environ.get("DIAG_ROUTING_SPECULATIVE", "0") == "1"  # Start both models, cancel the loser
+
+# Function to list why a triage result is not good enough to return (empty when it is)
+def escalation_reasons(result):
+    if result is None:
+        return ["unparseable response"]
+    reasons = []
+    missing = [key for key in result.missing_fields if key != "important_note"]
+    if missing:
+        reasons.append("missing " + ", ".join(missing))
+    confidence = coerce_percentage(result.confidence_level)
+    if confidence is None or confidence < ROUTE_MIN_CONFIDENCE:
+        reasons.append(f"confidence {confidence} < {ROUTE_MIN_CONFIDENCE:g}")
+    probabilities = sorted((d.probability or 0 for d in result.differential_diagnosis), reverse=True)
+    if probabilities:
+        spread = probabilities[0] - (probabilities[1] if len(probabilities) > 1 else 0)
+        if spread < ROUTE_MIN_PROBABILITY_SPREAD:
+            reasons.append(f"probability spread {spread:g} < {ROUTE_MIN_PROBABILITY_SPREAD:g}")
+    return reasons
+
+# Function to log the route a request took, with the thresholds it was judged against
+def record_route(route, model, reasons, elapsed):
+    metrics = get_metrics()
+    metrics.inc("diag_routes_total", route=route, model=model)
+    metrics.observe("diag_route_duration_seconds", elapsed, route=route)
+    entry = {"event": "route", "route": route, "model": model, "reasons": reasons,
+             "min_confidence": ROUTE_MIN_CONFIDENCE, "min_spread": ROUTE_MIN_PROBABILITY_SPREAD,
+             "seconds": round(elapsed, 3)}
+    print("Route:", json.dumps(entry))
+    if METRICS_JSON_LOG:
+        metrics_logger.info(json.dumps(entry))
+
+def route_diagnosis(contents, use_cache=True, on_partial=None):
+    """Diagnoses `contents`, trying the triage model first. Returns (response_text, result, route).
+
+    The triage answer is kept when it parses with every field, its confidence_level
+    and the gap between the two most probable diagnoses meet the thresholds;
+    otherwise the case is sent to the escalation model, whose missing fields are
+    repaired as usual. In speculative mode the escalation call starts alongside
+    triage and is cancelled when triage is good enough.
+    """
+    started = time.perf_counter()
+    if not ROUTING_ENABLED or TRIAGE_MODEL == ESCALATION_MODEL:
+        if on_partial is not None:
+            response_text = call_gemini_stream(contents, sys_ins, on_partial, use_cache=use_cache)
+        else:
+            response_text = call_gemini(contents, sys_ins, use_cache=use_cache)
+        with stage_span("parse"):
+            result = parse_gemini_response(response_text, contents, use_cache=use_cache)
+        return response_text, result, {"route": "direct", "model": GEMINI_MODEL, "reasons": []}
+
+    scope = CancelScope()
+    pool = ThreadPoolExecutor(max_workers=1) if ROUTING_SPECULATIVE else None
+    escalation = None
+    if pool is not None:
+        escalation = pool.submit(contextvars.copy_context().run, call_gemini, contents, sys_ins, use_cache, ESCALATION_MODEL, scope)
+    try:
+        # A failed triage is only worth showing if the escalation fails too
+        with held_notices() as triage_notices:
+            if on_partial is not None:
+                response_text = call_gemini_stream(contents, sys_ins, on_partial, use_cache=use_cache, model=TRIAGE_MODEL)
+            else:
+                response_text = call_gemini(contents, sys_ins, use_cache=use_cache, model=TRIAGE_MODEL)
+            with stage_span("parse", model=TRIAGE_MODEL):
+                result = parse_gemini_response(response_text)  # No repair call: a gap is a reason to escalate
+        reasons = escalation_reasons(result)
+        if not reasons:
+            scope.cancel()
+            record_route("triage", TRIAGE_MODEL, reasons, time.perf_counter() - started)
+            return response_text, result, {"route": "triage", "model": TRIAGE_MODEL, "reasons": reasons}
+
+        if on_partial is not None:
+            on_partial({})  # The triage sections are about to be replaced, so stop showing them
+        if escalation is not None:
+            escalated_text = escalation.result()
+        else:
+            escalated_text = call_gemini(contents, sys_ins, use_cache=use_cache, model=ESCALATION_MODEL)
+        with stage_span("parse", model=ESCALATION_MODEL):
+            escalated = parse_gemini_response(escalated_text, contents, use_cache=use_cache)
+        if escalated is None:
+            for level, message in triage_notices:
+                notify(level, message)
+        if escalated is not None or result is None:
+            record_route("escalated", ESCALATION_MODEL, reasons, time.perf_counter() - started)
+            return escalated_text, escalated, {"route": "escalated", "model": ESCALATION_MODEL, "reasons": reasons}
+        record_route("triage_fallback", TRIAGE_MODEL, reasons, time.perf_counter() - started)
+        return response_text, result, {"route": "triage_fallback", "model": TRIAGE_MODEL, "reasons": reasons}
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+# Reference article cache settings
+REFERENCE_CACHE_ENABLED = os.environ.get("DIAG_REFERENCE_CACHE", "1") != "0"
+REFERENCE_CACHE_PATH = os.path.join(".cache", "references.json")
+REFERENCE_CACHE_TTL = 30 * 24 * 60 * 60  # seconds; guideline pages change slowly
+REFERENCE_CACHE_MAX_ENTRIES = 5000
+REFERENCE_DIAGNOSES = 3  # Articles are gathered for this many of the most probable diagnoses
+REFERENCE_ARTICLES_PER_DIAGNOSIS = 4
+# With the cache on, the diagnosis call has no search tool, so asking for articles only gets invented links
+ARTICLE_SEARCH_INSTRUCTION = '12. Search the google for articles on the most likely diagnosis from websites like "Mayo Clinic", "WebMD", "AIIMS", "NIH(.gov)".'
+ARTICLE_LOOKUP_INSTRUCTION = '12. Leave "articles" as an empty list: reference articles for the diagnoses are added after your answer.'
+if REFERENCE_CACHE_ENABLED:
+    sys_ins = sys_ins.replace(ARTICLE_SEARCH_INSTRUCTION, ARTICLE_LOOKUP_INSTRUCTION)
+REFERENCE_LOOKUP_PROMPT = (
+    "Search for reference articles on each of these diagnoses, preferring Mayo Clinic, WebMD, AIIMS and NIH (.gov). "
+    "Return ONLY a JSON object mapping each diagnosis, spelled exactly as given, to a list of at most "
+    f"{REFERENCE_ARTICLES_PER_DIAGNOSIS} article URLs.\nDiagnoses: "
+)
+
+# Function to normalize a diagnosis name into a reference cache key
+def normalize_diagnosis(name):
+    name = re.sub(r"\([^)]*\)", " ", str(name).lower())  # Drop abbreviations such as "(CAP)"
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", name).split())
+
+class ReferenceCache:
+    """Reference articles per normalized diagnosis, shared by every session of the process.
+
+    An LRU bounded by entry count with a TTL, persisted to one JSON file so a
+    restart keeps what was already looked up.
+    """
 
+    def __init__(self, path=REFERENCE_CACHE_PATH, ttl=REFERENCE_CACHE_TTL, max_entries=REFERENCE_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (stored_at, articles)
+        self._lock = threading.Lock()
+        try:
+            with open(path, encoding="utf-8") as f:
+                for key, (stored_at, articles) in json.load(f).items():
+                    self._entries[key] = (stored_at, articles)
+        except (OSError, ValueError):
+            pass
+
+    def get(self, diagnosis):
+        key = normalize_diagnosis(diagnosis)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put_many(self, articles_by_diagnosis):
+        with self._lock:
+            for diagnosis, articles in articles_by_diagnosis.items():
+                key = normalize_diagnosis(diagnosis)
+                if key and articles:
+                    self._entries[key] = (time.time(), list(articles))
+                    self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            snapshot = dict(self._entries)
+            tmp_path = self.path + ".tmp"
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(snapshot, f)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                print("Could not write reference cache:", e)
+
+@shared_resource
+def get_reference_cache():
+    return ReferenceCache()
+
+# Function to collect the web sources Google Search grounding attached to a response
+def grounding_urls(response):
+    urls = []
+    for candidate in response.candidates or []:
+        metadata = candidate.grounding_metadata
+        for chunk in (metadata.grounding_chunks or []) if metadata else []:
+            if chunk.web is not None and chunk.web.uri:
+                urls.append(chunk.web.uri)
+    return list(dict.fromkeys(urls))
+
+# Function to look up articles for diagnoses missing from the reference cache, with Google Search
+def lookup_articles(diagnoses):
+    config = genai_types.GenerateContentConfig(temperature=0, tools=[get_google_search_tool()])
     try:
-        json_data = json.loads(response_text)
+        with stage_span("reference_lookup", model=GEMINI_MODEL):
+            response = get_event_loop().run(get_async_gemini_client().generate_content(
+                GEMINI_MODEL, [REFERENCE_LOOKUP_PROMPT + json.dumps(diagnoses)], config))
+        record_request(GEMINI_MODEL, "ok", response.usage_metadata)
+    except Exception as e:
+        record_request(GEMINI_MODEL, "error")
+        print("Reference lookup failed:", e)
+        return {}
+    data, _ = decode_response_json(clean_response_text(response.text or ""))
+    found = {}
+    by_key = {normalize_diagnosis(name): urls for name, urls in data.items()} if isinstance(data, dict) else {}
+    for diagnosis in diagnoses:
+        urls = by_key.get(normalize_diagnosis(diagnosis))
+        if isinstance(urls, list) and urls:
+            found[diagnosis] = [str(url) for url in urls[:REFERENCE_ARTICLES_PER_DIAGNOSIS]]
+    if not found and len(diagnoses) == 1:
+        # No usable JSON; the grounding sources are still the pages the search found
+        found = {diagnoses[0]: grounding_urls(response)[:REFERENCE_ARTICLES_PER_DIAGNOSIS]}
+    get_reference_cache().put_many(found)
+    return found
+
+# Function to fill a diagnosis' articles from the reference cache, searching only for diagnoses it lacks
+def attach_references(json_data):
+    """Articles the model wrote itself are dropped: without the search tool they aren't real lookups."""
+    if not REFERENCE_CACHE_ENABLED or not json_data:
         return json_data
-    except json.JSONDecodeError as e:
-        st.error(f"❌ JSON Decode Error: {e}.  Completely invalid JSON response.  Check the prompt and model behavior.  Returning None.")
+    ranked = sorted(json_data.get("differential_diagnosis") or [], key=lambda e: e.get("probability") or 0, reverse=True)
+    diagnoses = [str(entry["diagnosis"]) for entry in ranked[:REFERENCE_DIAGNOSES] if entry.get("diagnosis")]
+    if not diagnoses:
+        return dict(json_data, articles=[])
+    cache = get_reference_cache()
+    cached = {diagnosis: cache.get(diagnosis) for diagnosis in diagnoses}
+    missing = [diagnosis for diagnosis, articles in cached.items() if articles is None]
+    if missing:
+        cached.update(lookup_articles(missing))
+    articles = [url for diagnosis in diagnoses for url in cached.get(diagnosis) or []]
+    return dict(json_data, articles=list(dict.fromkeys(articles)))
+
+# Token budget settings
+REQUEST_TOKEN_BUDGET = int(os.environ.get("DIAG_TOKEN_BUDGET", "50000"))  # prompt tokens per model call
+CHARS_PER_TOKEN = 4
+IMAGE_TILE_SIZE = 768  # Gemini bills images as 768x768 tiles...
+TOKENS_PER_IMAGE_TILE = 258  # ...of 258 tokens each; images up to 384px are a single tile
+SMALL_IMAGE_DIM = 384
+# Resolutions the planner steps down through before dropping pages or splitting the request
+PLANNER_IMAGE_DIMS = (MODEL_MAX_IMAGE_DIM, 1536, 768)
+# Over budget, PDF pages with less ink than this fraction of their pixels (at full resolution) may be
+# dropped, emptiest first; a page with a single line of results is kept unless nothing else fits
+LOW_VALUE_PAGE_MAX_INK = 0.001
+
+# Function to estimate the tokens of a text
+def estimate_text_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+# Function to estimate the tokens of an image once it is fit inside max_dim
+def estimate_image_tokens(width, height, max_dim=MODEL_MAX_IMAGE_DIM):
+    scale = min(1.0, max_dim / max(width, height))
+    width, height = width * scale, height * scale
+    if width <= SMALL_IMAGE_DIM and height <= SMALL_IMAGE_DIM:
+        return TOKENS_PER_IMAGE_TILE
+    return math.ceil(width / IMAGE_TILE_SIZE) * math.ceil(height / IMAGE_TILE_SIZE) * TOKENS_PER_IMAGE_TILE
+
+# Function to estimate the prompt tokens of request contents (text and inline images)
+def estimate_contents_tokens(contents, sys_ins=""):
+    tokens = estimate_text_tokens(sys_ins)
+    for item in contents:
+        if isinstance(item, str):
+            tokens += estimate_text_tokens(item)
+        elif item.inline_data is not None and item.inline_data.mime_type.startswith("image/"):
+            with Image.open(io.BytesIO(item.inline_data.data)) as image:  # Reads the header only
+                tokens += estimate_image_tokens(*image.size)
+        elif item.text:
+            tokens += estimate_text_tokens(item.text)
+        else:
+            tokens += TOKENS_PER_IMAGE_TILE
+    return tokens
+
+class TokenCalibration:
+    """Running ratio of the prompt tokens the API reports to the local estimate."""
+
+    def __init__(self, smoothing=0.2):
+        self.ratio = 1.0
+        self.samples = 0
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+
+    def update(self, estimated, actual):
+        if not estimated or not actual:
+            return
+        with self._lock:
+            observed = min(2.0, max(0.5, actual / estimated))
+            self.ratio = observed if self.samples == 0 else self.ratio + self.smoothing * (observed - self.ratio)
+            self.samples += 1
+
+    def apply(self, tokens):
+        return int(tokens * self.ratio)
+
+@shared_resource
+def get_token_calibration():
+    return TokenCalibration()
+
+# Function to score how much information a page carries (0 for a blank page)
+# Duplicate and blank page settings
+PHASH_SIZE = 32  # Pages are compared as 32x32 grayscale...
+PHASH_BITS = 8  # ...through the 8x8 lowest frequencies of their DCT (a 64-bit hash)
+DUPLICATE_MAX_DISTANCE = 6  # Hashes at most this many bits apart are candidate near duplicates...
+# ...shown for confirmation if no 8x8 block of the 512x512 grayscale pages differs by more than this on average.
+# The grid can't see a changed value in a line of text, so near duplicates are never removed automatically.
+DUPLICATE_COMPARE_SIZE = 512
+DUPLICATE_BLOCK = 8
+DUPLICATE_MAX_BLOCK_DIFF = 12.0
+INK_CONTRAST = 48  # Gray levels a pixel must differ from the page background by to count as ink
+BLANK_PAGE_MAX_INK = 0.00001  # Pages with less ink than this fraction of their pixels are blank
+
+# Function to measure the fraction of a page's pixels that carry ink, at native resolution
+def ink_fraction(image):
+    gray = np.asarray(image.convert("L"), dtype=np.int16)
+    background = int(np.median(gray[::8, ::8]))
+    return float(np.count_nonzero(np.abs(gray - background) > INK_CONTRAST)) / gray.size
+
+# Function to compute the 64-bit perceptual (DCT) hash of an image
+def perceptual_hash(image):
+    gray = np.asarray(image.convert("L"), dtype=np.float32)
+    small = cv2.resize(gray, (PHASH_SIZE, PHASH_SIZE), interpolation=cv2.INTER_AREA)
+    low = cv2.dct(small)[:PHASH_BITS, :PHASH_BITS].flatten()
+    bits = low > np.median(low[1:])  # The DC term only tracks brightness, so it doesn't set the threshold
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+# Function to shrink an image to the grayscale grid near duplicates are compared on
+def duplicate_grid(image):
+    gray = np.asarray(image.convert("L"))
+    return cv2.resize(gray, (DUPLICATE_COMPARE_SIZE, DUPLICATE_COMPARE_SIZE), interpolation=cv2.INTER_AREA)
+
+# Function to get the largest mean absolute difference of any block of two duplicate grids
+def max_block_difference(grid_a, grid_b):
+    blocks = DUPLICATE_COMPARE_SIZE // DUPLICATE_BLOCK
+    difference = np.abs(grid_a.astype(np.float32) - grid_b.astype(np.float32))
+    return float(difference.reshape(blocks, DUPLICATE_BLOCK, blocks, DUPLICATE_BLOCK).mean(axis=(1, 3)).max())
+
+class PageFingerprint:
+    """What deduplication and planning need to know about one page.
+
+    `digest` identifies the exact pixels (or text layer); `ink`, `phash` and `aspect`
+    are None for text pages. The comparison grid is built only when needed.
+    """
+    __slots__ = ("digest", "ink", "phash", "aspect", "grid")
+
+    def __init__(self, image, image_part):
+        self.grid = None
+        if is_text_part(image_part):
+            body = image_part.text.split("\n", 1)[-1]  # Without the "[PDF page N of M]" header
+            self.digest = hashlib.sha256(b"text\0" + body.encode("utf-8")).hexdigest()
+            self.ink = self.phash = self.aspect = None
+            return
+        pixels = hashlib.sha256(f"{image.mode}:{image.size}\0".encode())
+        pixels.update(image.tobytes())
+        self.digest = pixels.hexdigest()
+        self.ink = ink_fraction(image)
+        self.phash = perceptual_hash(image)
+        self.aspect = image.width / image.height
+
+    def comparison_grid(self, image):
+        if self.grid is None:
+            self.grid = duplicate_grid(image)
+        return self.grid
+
+# Function to get the fingerprint of an (image, part, label, thumbnail[, page key]) entry
+def page_fingerprint(img):
+    """Uploaded pages carry a page key, so their fingerprint is computed once, not on every rerun."""
+    key = f"{img[4]}:fingerprint" if len(img) > 4 else None
+    fingerprint = get_upload_cache().get(key) if key else None
+    if fingerprint is None:
+        fingerprint = PageFingerprint(*img[:2])
+        if key:
+            get_upload_cache().put(key, fingerprint, 1024 + DUPLICATE_COMPARE_SIZE ** 2)
+    return fingerprint
+
+# Function to tell whether two image pages look like copies of each other
+def near_duplicate(img, fingerprint, other_img, other):
+    if bin(fingerprint.phash ^ other.phash).count("1") > DUPLICATE_MAX_DISTANCE or abs(fingerprint.aspect - other.aspect) >= 0.02:
+        return False
+    difference = max_block_difference(fingerprint.comparison_grid(img[0]), other.comparison_grid(other_img[0]))
+    return difference <= DUPLICATE_MAX_BLOCK_DIFF
+
+# Function to drop blank pages and identical images from a request and find near duplicates
+def deduplicate_images(images, leave_out=()):
+    """Returns (kept images, descriptions of removed pages, near duplicates).
+
+    Only blank pages and pages identical to an earlier one (same pixels, or the same
+    text layer) are removed on their own; the first copy is kept. Near duplicates
+    are reported as (image number, earlier image number, page id) for the user to
+    confirm, and removed only if their page id is in `leave_out`.
+    """
+    kept, removed, similar = [], [], []
+    seen = {}  # digest -> number of the first image with it
+    compared = []  # (number, image, fingerprint) of kept image pages
+    with stage_span("deduplicate"):
+        for number, img in enumerate(images, 1):
+            fingerprint = page_fingerprint(img)
+            if fingerprint.ink is not None and fingerprint.ink < BLANK_PAGE_MAX_INK:
+                removed.append(f"Image {number}: blank page")
+                continue
+            if fingerprint.digest in seen:
+                removed.append(f"Image {number}: identical to image {seen[fingerprint.digest]}")
+                continue
+            seen[fingerprint.digest] = number
+            if fingerprint.phash is not None:
+                original = next((kept_number for kept_number, kept_img, kept_fingerprint in compared
+                                 if near_duplicate(img, fingerprint, kept_img, kept_fingerprint)), None)
+                if original is not None:
+                    page_id = fingerprint.digest[:16]
+                    similar.append((number, original, page_id))
+                    if page_id in leave_out:
+                        removed.append(f"Image {number}: left out as a duplicate of image {original}")
+                        continue
+                compared.append((number, img, fingerprint))
+            kept.append(img)
+    return kept, removed, similar
+
+class TokenPlan:
+    """How a request is fitted into the token budget: resolution, dropped pages and call groups."""
+    __slots__ = ("max_dim", "dropped", "groups", "group_tokens", "steps", "budget", "numbers")
+
+    def dropped_pages(self):
+        return ", ".join(f"image {self.numbers[index]}" for index in sorted(self.dropped))
+
+    def describe(self):
+        lines = list(self.steps)
+        for number, (group, tokens) in enumerate(zip(self.groups, self.group_tokens), 1):
+            lines.append(f"Call {number}: {len(group)} image(s), about {tokens:,} prompt tokens")
+        return lines
+
+def plan_request(prompt, images, budget=REQUEST_TOKEN_BUDGET, numbers=None):
+    """Fits a request into `budget` prompt tokens per call.
+
+    In order of preference: send everything as is, downscale all images,
+    drop nearly empty PDF pages (least ink first, only while still over budget),
+    then split the images over several calls whose results are merged. `numbers`
+    gives the image numbers the user sees, when they differ from the positions.
+    """
+    calibration = get_token_calibration()
+    text_tokens = calibration.apply(estimate_text_tokens(sys_ins) + estimate_text_tokens(prompt))
+    plan = TokenPlan()
+    plan.budget = budget
+    plan.numbers = numbers or list(range(1, len(images) + 1))
+    plan.dropped = []
+    plan.steps = []
+
+    def image_tokens(index, max_dim):
+        if is_text_part(images[index][1]):
+            return calibration.apply(estimate_text_tokens(images[index][1].text))
+        return calibration.apply(estimate_image_tokens(*images[index][0].size, max_dim))
+
+    kept = list(range(len(images)))
+    original = text_tokens + sum(image_tokens(i, MODEL_MAX_IMAGE_DIM) for i in kept)
+    plan.steps.append(f"Estimated {original:,} prompt tokens for {len(images)} image(s); budget {budget:,} per call")
+
+    for max_dim in PLANNER_IMAGE_DIMS:
+        plan.max_dim = max_dim
+        total = text_tokens + sum(image_tokens(i, max_dim) for i in kept)
+        if total <= budget:
+            break
+    if plan.max_dim != MODEL_MAX_IMAGE_DIM:
+        plan.steps.append(f"Downscaled images to at most {plan.max_dim}px ({total:,} tokens)")
+
+    if total > budget:
+        candidates = [i for i in kept if images[i][2] == "pdf page" and not is_text_part(images[i][1])]
+        ink = {i: page_fingerprint(images[i]).ink for i in candidates}
+        for index in sorted(candidates, key=ink.get):
+            if total <= budget or ink[index] >= LOW_VALUE_PAGE_MAX_INK:
+                break
+            kept.remove(index)
+            plan.dropped.append(index)
+            total -= image_tokens(index, plan.max_dim)
+        if plan.dropped:
+            plan.steps.append(f"Dropped {len(plan.dropped)} nearly empty page(s) to fit the budget: {plan.dropped_pages()}")
+
+    plan.groups = [[]]
+    plan.group_tokens = [text_tokens]
+    for index in kept:
+        tokens = image_tokens(index, plan.max_dim)
+        if plan.groups[-1] and plan.group_tokens[-1] + tokens > budget:
+            plan.groups.append([])
+            plan.group_tokens.append(text_tokens)
+        plan.groups[-1].append(index)
+        plan.group_tokens[-1] += tokens
+    if len(plan.groups) > 1:
+        plan.steps.append(f"Split into {len(plan.groups)} calls; their results are merged")
+    return plan
+
+# Function to merge the diagnoses of a request that was split over several calls
+def merge_results(results):
+    results = [result for result in results if result]
+    if not results:
         return None
+    merged = dict(results[0])
+    by_name = {}
+    for result in results:
+        for entry in result.get("differential_diagnosis", []):
+            name = str(entry.get("diagnosis", "")).strip().lower()
+            if name not in by_name or entry.get("probability", 0) > by_name[name].get("probability", 0):
+                by_name[name] = entry
+    merged["differential_diagnosis"] = sorted(by_name.values(), key=lambda e: e.get("probability", 0), reverse=True)
+    for key, identity in (("alternative_diagnoses", "diagnosis"), ("biases", "bias")):
+        seen = {}
+        for result in results:
+            for entry in result.get(key, []):
+                seen.setdefault(str(entry.get(identity, "")).strip().lower(), entry)
+        merged[key] = list(seen.values())
+    for key in ("follow_up_recommendations", "articles"):
+        merged[key] = list(dict.fromkeys(item for result in results for item in result.get(key, [])))
+    analyses = [r.get("IMAGE_ANALYSIS", {}).get("image_analysis") for r in results]
+    merged["IMAGE_ANALYSIS"] = dict(merged.get("IMAGE_ANALYSIS", {}),
+                                    image_analysis=" ".join(a for a in analyses if a))
+    confidences = [r["confidence_level"] for r in results if isinstance(r.get("confidence_level"), (int, float))]
+    merged["confidence_level"] = min(confidences) if confidences else None  # Be as cautious as the least sure call
+    return merged
+
+# Function to run a planned request and return the (merged) diagnosis dict
+def run_plan(prompt, images, plan, use_cache=True, on_partial=None, on_progress=None, on_route=None):
+    def contents_for(group):
+        parts = []
+        for index in group:
+            image, image_part = images[index][:2]
+            if plan.max_dim < MODEL_MAX_IMAGE_DIM and max(image.size) > plan.max_dim and not is_text_part(image_part):
+                image_part = image_to_part(image, plan.max_dim)
+            parts.append((image, image_part))
+        return [prompt] + [part for _, part in enforce_byte_budget(parts)]
+
+    def run_group(group, on_partial=None):
+        contents = contents_for(group)
+        _, result, route = route_diagnosis(contents, use_cache, on_partial)  # Raw JSON from the routed model, parsed
+        if on_route is not None:
+            on_route(route)
+        return result.to_dict() if result else None
+
+    if len(plan.groups) == 1:
+        return attach_references(run_group(plan.groups[0], on_partial))
+    with ThreadPoolExecutor(max_workers=len(plan.groups)) as pool:
+        futures = [pool.submit(contextvars.copy_context().run, run_group, group) for group in plan.groups]
+        for done, _ in enumerate(as_completed(futures), 1):
+            if on_progress is not None:
+                on_progress(done, len(futures))
+        return attach_references(merge_results([future.result() for future in futures]))
+
+# Follow-up chat settings
+FOLLOWUP_CACHE_TTL = 30 * 60  # seconds the case context stays cached; extended on every question
+CONTEXT_CACHE_MIN_TOKENS = 4096  # Gemini won't cache less; smaller contexts are cheap to send inline
+FOLLOWUP_INSTRUCTION = ("This is a follow-up question from the doctor about the case above. Answer it directly "
+                        "in plain prose, not JSON, using the patient details, the attachments and your diagnosis.")
+
+class FollowUpChat:
+    """Follow-up conversation about one diagnosed case.
+
+    The case context (system instruction, patient details, attachments and the
+    diagnosis) is stored once with the model's context caching, so each question
+    sends only the conversation text. Contexts below the caching minimum, or when
+    caching fails, are sent inline instead.
+    """
+
+    def __init__(self, prompt, parts, diagnosis_text):
+        self.context_tokens = estimate_contents_tokens([prompt, *parts], sys_ins)
+        self.context = [
+            genai_types.Content(role="user", parts=[genai_types.Part(text=prompt), *parts]),
+            genai_types.Content(role="model", parts=[genai_types.Part(text=diagnosis_text)]),
+        ]
+        self.history = []  # (role, text) turns after the diagnosis
+        self.cache_name = None
+        self.cache_expires = 0.0
+        self.inline = self.context_tokens < CONTEXT_CACHE_MIN_TOKENS
+
+    def _resolved_context(self):
+        return [genai_types.Content(role=turn.role, parts=resolve_file_handles(turn.parts)) for turn in self.context]
+
+    def _ensure_cache(self):
+        client = get_client()
+        if self.cache_name and time.time() < self.cache_expires - 60:
+            try:
+                client.caches.update(name=self.cache_name,
+                                     config=genai_types.UpdateCachedContentConfig(ttl=f"{FOLLOWUP_CACHE_TTL}s"))
+                self.cache_expires = time.time() + FOLLOWUP_CACHE_TTL
+                return
+            except Exception as e:
+                print("Cached case context is gone, caching it again:", e)
+        try:
+            with stage_span("context_cache_create", model=GEMINI_MODEL):
+                cached = client.caches.create(model=GEMINI_MODEL, config=genai_types.CreateCachedContentConfig(
+                    contents=self._resolved_context(),
+                    system_instruction=sys_ins,
+                    ttl=f"{FOLLOWUP_CACHE_TTL}s",
+                    display_name="diagnosis case",
+                ))
+            self.cache_name = cached.name
+            self.cache_expires = time.time() + FOLLOWUP_CACHE_TTL
+        except Exception as e:
+            print("Context caching unavailable, sending the case inline:", e)
+            self.cache_name = None
+            self.inline = True
+
+    def ask(self, question):
+        """Returns the model's answer to `question` and adds both to the history."""
+        turns = [genai_types.Content(role=role, parts=[genai_types.Part(text=text)]) for role, text in self.history]
+        turns.append(genai_types.Content(role="user", parts=[genai_types.Part(text=f"{FOLLOWUP_INSTRUCTION}\n\n{question}")]))
+        for attempt in range(2):
+            if not self.inline:
+                self._ensure_cache()
+            if self.cache_name:
+                contents, config = turns, genai_types.GenerateContentConfig(cached_content=self.cache_name, temperature=1)
+            else:
+                contents = self._resolved_context() + turns
+                config = genai_types.GenerateContentConfig(system_instruction=sys_ins, temperature=1)
+            try:
+                with stage_span("followup_call", model=GEMINI_MODEL):
+                    response = get_event_loop().run(get_async_gemini_client().generate_content(GEMINI_MODEL, contents, config))
+                break
+            except genai_errors.APIError as e:
+                if self.cache_name and e.code in (403, 404) and attempt == 0:
+                    self.cache_name = None  # The cache expired between the TTL refresh and the call
+                    continue
+                record_request(GEMINI_MODEL, "error")
+                raise
+            except Exception:
+                record_request(GEMINI_MODEL, "error")
+                raise
+        record_request(GEMINI_MODEL, "ok", response.usage_metadata)
+        self.history += [("user", question), ("model", response.text)]
+        return response.text
+
+    def close(self):
+        """Drops the cached context early instead of waiting for its TTL."""
+        if self.cache_name:
+            try:
+                get_client().caches.delete(name=self.cache_name)
+            except Exception as e:
+                print("Could not delete cached case context:", e)
+            self.cache_name = None
+
+# Job: answer one follow-up question
+def followup_job(job, chat, question):
+    job.update(0.1, "Waiting for the answer")
+    return chat.ask(question)
+
+# Function to show the follow-up chat for the diagnosed case
+def followup_panel(jobs, session_id):
+    chat = st.session_state.get("followup_chat")
+    if chat is None:
+        return
+    st.subheader("Follow-Up Questions")
+    for role, text in chat.history:
+        with st.chat_message("user" if role == "user" else "assistant"):
+            st.write(text)
+    job = jobs.get(session_id, "followup")
+    if job is not None and not job.done:
+        with st.chat_message("user"):
+            st.write(st.session_state.get("followup_question", ""))
+        st.progress(job.progress, text=job.message)
+    elif job is not None:
+        jobs.pop(session_id, "followup")
+        show_job_messages(job)
+        if job.error:
+            st.error(f"\u274C Error calling Gemini API: {job.error}")
+    with st.form("followup_form", clear_on_submit=True):
+        question = st.text_input("Ask a follow-up question about this case")
+        if st.form_submit_button("Ask") and question.strip() and (job is None or job.done):
+            st.session_state.followup_question = question.strip()
+            jobs.submit(session_id, "followup", followup_job, chat, question.strip())
+            st.rerun()
 
 # Function to display results
 def adjust_layout():
@@ -235,17 +2863,79 @@ def adjust_layout():
         unsafe_allow_html=True,
     )
 
-from pdf2image import convert_from_path
-import io
+# PDF rasterization settings
+PDF_DPI = 150
+PDF_THREAD_COUNT = max(1, min(4, os.cpu_count() or 1))
+PDF_PAGES_PER_THREAD = 2
+PDF_PREVIEW_MAX_SIZE = (1600, 1600)
 
-def pdf_to_images(pdf_path):
-    """Converts a PDF to a list of PIL Images."""
+def pdf_to_images(pdf_path, dpi=PDF_DPI, first_page=None, last_page=None, thread_count=PDF_THREAD_COUNT):
+    """Yields the pages of a PDF as PIL Images, one at a time.
+
+    Poppler rasterizes a small batch of pages in parallel into a temporary folder;
+    each page is loaded only when the caller asks for it and its file is deleted
+    straight away, so memory stays flat however long the document is. Poppler
+    failures are raised: this runs in worker processes, which have no page to show them on.
+    """
     try:
-        images = convert_from_path(pdf_path)
-        return images
+        page_count = pdf2image.pdfinfo_from_path(pdf_path)["Pages"]
     except Exception as e:
-        st.error(f"Error converting PDF to images: {e}. Is Ghostscript installed?")
-        return []
+        raise RuntimeError(f"Error converting PDF to images: {e}. Is Poppler installed?") from e
+    first_page = max(1, first_page or 1)
+    last_page = min(page_count, last_page or page_count)
+    batch_size = thread_count * PDF_PAGES_PER_THREAD
+
+    with tempfile.TemporaryDirectory(prefix="pdf_pages_") as output_folder:
+        for batch_start in range(first_page, last_page + 1, batch_size):
+            batch_end = min(batch_start + batch_size - 1, last_page)
+            try:
+                with stage_span("pdf_rasterize"):
+                    page_paths = pdf2image.convert_from_path(
+                        pdf_path,
+                        dpi=dpi,
+                        first_page=batch_start,
+                        last_page=batch_end,
+                        thread_count=thread_count,
+                        output_folder=output_folder,
+                        fmt="ppm",  # Uncompressed, so poppler and PIL spend no time on codecs
+                        paths_only=True,
+                    )
+            except Exception as e:
+                raise RuntimeError(f"Error converting PDF to images: {e}. Is Poppler installed?") from e
+            for page_path in page_paths:
+                page = Image.open(page_path)
+                page.load()
+                os.remove(page_path)
+                yield page
+
+# Function to show uploads as a paginated thumbnail grid, opening one image at full resolution on demand
+def display_image_grid(images):
+    if not images:
+        st.write("No images uploaded.")
+        return
+    page_count = (len(images) + THUMBNAILS_PER_PAGE - 1) // THUMBNAILS_PER_PAGE
+    page = 1
+    if page_count > 1:
+        page = st.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, value=1, key="thumbnail_page")
+    start = (page - 1) * THUMBNAILS_PER_PAGE
+    columns = st.columns(THUMBNAIL_COLUMNS)
+    for offset, img_data in enumerate(images[start:start + THUMBNAILS_PER_PAGE]):
+        index = start + offset
+        with columns[offset % THUMBNAIL_COLUMNS]:
+            st.image(img_data[3], caption=f"Image {index + 1}", use_column_width=True)
+            if st.button("Open", key=f"open_image_{index}"):
+                st.session_state.open_image = index
+
+    # Only the image the user opened is sent at full resolution
+    open_index = st.session_state.get("open_image")
+    if open_index is not None and open_index < len(images):
+        if is_text_part(images[open_index][1]):
+            st.text(images[open_index][1].text)  # Sent as text, so show what the model read
+        else:
+            st.image(images[open_index][0], caption=f"Image {open_index + 1}", use_column_width=True)
+        if st.button("Close image", key="close_image"):
+            st.session_state.open_image = None
+            st.rerun()
 
 def display_results(json_data, images):
     if not json_data:
@@ -307,8 +2997,7 @@ def display_results(json_data, images):
 
     with tab5:
         st.header("Image and Analysis")
-        for img_data in images:
-            st.image(img_data[0], caption="Uploaded Image", use_container_width=True) #Show all images
+        display_image_grid(images)
 
         st.subheader("Image Analysis")
         st.write(f"**Image Type:** {json_data.get('IMAGE_ANALYSIS', {}).get('image_type', 'N/A')}")
@@ -341,6 +3030,366 @@ def display_results(json_data, images):
         st.header("Confidence Level")
         st.write(f"**Confidence Level:** {json_data.get('confidence_level', 'N/A')}%")
 
+# Precompiled report template; every $field is HTML-escaped before substitution
+REPORT_TEMPLATE = string.Template("""
+<!DOCTYPE html>
+<html>
+<head>
+<style>
+body { font-family: sans-serif;
+        padding-top: 30px;  } /* add padding to push content down */
+h1 { text-align: center; }
+h2 { color: #333; }
+p { line-height: 1.6; }
+.section { margin-bottom: 20px; }
+.contact-details { margin-top: 30px; text-align: center; }
+.date-time { 
+    text-align: right; 
+    font-style: italic; 
+    position: absolute;
+    top: 5px;
+    right: 5px;
+    margin-top: -5px; /* pull the date-time up into the corner */
+}
+</style>
+</head>
+<body>
+<div class="date-time">$date_time</div>
+<h1>Medical Diagnosis Assistant Report</h1>
+
+<div class="section">
+    <h2>Patient Information</h2>
+    <p><strong>Patient Name:</strong> $patient_name</p>
+    <p><strong>Age:</strong> $age</p>
+    <p><strong>Symptoms:</strong> $symptoms</p>
+</div>
+
+<div class="section">
+    <h2>Primary Diagnosis</h2>
+    $primary_diagnosis
+</div>
+
+<div class="section">
+    <h2>Image Analysis</h2>
+    <p><strong>Image Type:</strong> $image_type</p>
+    <p><strong>Analysis:</strong> $image_analysis</p>
+</div>
+
+<div class="section">
+    <h2>Doctor's Notes</h2>
+    <p>$doctor_notes</p>
+</div>
+
+<div class="section">
+    <h2>Doctor's Signature</h2>
+    <p>$doctor_signature</p>
+</div>
+
+ <div class="section">
+    <h2>Articles</h2>
+    <ul>
+        $articles
+    </ul>
+</div>
+
+<div class="contact-details">
+    <p>Contact Us: medassistant@example.com | 1-800-MED-AI-DOC</p>
+</div>
+</body>
+</html>
+""")
+
+PRIMARY_DIAGNOSIS_TEMPLATE = string.Template("""
+<p><strong>Diagnosis:</strong> $diagnosis</p>
+<p><strong>Reasoning:</strong> $reasoning</p>
+<p><strong>Severity:</strong> $severity</p>
+<p><strong>Risk Factors:</strong> $risk_factors</p>
+""")
+
+REPORT_CACHE_MAX_BYTES = 128 * 1024 * 1024
+REPORT_RENDER_WORKERS = 2  # concurrent wkhtmltopdf processes per node
+
+# Function to escape a value for the report
+def report_text(value):
+    return html.escape(str(value if value is not None else "N/A"))
+
+# Function to fill the report template
+def build_report_html(json_data, patient_name, doctor_notes, doctor_signature, date_time):
+    differential_diagnosis = json_data.get('differential_diagnosis', [])
+    if differential_diagnosis and differential_diagnosis[0]:
+        primary = differential_diagnosis[0]
+        primary_diagnosis = PRIMARY_DIAGNOSIS_TEMPLATE.substitute(
+            {field: report_text(primary.get(field, 'N/A')) for field in ("diagnosis", "reasoning", "severity", "risk_factors")}
+        )
+    else:
+        primary_diagnosis = "<p>No diagnosis found.</p>"
+    patient_information = json_data.get('patient_information', {})
+    image_analysis = json_data.get('IMAGE_ANALYSIS', {})
+    return REPORT_TEMPLATE.substitute(
+        date_time=report_text(date_time),
+        patient_name=report_text(patient_name or "Not Specified"),
+        age=report_text(patient_information.get('age', 'N/A')),
+        symptoms=report_text(patient_information.get('symptoms', 'N/A')),
+        primary_diagnosis=primary_diagnosis,
+        image_type=report_text(image_analysis.get('image_type', 'N/A')),
+        image_analysis=report_text(image_analysis.get('image_analysis', 'N/A')),
+        doctor_notes=report_text(doctor_notes),
+        doctor_signature=report_text(doctor_signature),
+        articles="".join(f"<li>{report_text(article)}</li>" for article in json_data.get('articles', [])),
+    )
+
+# Function to hash everything that appears in a report except its timestamp
+def report_cache_key(json_data, patient_name, doctor_notes, doctor_signature):
+    payload = json.dumps([json_data, patient_name, doctor_notes, doctor_signature], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class ReportRenderer:
+    """Renders reports on a small worker pool, caching PDFs and merging identical in-flight renders."""
+
+    def __init__(self, workers=REPORT_RENDER_WORKERS, max_bytes=REPORT_CACHE_MAX_BYTES):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="report")
+        self._cache = UploadCache(max_bytes)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def _render(self, key, report_html):
+        try:
+            with stage_span("report_render"):
+                pdf_report = pdfkit.from_string(report_html, False)
+            self._cache.put(key, pdf_report, len(pdf_report))
+            return pdf_report
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def render(self, json_data, patient_name, doctor_notes, doctor_signature):
+        key = report_cache_key(json_data, patient_name, doctor_notes, doctor_signature)
+        with self._lock:
+            pdf_report = self._cache.get(key)
+            if pdf_report is not None:
+                return pdf_report
+            future = self._in_flight.get(key)
+            if future is None:
+                date_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                report_html = build_report_html(json_data, patient_name, doctor_notes, doctor_signature, date_time)
+                future = self._pool.submit(self._render, key, report_html)
+                self._in_flight[key] = future
+        return future.result()
+
+@shared_resource
+def get_report_renderer():
+    return ReportRenderer()
+
+# Job: render the PDF report (identical reports are rendered once) and store it with the saved case
+def render_report_job(job, json_data, patient_name, doctor_notes, doctor_signature, case_id):
+    job.update(0.1, "Rendering")
+    pdf_report = get_report_renderer().render(json_data, patient_name, doctor_notes, doctor_signature)
+    if case_id is not None:
+        get_case_store().update_case(case_id, patient_name, doctor_notes, doctor_signature, pdf_report)
+    return pdf_report
+
+# Case history settings
+CASE_DB_PATH = os.environ.get("DIAG_CASE_DB", os.path.join(".cache", "cases.sqlite3"))
+CASE_HISTORY_LIMIT = 20  # cases listed in the sidebar
+
+CASE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cases (
+    id INTEGER PRIMARY KEY,
+    created_at TEXT NOT NULL,
+    case_date TEXT NOT NULL,
+    patient_name TEXT NOT NULL DEFAULT '',
+    primary_diagnosis TEXT NOT NULL DEFAULT '',
+    input_hash TEXT NOT NULL,
+    model TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    result_json TEXT NOT NULL,
+    reasoning TEXT NOT NULL DEFAULT '',
+    doctor_notes TEXT NOT NULL DEFAULT '',
+    doctor_signature TEXT NOT NULL DEFAULT '',
+    timings_json TEXT NOT NULL DEFAULT '{}',
+    report_pdf BLOB
+);
+CREATE INDEX IF NOT EXISTS cases_patient_name ON cases (patient_name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS cases_case_date ON cases (case_date);
+CREATE INDEX IF NOT EXISTS cases_primary_diagnosis ON cases (primary_diagnosis COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS cases_input_hash ON cases (input_hash);
+"""
+
+# Full-text index over the model's reasoning and the doctor's notes, kept in sync by triggers
+CASE_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS cases_fts USING fts5(
+    reasoning, doctor_notes, content='cases', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS cases_fts_insert AFTER INSERT ON cases BEGIN
+    INSERT INTO cases_fts (rowid, reasoning, doctor_notes) VALUES (new.id, new.reasoning, new.doctor_notes);
+END;
+CREATE TRIGGER IF NOT EXISTS cases_fts_delete AFTER DELETE ON cases BEGIN
+    INSERT INTO cases_fts (cases_fts, rowid, reasoning, doctor_notes) VALUES ('delete', old.id, old.reasoning, old.doctor_notes);
+END;
+CREATE TRIGGER IF NOT EXISTS cases_fts_update AFTER UPDATE OF reasoning, doctor_notes ON cases BEGIN
+    INSERT INTO cases_fts (cases_fts, rowid, reasoning, doctor_notes) VALUES ('delete', old.id, old.reasoning, old.doctor_notes);
+    INSERT INTO cases_fts (rowid, reasoning, doctor_notes) VALUES (new.id, new.reasoning, new.doctor_notes);
+END;
+"""
+
+# Function to hash the inputs of a diagnosis: the prompt and every part, in order
+def case_input_hash(prompt, images):
+    digest = hashlib.sha256(b"prompt\0" + prompt.encode("utf-8"))
+    for img in images:
+        part = img[1]
+        if is_text_part(part):
+            digest.update(b"text\0" + part.text.encode("utf-8"))
+        else:
+            digest.update(b"blob\0" + part.inline_data.data)
+    return digest.hexdigest()
+
+# Function to pick the primary (most probable) diagnosis of a result
+def primary_diagnosis(json_data):
+    differential = json_data.get("differential_diagnosis") or []
+    if not differential:
+        return ""
+    return str(max(differential, key=lambda entry: entry.get("probability") or 0).get("diagnosis", ""))
+
+class CaseStore:
+    """SQLite history of diagnosed cases: results, input hashes, timings, notes and reports.
+
+    Indexed by patient name, date, primary diagnosis and input hash, with an FTS5
+    index over the reasoning and the doctor's notes (plain LIKE search if this
+    SQLite lacks FTS5). Every call opens its own connection, so any thread can use it.
+    """
+
+    def __init__(self, path=CASE_DB_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")  # Readers never wait for a writer
+            db.executescript(CASE_SCHEMA)
+            try:
+                db.executescript(CASE_FTS_SCHEMA)
+                self.fts = True
+            except sqlite3.OperationalError as e:
+                print("SQLite has no FTS5, case search falls back to LIKE:", e)
+                self.fts = False
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=10)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def save_case(self, prompt, images, json_data, timings, model=GEMINI_MODEL):
+        """Stores a new diagnosis, made by `model`, and returns its case id."""
+        now = dt.datetime.now()
+        reasoning = "\n".join(str(entry.get("reasoning", "")) for entry in json_data.get("differential_diagnosis") or [])
+        with self._connect() as db:
+            cursor = db.execute(
+                "INSERT INTO cases (created_at, case_date, primary_diagnosis, input_hash, model, prompt, result_json,"
+                " reasoning, timings_json) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (now.isoformat(timespec="seconds"), now.date().isoformat(), primary_diagnosis(json_data),
+                 case_input_hash(prompt, images), model, prompt, json.dumps(json_data), reasoning,
+                 json.dumps(timings)),
+            )
+            return cursor.lastrowid
+
+    def update_case(self, case_id, patient_name, doctor_notes, doctor_signature, report_pdf=None):
+        with self._connect() as db:
+            db.execute(
+                "UPDATE cases SET patient_name = ?, doctor_notes = ?, doctor_signature = ?,"
+                " report_pdf = COALESCE(?, report_pdf) WHERE id = ?",
+                (patient_name, doctor_notes, doctor_signature, report_pdf, case_id),
+            )
+
+    def find_by_input(self, input_hash):
+        """Returns the latest case with exactly these inputs, or None."""
+        with self._connect() as db:
+            return db.execute(
+                "SELECT id, created_at FROM cases WHERE input_hash = ? ORDER BY id DESC LIMIT 1", (input_hash,)
+            ).fetchone()
+
+    def search(self, query="", limit=CASE_HISTORY_LIMIT):
+        """Lists the latest cases matching `query` in the patient name, primary diagnosis, reasoning or notes."""
+        columns = "SELECT id, case_date, patient_name, primary_diagnosis FROM cases"
+        query = query.strip()
+        with self._connect() as db:
+            if not query:
+                return db.execute(f"{columns} ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+            like = f"%{query}%"
+            if self.fts:
+                # Quote every term so user input can't break the FTS query syntax
+                match = " ".join('"' + term.replace('"', '""') + '"' for term in query.split())
+                return db.execute(
+                    f"{columns} WHERE patient_name LIKE ? OR primary_diagnosis LIKE ?"
+                    " OR id IN (SELECT rowid FROM cases_fts WHERE cases_fts MATCH ?) ORDER BY id DESC LIMIT ?",
+                    (like, like, match, limit),
+                ).fetchall()
+            return db.execute(
+                f"{columns} WHERE patient_name LIKE ? OR primary_diagnosis LIKE ? OR reasoning LIKE ?"
+                " OR doctor_notes LIKE ? ORDER BY id DESC LIMIT ?",
+                (like, like, like, like, limit),
+            ).fetchall()
+
+    def load(self, case_id):
+        """Returns the stored case as a dict (result parsed), or None."""
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM cases WHERE id = ?", (case_id,)).fetchone()
+        if row is None:
+            return None
+        case = dict(row)
+        case["result"] = json.loads(case.pop("result_json"))
+        case["timings"] = json.loads(case.pop("timings_json"))
+        return case
+
+@shared_resource
+def get_case_store():
+    return CaseStore()
+
+# Function to deduplicate, plan and hash a request once per set of inputs, not on every rerun
+def prepare_request(prompt, uploaded, leave_out):
+    """Returns (images, removed, similar, plan, input_hash). While jobs run the page reruns
+    twice a second, so the result is kept in the upload cache under the prompt and page keys."""
+    digest = hashlib.sha256(b"request\0" + prompt.encode("utf-8"))
+    digest.update(f"{get_token_calibration().ratio:.2f}".encode())  # The plan's token estimates depend on it
+    for img in uploaded:
+        digest.update(b"\0" + img[4].encode("utf-8"))
+    for page_id in sorted(leave_out):
+        digest.update(b"\1" + page_id.encode("utf-8"))
+    key = f"request:{digest.hexdigest()}"
+    prepared = get_upload_cache().get(key)
+    if prepared is None:
+        images, removed, similar = deduplicate_images(uploaded, leave_out)
+        positions = {id(img): number for number, img in enumerate(uploaded, 1)}
+        plan = plan_request(prompt, images, numbers=[positions[id(img)] for img in images]) if images else None
+        prepared = (images, removed, similar, plan, case_input_hash(prompt, images))
+        get_upload_cache().put(key, prepared, 4096 + len(prompt))  # The pages themselves are cached already
+    return prepared
+
+# Function to open a stored case in this session without calling the model
+def load_case(case_id):
+    with stage_span("case_load"):
+        case = get_case_store().load(case_id)
+    if case is None:
+        st.error("That case is no longer in the history.")
+        return
+    st.session_state.case_id = case_id
+    st.session_state.json_data = case["result"]
+    st.session_state.report_pdf = case["report_pdf"]
+    st.session_state.patient_name = case["patient_name"]
+    st.session_state.doctor_notes = case["doctor_notes"]
+    st.session_state.doctor_signature = case["doctor_signature"]
+    st.session_state.followup_chat = None  # The attachments aren't stored, so there's no context to ask about
+
+# Function to show the searchable case history in the sidebar
+def case_history_sidebar():
+    with st.sidebar:
+        st.header("Case History")
+        query = st.text_input("Search names, diagnoses, reasoning and notes", key="case_search")
+        cases = get_case_store().search(query)
+        if not cases:
+            st.caption("No saved cases." if not query else "No matching cases.")
+        for case in cases:
+            label = f"{case['case_date']} \u00B7 {case['patient_name'] or 'Unnamed'} \u00B7 {case['primary_diagnosis'] or 'No diagnosis'}"
+            if st.button(label, key=f"load_case_{case['id']}", use_container_width=True):
+                load_case(case["id"])
+
 from datetime import datetime
 def main():
     # Adjust layout to increase working space
@@ -355,6 +3404,7 @@ def main():
     </div>
     """
     st.markdown(title, unsafe_allow_html=True)
+    case_history_sidebar()
     
     st.markdown(
         """
@@ -414,7 +3464,48 @@ def main():
     if 'show_followup' not in st.session_state:
         st.session_state.show_followup = False
 
-    if st.button("Generate Diagnosis"):
+    stream_results = st.checkbox("Show results as they are generated", value=True)
+    bypass_cache = st.checkbox("Bypass response cache", value=False, help="Always ask the model again, even for identical inputs.")
+    cache_stats = get_response_cache().stats()
+    st.sidebar.caption(f"Response cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses")
+    references = get_reference_cache()
+    st.sidebar.caption(f"Reference cache: {references.hits} hits / {references.misses} misses")
+
+    uploaded = images
+    leave_out = {key[len("leave_out_"):] for key, value in st.session_state.items() if key.startswith("leave_out_") and value}
+    images, removed, similar, plan, input_hash = prepare_request(prompt, uploaded, leave_out)
+    if removed:
+        with st.expander(f"Removed {len(removed)} identical or blank page(s) from the request"):
+            for line in removed:
+                st.write(f"- {line}")
+    if similar:
+        with st.expander(f"{len(similar)} page(s) look like near duplicates", expanded=True):
+            st.caption("They are sent unless you leave them out. Check them first: reports that differ in a single value look alike.")
+            for number, original, page_id in similar:
+                left, right, choice = st.columns([1, 1, 2])
+                left.image(uploaded[number - 1][3], caption=f"Image {number}")
+                right.image(uploaded[original - 1][3], caption=f"Image {original}")
+                choice.checkbox(f"Leave out image {number}", key=f"leave_out_{page_id}")
+
+    if plan is not None and plan.dropped:
+        # Said outside the collapsed plan, so it isn't missed
+        st.warning(f"To fit the token budget, these nearly empty pages are not sent to the model: {plan.dropped_pages()}")
+    if plan is not None:
+        with st.expander(f"Request plan: {len(plan.groups)} call(s), about {sum(plan.group_tokens):,} prompt tokens"):
+            for line in plan.describe():
+                st.write(f"- {line}")
+
+    jobs = get_job_queue()
+    session_id = get_session_id()
+    uploads_pending = any(job.key[1] not in ("diagnosis", "followup", "report") for job in jobs.pending(session_id))
+    # Identical inputs were diagnosed before: offer the stored result instead of a new model call
+    saved_case = get_case_store().find_by_input(input_hash) if images else None
+    if saved_case is not None:
+        st.info(f"These inputs were already diagnosed on {saved_case['created_at'].replace('T', ' ')}.")
+        if st.button("Open saved result"):
+            load_case(saved_case["id"])
+
+    if st.button("Generate Diagnosis", disabled=uploads_pending):
         if not images:
             st.warning("Please upload files or prompts")
             json_data = {
@@ -444,42 +3535,66 @@ def main():
                 "important_note": "This information is intended for informational and educational purposes only and does not constitute medical advice. It is essential to consult with a healthcare professional for any health concerns and should not be used as a substitute for a consultation with a healthcare provider."
             }
             st.session_state.json_data = json_data
+            st.session_state.case_id = None
         else:
-            contents = [prompt]
-            contents.extend([img[1] for img in images])
-
-            response_text = call_gemini(contents, sys_ins)  # Get Raw Json
-            json_data = parse_gemini_response(response_text)  # Parse to Json
-            
-            # Provide default JSON data if Gemini fails to return data
-            if json_data is None:
-               json_data = {
-                   "patient_information": {
-                       "age": None,
-                       "symptoms": None,
-                       "relevant_details": "No details to display because analysis failed. Ensure the file is correct and valid."
-                   },
-                   "IMAGE_ANALYSIS": {
-                       "image_type": "Failed image",
-                       "image_analysis": "Image analysis failed to upload. Ensure the file is correct and valid."
-                   },
-                   "ans_to_ques": {"Answer": "Not applicable."},
-                   "differential_diagnosis": [],
-                   "alternative_diagnoses": [],
-                   "follow_up_recommendations": [],
-                   "biases": [
-                       {"bias": "Lack of patient-specific information limits diagnostic accuracy.",
-                        "recommendation": "Obtain a complete patient history, including age, symptoms,  and relevant medical background."},
-                       {"bias": "Absence of medical examination data hinders comprehensive assessment.",
-                        "recommendation": "Conduct a thorough physical examination and gather vital signs."},
-                       {"bias": "Reliance on image data alone may lead to incomplete or inaccurate conclusions.",
-                        "recommendation": "Integrate image findings with other diagnostic modalities, such as laboratory tests and clinical assessments."}
-                   ],
-                   "articles": [],
-                   "confidence_level": 10,
-                   "important_note": "This information is intended for informational and educational purposes only and does not constitute medical advice. It is essential to consult with a healthcare professional for any health concerns and should not be used as a substitute for a consultation with a healthcare provider."
-               }
-            st.session_state.json_data = json_data
+            jobs.pop(session_id, "diagnosis")  # A new request replaces any result not yet collected
+            jobs.pop(session_id, "report")  # A report still rendering belongs to the previous result
+            jobs.submit(session_id, "diagnosis", diagnose_job, prompt, images, plan, not bypass_cache, stream_results)
+
+    # The diagnosis runs in the background; show its progress until it finishes
+    job = jobs.get(session_id, "diagnosis")
+    if job is not None and not job.done:
+        st.progress(job.progress, text=f"Generating diagnosis: {job.message}")
+        if job.partial:
+            render_partial_result(st.empty(), job.partial)
+    elif job is not None:
+        jobs.pop(session_id, "diagnosis")
+        show_job_messages(job)
+        if job.error:
+            st.error(f"\u274C The diagnosis failed: {job.error}")
+        json_data = job.result
+        if st.session_state.get("followup_chat") is not None:
+            st.session_state.followup_chat.close()
+        # Follow-up questions reuse this case's context instead of resending it
+        st.session_state.followup_chat = None
+        st.session_state.case_id = None
+        if json_data is not None:
+            parts = [img[1] for img in enforce_byte_budget(images)]
+            st.session_state.followup_chat = FollowUpChat(prompt, parts, json.dumps(json_data))
+            timings = {"diagnosis_seconds": round(job.finished_at - job.submitted_at, 3), "images": len(images)}
+            model = ", ".join(dict.fromkeys(job.models)) or GEMINI_MODEL  # Split requests may mix routes
+            st.session_state.case_id = get_case_store().save_case(prompt, images, json_data, timings, model)
+            st.session_state.report_pdf = None
+
+        # Provide default JSON data if Gemini fails to return data
+        if json_data is None:
+           json_data = {
+               "patient_information": {
+                   "age": None,
+                   "symptoms": None,
+                   "relevant_details": "No details to display because analysis failed. Ensure the file is correct and valid."
+               },
+               "IMAGE_ANALYSIS": {
+                   "image_type": "Failed image",
+                   "image_analysis": "Image analysis failed to upload. Ensure the file is correct and valid."
+               },
+               "ans_to_ques": {"Answer": "Not applicable."},
+               "differential_diagnosis": [],
+               "alternative_diagnoses": [],
+               "follow_up_recommendations": [],
+               "biases": [
+                   {"bias": "Lack of patient-specific information limits diagnostic accuracy.",
+                    "recommendation": "Obtain a complete patient history, including age, symptoms,  and relevant medical background."},
+                   {"bias": "Absence of medical examination data hinders comprehensive assessment.",
+                    "recommendation": "Conduct a thorough physical examination and gather vital signs."},
+                   {"bias": "Reliance on image data alone may lead to incomplete or inaccurate conclusions.",
+                    "recommendation": "Integrate image findings with other diagnostic modalities, such as laboratory tests and clinical assessments."}
+               ],
+               "articles": [],
+               "confidence_level": 10,
+               "important_note": "This information is intended for informational and educational purposes only and does not constitute medical advice. It is essential to consult with a healthcare professional for any health concerns and should not be used as a substitute for a consultation with a healthcare provider."
+           }
+        st.session_state.json_data = json_data
 
     # Display results *only if* json_data exists in session state
     if 'json_data' in st.session_state:
@@ -495,116 +3610,42 @@ def main():
         for recommendation in st.session_state.json_data.get('follow_up_recommendations', []):
             st.write(f"- {recommendation}")
 
-    doctor_notes = st.text_area("Doctor's Notes", "")
-    patient_name = st.text_input("Patient Name", "") # New prompt input
-    doctor_signature = st.text_input("Doctor's Signature", "") # New prompt input
+    followup_panel(jobs, session_id)
+
+    doctor_notes = st.text_area("Doctor's Notes", "", key="doctor_notes")
+    patient_name = st.text_input("Patient Name", "", key="patient_name") # New prompt input
+    doctor_signature = st.text_input("Doctor's Signature", "", key="doctor_signature") # New prompt input
 
     # Generate PDF if Generate Diagnosis has been run
     if st.button("Generate PDF Report") and 'json_data' in st.session_state:
-        now = datetime.now()
-        formatted_date_time = now.strftime("%Y-%m-%d %H:%M:%S")
-        # Access data from session_state
-        json_data = st.session_state.json_data
-        differential_diagnosis = json_data.get('differential_diagnosis', []) #Get it and make it safe
-        
-        # Determine primary diagnosis string
-        primary_diagnosis_str = ""
-        if differential_diagnosis and len(differential_diagnosis) > 0 : #check if it has differential diagnosis at all!
-          primary_diagnosis_str = f"""
-          <p><strong>Diagnosis:</strong> {differential_diagnosis[0].get('diagnosis', 'N/A') if differential_diagnosis[0] else 'N/A'}</p>
-          <p><strong>Reasoning:</strong> {differential_diagnosis[0].get('reasoning', 'N/A') if differential_diagnosis[0] else 'N/A'}</p>
-          <p><strong>Severity:</strong> {differential_diagnosis[0].get('severity', 'N/A') if differential_diagnosis[0] else 'N/A'}</p>
-          <p><strong>Risk Factors:</strong> {differential_diagnosis[0].get('risk_factors', 'N/A') if differential_diagnosis[0] else 'N/A'}</p>
-          """ #If its great add these elements
+        jobs.pop(session_id, "report")
+        jobs.submit(session_id, "report", render_report_job, st.session_state.json_data, patient_name, doctor_notes,
+                    doctor_signature, st.session_state.get("case_id"))
+
+    # The report renders in the background; the download is offered once its bytes are ready
+    job = jobs.get(session_id, "report")
+    if job is not None and not job.done:
+        st.progress(job.progress, text=f"Rendering PDF report: {job.message}")
+    elif job is not None:
+        jobs.pop(session_id, "report")
+        if job.error:
+            st.error(f"An error occurred during PDF generation: {job.error}. Please make sure you have followed the instructions to properly install PDF kit and added it to the path, as well as ghost script. "
+                     "Also make sure that differential diagnosis exists for a primary diagnosis. Please upload files or prompt such that it will create a primary diagnosis for it.")
         else:
-          primary_diagnosis_str = "<p>No diagnosis found.</p>" #If not do not add
-
-        report_html = f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-            <style>
-            body {{ font-family: sans-serif;
-                    padding-top: 30px;  }} /* add padding to push content down */
-            h1 {{ text-align: center; }}
-            h2 {{ color: #333; }}
-            p {{ line-height: 1.6; }}
-            .section {{ margin-bottom: 20px; }}
-            .contact-details {{ margin-top: 30px; text-align: center; }}
-            .date-time {{ 
-                text-align: right; 
-                font-style: italic; 
-                position: absolute;
-                top: 5px;
-                right: 5px;
-                margin-top: -5px; /* pull the date-time up into the corner */
-            }}
-            </style>
-            </head>
-            <body>
-            <div class="date-time">{formatted_date_time}</div>
-            <h1>Medical Diagnosis Assistant Report</h1>
-
-            <div class="section">
-                <h2>Patient Information</h2>
-                <p><strong>Patient Name:</strong> {patient_name if patient_name else "Not Specified"}</p>
-                <p><strong>Age:</strong> {json_data.get('patient_information', {}).get('age', 'N/A')}</p>
-                <p><strong>Symptoms:</strong> {json_data.get('patient_information', {}).get('symptoms', 'N/A')}</p>
-            </div>
-
-            <div class="section">
-                <h2>Primary Diagnosis</h2>
-                {primary_diagnosis_str} 
-            </div>
-
-            <div class="section">
-                <h2>Image Analysis</h2>
-                <p><strong>Image Type:</strong> {json_data.get('IMAGE_ANALYSIS', {}).get('image_type', 'N/A')}</p>
-                <p><strong>Analysis:</strong> {json_data.get('IMAGE_ANALYSIS', {}).get('image_analysis', 'N/A')}</p>
-            </div>
-
-            <div class="section">
-                <h2>Doctor's Notes</h2>
-                <p>{doctor_notes}</p>
-            </div>
-
-            <div class="section">
-                <h2>Doctor's Signature</h2>
-                <p>{doctor_signature}</p>
-            </div>
-
-             <div class="section">
-                <h2>Articles</h2>
-                <ul>
-                    {"".join([f"<li>{article}</li>" for article in json_data.get('articles', [])])}
-                </ul>
-            </div>
-
-            <div class="contact-details">
-                <p>Contact Us: medassistant@example.com | 1-800-MED-AI-DOC</p>
-            </div>
-            </body>
-            </html>
-            """
-
-        # Generate and offer PDF file download
-        try:
-            pdf_report = pdfkit.from_string(report_html, False)
-            st.subheader("Your pdf is ready to download!")
-
-            b64_pdf = base64.b64encode(pdf_report).decode('UTF-8')
-            pdf_display = f'<iframe src="data:application/pdf;base64,{b64_pdf}" width="700" height="1000" type="application/pdf"></iframe>'
-            st.markdown(pdf_display, unsafe_allow_html=True)
+            st.session_state.report_pdf = job.result
 
-            download_button_str = f"""
-                <a href="data:application/octet-stream;base64,{b64_pdf}" download="report.pdf" class="button">Download PDF</a>
-            """
-            st.markdown(download_button_str, unsafe_allow_html=True)
-        except Exception as e:
-             st.error(f"An error occurred during PDF generation: {e}. Please make sure you have followed the instructions to properly install PDF kit and added it to the path, as well as ghost script."," ""Also make sure that differential diagnosis exists for a primary diagnosis. Please upload files or prompt such that it will create a primary diagnosis for it.")
+    # Served through Streamlit's media endpoint instead of inline base64 data URIs
+    if st.session_state.get("report_pdf"):
+        st.subheader("Your pdf is ready to download!")
+        st.download_button("Download PDF", data=st.session_state.report_pdf, file_name="report.pdf", mime="application/pdf")
     
     json_data = st.session_state.get("json_data", None) #Set it to none so that the data does not throw
     st.info("This tool is intended for educational and informational purposes only. It is not a substitute for professional medical advice, diagnosis, or treatment. Consult a qualified healthcare provider for any health concerns.")   
 
+    # Poll background jobs: rerun shortly to refresh their progress bars and pick up results
+    if jobs.pending(session_id):
+        time.sleep(JOB_POLL_SECONDS)
+        st.rerun()
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,179 @@
+"""Headless batch runner for the Medical Diagnostic Assistant.
+
+Runs every case in a directory (one sub-folder per case) or a JSONL manifest
+through the same encoding, Gemini call and parsing used by the Streamlit app,
+and streams one JSON line per case to an output file. Re-running with the
+same output file skips cases that already succeeded, so a crashed or
+interrupted run can simply be started again.
+
+    python batch_diagnose.py cases/ --output results.jsonl --workers 8 --rpm 120
+
+Manifest lines look like:
+    {"case_id": "case-17", "files": ["case-17/cxr.png", "labs.pdf"], "prompt": "65M, cough"}
+with file paths relative to the manifest.
+"""
+import argparse
+import json
+import mimetypes
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import Diag_Assist
+
+SUPPORTED_MIME_TYPES = ["image/png", "image/jpg", "image/jpeg", "application/pdf", "application/dicom"]
+# Text files in a case folder that hold the patient details prompt
+PROMPT_FILE_NAMES = ["prompt.txt", "notes.txt"]
+DEFAULT_PROMPT = "Just give output based on image."
+
+
+# Function to list the cases in a directory: one sub-folder per case
+def cases_from_directory(root, default_prompt=DEFAULT_PROMPT):
+    cases = []
+    for name in sorted(os.listdir(root)):
+        case_dir = os.path.join(root, name)
+        if not os.path.isdir(case_dir):
+            continue
+        prompt = default_prompt
+        files = []
+        for file_name in sorted(os.listdir(case_dir)):
+            path = os.path.join(case_dir, file_name)
+            if file_name in PROMPT_FILE_NAMES:
+                with open(path, encoding="utf-8") as f:
+                    prompt = f.read().strip() or default_prompt
+            elif mimetypes.guess_type(path)[0] in SUPPORTED_MIME_TYPES:
+                files.append(path)
+        cases.append({"case_id": name, "files": files, "prompt": prompt})
+    return cases
+
+
+# Function to read cases from a JSONL manifest
+def cases_from_manifest(manifest_path, default_prompt=DEFAULT_PROMPT):
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    cases = []
+    with open(manifest_path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            cases.append({
+                "case_id": str(entry.get("case_id", line_number)),
+                "files": [os.path.join(base_dir, path) for path in entry.get("files", [])],
+                "prompt": entry.get("prompt") or default_prompt,
+            })
+    return cases
+
+
+# Function to collect the case ids that already have a successful result
+def completed_case_ids(output_path):
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # Partial last line from a crash; that case is simply run again
+            if record.get("status") == "ok":
+                done.add(record["case_id"])
+    return done
+
+
+# Function to run one case end to end, without Streamlit
+def diagnose_case(case, use_cache=True, pdf_options=None, dicom_options=None):
+    started = time.perf_counter()
+    record = {"case_id": case["case_id"], "model": Diag_Assist.GEMINI_MODEL}
+    try:
+        images = []
+        dicom_paths = []
+        for path in case["files"]:
+            mime_type = mimetypes.guess_type(path)[0]
+            if mime_type == "application/dicom":
+                dicom_paths.append(path)  # A series spans many files, so they are rendered together
+                continue
+            for image, image_part in Diag_Assist.encode_file(path, mime_type, pdf_options):
+                images.append((image, image_part, path))
+        if dicom_paths:
+            for image, image_part in Diag_Assist.encode_dicom_series(dicom_paths, dicom_options):
+                images.append((image, image_part, "dicom slice"))
+        images, removed, similar = Diag_Assist.deduplicate_images(images)
+        if removed:
+            record["removed_pages"] = removed
+        if similar:  # Kept: nobody is there to confirm them
+            record["possible_duplicates"] = [f"Image {number} looks like image {original}" for number, original, _ in similar]
+        if not images:
+            record.update(status="error", error="No supported files in case")
+            return record
+        contents = [case["prompt"]]
+        contents.extend([img[1] for img in Diag_Assist.enforce_byte_budget(images)])
+
+        response_text, result, route = Diag_Assist.route_diagnosis(contents, use_cache=use_cache)
+        record.update(model=route["model"], route=route["route"], route_reasons=route["reasons"])
+        if response_text is None:
+            record.update(status="error", error="Gemini call failed")
+            return record
+        if result is None:
+            record.update(status="invalid_json", raw_response=response_text)
+        else:
+            record.update(status="ok", result=Diag_Assist.attach_references(result.to_dict()),
+                          missing_fields=result.missing_fields)
+    except Exception as e:
+        record.update(status="error", error=f"{type(e).__name__}: {e}")
+    finally:
+        record["elapsed_seconds"] = round(time.perf_counter() - started, 3)
+    return record
+
+
+def run_batch(cases, output_path, workers=4, requests_per_minute=60, use_cache=True, pdf_options=None,
+              dicom_options=None):
+    """Diagnoses `cases` on a bounded thread pool and appends one JSON line per case to `output_path`.
+
+    Cases already recorded as successful in `output_path` are skipped. Returns a
+    dict of counts per status for this run.
+    """
+    done = completed_case_ids(output_path)
+    pending = [case for case in cases if case["case_id"] not in done]
+    # Every model request of every case (follow-up fields, escalations, reference lookups) goes through the
+    # shared client, so the limit is enforced there rather than once per case
+    Diag_Assist.get_async_gemini_client().set_rate_limit(requests_per_minute)
+    counts = {"skipped": len(cases) - len(pending)}
+
+    with open(output_path, "a", encoding="utf-8") as out, ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(diagnose_case, case, use_cache, pdf_options, dicom_options)
+                   for case in pending]
+        for future in as_completed(futures):
+            record = future.result()
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+            os.fsync(out.fileno())  # Make every finished case survive a crash
+            counts[record["status"]] = counts.get(record["status"], 0) + 1
+            print(f"[{sum(counts.values()) - counts['skipped']}/{len(pending)}] {record['case_id']}: {record['status']}")
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run diagnoses over a directory or manifest of cases.")
+    parser.add_argument("cases", help="Directory with one sub-folder per case, or a .jsonl manifest")
+    parser.add_argument("--output", default="batch_results.jsonl", help="JSONL file results are appended to")
+    parser.add_argument("--workers", type=int, default=4, help="Cases processed concurrently")
+    parser.add_argument("--rpm", type=float, default=60, help="Max Gemini requests started per minute (0 = unlimited)")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the response cache")
+    parser.add_argument("--dpi", type=int, default=Diag_Assist.PDF_DPI, help="PDF rasterization DPI")
+    parser.add_argument("--window", default="From file", choices=list(Diag_Assist.DICOM_WINDOWS), help="DICOM window preset")
+    parser.add_argument("--slices", type=int, default=Diag_Assist.DICOM_SLICES_PER_SERIES,
+                        help="Representative slices sent per DICOM series")
+    parser.add_argument("--prompt", default=DEFAULT_PROMPT, help="Prompt for cases without prompt.txt/notes.txt")
+    args = parser.parse_args()
+
+    if os.path.isdir(args.cases):
+        cases = cases_from_directory(args.cases, args.prompt)
+    else:
+        cases = cases_from_manifest(args.cases, args.prompt)
+    counts = run_batch(cases, args.output, args.workers, args.rpm, not args.no_cache, {"dpi": args.dpi},
+                       {"window": args.window, "slices": args.slices})
+    print("Done:", ", ".join(f"{status}={count}" for status, count in sorted(counts.items())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+"""Offline end-to-end benchmark of the diagnosis pipeline.
+
+Generates a synthetic corpus of scans, photos, documents and multi-page PDFs,
+runs every case through the same jobs as the app (the upload job with its
+process-pool encoding, deduplication and request planning, the diagnosis job
+with model routing and parsing, then display and report) against the
+LocalGeminiClient stand-in, and reports per-stage latency percentiles,
+throughput and peak RSS. Exits non-zero when fewer responses parse than
+--min-parse-success.
+
+    python benchmark_pipeline.py --cases 40 --latency 0.8 --malformed-rate 0.1 --output bench.json
+
+Use --responses with a JSONL file of recorded responses ({"text": ...} per
+line) to replay real model output. PDF cases need poppler (pdftoppm) on the
+PATH and the report stage needs wkhtmltopdf; without them those stages are
+skipped and listed in the results.
+"""
+import argparse
+import io
+import json
+import mimetypes
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+import Diag_Assist
+import local_gemini
+
+PROMPT = "Just give output based on image."
+
+# Synthetic corpus: (kind, longest side in px, pages) and how often each appears
+CORPUS_MIX = [
+    ("xray", 1024, 1, 3),
+    ("xray", 3000, 1, 2),
+    ("photo", 4000, 1, 2),
+    ("document", 2200, 1, 2),
+    ("pdf", 1700, 4, 2),
+    ("pdf", 1700, 30, 1),
+]
+
+
+class StageTimer:
+    """Collects wall-clock durations per pipeline stage from any number of threads."""
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.durations[name].append(elapsed)
+
+
+# Function to compute the latency summary of one stage, in milliseconds
+def summarize(durations):
+    ordered = sorted(durations)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] * 1000
+
+    return {
+        "count": len(ordered),
+        "mean_ms": statistics.fmean(ordered) * 1000,
+        "p50_ms": percentile(50),
+        "p90_ms": percentile(90),
+        "p99_ms": percentile(99),
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+# Function to draw a synthetic image of the given kind
+def synthetic_image(kind, size, rng):
+    height, width = size, int(size * 0.8)
+    if kind == "xray":
+        # Smooth grayscale blobs on a dark field, like a radiograph
+        y, x = np.mgrid[0:height, 0:width]
+        field = np.zeros((height, width), dtype=np.float32)
+        for _ in range(6):
+            cy, cx, radius = rng.uniform(0, height), rng.uniform(0, width), rng.uniform(size / 10, size / 3)
+            field += np.exp(-((y - cy) ** 2 + (x - cx) ** 2) / (2 * radius ** 2))
+        field += np.random.default_rng(rng.randrange(2 ** 32)).normal(0, 0.03, field.shape)
+        return Image.fromarray(np.clip(field / field.max() * 255, 0, 255).astype(np.uint8)).convert("RGB")
+    if kind == "photo":
+        noise = np.random.default_rng(rng.randrange(2 ** 32)).integers(0, 255, (height // 8, width // 8, 3), dtype=np.uint8)
+        return Image.fromarray(noise).resize((width, height), Image.BICUBIC)
+    # Document: black text-like lines on white
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    for row in range(60, height - 60, 40):
+        draw.text((60, row), "Lab result %d: value %.2f mmol/L (ref 3.5-5.0)" % (row, rng.uniform(1, 9)), fill="black")
+    return image
+
+
+# Function to write the synthetic corpus to disk; returns a list of cases
+def build_corpus(directory, cases, seed, include_pdfs):
+    rng = random.Random(seed)
+    weighted = [entry for entry in CORPUS_MIX for _ in range(entry[3]) if include_pdfs or entry[0] != "pdf"]
+    corpus = []
+    for index in range(cases):
+        kind, size, pages, _ = rng.choice(weighted)
+        if kind == "pdf":
+            path = os.path.join(directory, f"case{index}.pdf")
+            images = [synthetic_image(rng.choice(["document", "xray"]), size, rng) for _ in range(pages)]
+            images[0].save(path, "PDF", save_all=True, append_images=images[1:], resolution=150)
+        else:
+            path = os.path.join(directory, f"case{index}.{'jpg' if kind == 'photo' else 'png'}")
+            synthetic_image(kind, size, rng).save(path)
+        corpus.append({"case_id": f"case{index}", "kind": f"{kind}-{size}px-{pages}p", "path": path,
+                       "bytes": os.path.getsize(path)})
+    return corpus
+
+
+class UploadedFile(io.BytesIO):
+    """What Streamlit hands the app for an upload: the bytes and the file name."""
+
+    def __init__(self, data, name):
+        super().__init__(data)
+        self.name = name
+
+
+# Function to run a job on the app's queue and wait for it; raises if the job failed
+def run_job(jobs, session_id, key, func, *args):
+    job = jobs.submit(session_id, key, func, *args)
+    job.future.result()
+    jobs.pop(session_id, key)
+    if job.error:
+        raise RuntimeError(f"{key} job failed: {job.error}")
+    return job
+
+
+# Function to push one case through the app's jobs, as the page would after an upload and a click
+def run_case(case, timer, spill_area, run_report):
+    jobs = Diag_Assist.get_job_queue()
+    name = os.path.basename(case["path"])
+    with open(case["path"], "rb") as f:
+        upload = UploadedFile(f.read(), name)
+    mime_type = mimetypes.guess_type(case["path"])[0]
+
+    key = Diag_Assist.upload_cache_key(upload, mime_type)
+    with timer.stage("upload_job"):
+        entries = run_job(jobs, case["case_id"], key, Diag_Assist.process_upload, upload, key, mime_type, None,
+                          spill_area).result
+    label = name if mime_type != "application/pdf" else "pdf page"
+    uploaded = [(image, image_part, label, thumbnail, f"{key}#{index}")
+                for index, (image, image_part, thumbnail) in enumerate(entries)]
+
+    with timer.stage("prepare_request"):  # Deduplication, token planning and the case hash
+        images, removed, _, plan, _ = Diag_Assist.prepare_request(PROMPT, uploaded, set())
+    request_bytes = sum(Diag_Assist.part_size(img[1]) for img in Diag_Assist.enforce_byte_budget(images))
+
+    with timer.stage("diagnosis_job"):  # Routing, escalation, missing-field repair and references
+        job = run_job(jobs, case["case_id"], "diagnosis", Diag_Assist.diagnose_job, PROMPT, images, plan, False, True)
+    json_data = job.result
+    if json_data is not None:
+        with timer.stage("display"):
+            Diag_Assist.display_results(json_data, images)
+        with timer.stage("report_html"):
+            report_html = Diag_Assist.build_report_html(json_data, "Synthetic Patient", "", "", "now")
+        if run_report:
+            with timer.stage("report_pdf"):
+                Diag_Assist.pdfkit.from_string(report_html, False)
+    return {
+        "case_id": case["case_id"],
+        "images": len(images),
+        "removed_pages": len(removed),
+        "calls": len(plan.groups),
+        "request_bytes": request_bytes,
+        "parsed": json_data is not None,
+        "models": job.models,
+    }
+
+
+@contextmanager
+def offline_app(fake, work_dir):
+    """Points the app at the stand-in client and at caches and a case DB under `work_dir`,
+    so stand-in diagnoses and invented reference links never reach the real app's .cache.
+    The module globals are restored on exit."""
+    cache_dir = os.path.join(work_dir, "cache")
+    async_client = Diag_Assist.AsyncGeminiClient(fake)
+    response_cache = Diag_Assist.ResponseCache(directory=os.path.join(cache_dir, "responses"))
+    reference_cache = Diag_Assist.ReferenceCache(path=os.path.join(cache_dir, "references.json"))
+    case_db_path = os.path.join(cache_dir, "cases.sqlite3")
+    case_store = Diag_Assist.CaseStore(case_db_path)
+    patches = {
+        "get_client": lambda: fake,
+        "get_async_gemini_client": lambda api_key=None: async_client,
+        "USE_FILE_UPLOADS": False,
+        "get_response_cache": lambda: response_cache,
+        "get_reference_cache": lambda: reference_cache,
+        "CASE_DB_PATH": case_db_path,
+        "get_case_store": lambda: case_store,
+    }
+    saved = {name: getattr(Diag_Assist, name) for name in patches}
+    for name, value in patches.items():
+        setattr(Diag_Assist, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(Diag_Assist, name, value)
+
+
+def run_benchmark(cases=20, concurrency=4, latency=0.5, latency_jitter=0.3, malformed_rate=0.0,
+                  responses=None, seed=0, run_report=None):
+    """Runs the synthetic benchmark and returns the results as a JSON-ready dict."""
+    include_pdfs = shutil.which("pdftoppm") is not None
+    if run_report is None:
+        run_report = shutil.which("wkhtmltopdf") is not None
+    skipped = [name for name, available in (("pdf cases (no pdftoppm)", include_pdfs),
+                                            ("report_pdf (no wkhtmltopdf)", run_report)) if not available]
+
+    fake = local_gemini.LocalGeminiClient(responses, latency, latency_jitter, malformed_rate, seed)
+    timer = StageTimer()
+
+    with tempfile.TemporaryDirectory(prefix="diag_bench_") as work_dir, offline_app(fake, work_dir):
+        corpus_dir = os.path.join(work_dir, "corpus")
+        os.makedirs(corpus_dir)
+        corpus = build_corpus(corpus_dir, cases, seed, include_pdfs)
+        spill_area = Diag_Assist.SpillArea()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            outcomes = list(pool.map(lambda case: run_case(case, timer, spill_area, run_report), corpus))
+        wall_seconds = time.perf_counter() - started
+        spill_area.cleanup()
+
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / (1024 * 1024) if sys.platform == "darwin" else peak_rss / 1024
+    return {
+        "config": {"cases": cases, "concurrency": concurrency, "latency_s": latency, "latency_jitter": latency_jitter,
+                   "malformed_rate": malformed_rate, "seed": seed, "recorded_responses": bool(responses)},
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "skipped": skipped,
+        "wall_seconds": wall_seconds,
+        "throughput_cases_per_hour": cases / wall_seconds * 3600 if wall_seconds else None,
+        "peak_rss_mb": peak_rss_mb,
+        "parse_success_rate": sum(o["parsed"] for o in outcomes) / len(outcomes) if outcomes else None,
+        "calls_by_model": dict(Counter(model for o in outcomes for model in o["models"])),
+        "removed_pages": sum(o["removed_pages"] for o in outcomes),
+        "mean_request_bytes": statistics.fmean(o["request_bytes"] for o in outcomes) if outcomes else None,
+        "corpus_bytes": sum(case["bytes"] for case in corpus),
+        "stages": {name: summarize(durations) for name, durations in sorted(timer.durations.items())},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the diagnosis pipeline offline against a local Gemini stand-in.")
+    parser.add_argument("--cases", type=int, default=20, help="Synthetic cases to generate and run")
+    parser.add_argument("--concurrency", type=int, default=4, help="Cases processed at the same time")
+    parser.add_argument("--latency", type=float, default=0.5, help="Median simulated model latency in seconds")
+    parser.add_argument("--latency-jitter", type=float, default=0.3, help="Log-normal sigma of the model latency")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="Fraction of responses that are damaged")
+    parser.add_argument("--responses", help="JSONL file of recorded responses to replay")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-report", action="store_true", help="Skip wkhtmltopdf even if it is installed")
+    parser.add_argument("--output", default="bench_results.json", help="Where to write the machine-readable results")
+    parser.add_argument("--min-parse-success", type=float, default=0.95,
+                        help="Exit non-zero when a smaller fraction of cases yields a parsed diagnosis")
+    args = parser.parse_args()
+
+    responses = local_gemini.load_recorded_responses(args.responses) if args.responses else None
+    results = run_benchmark(args.cases, args.concurrency, args.latency, args.latency_jitter, args.malformed_rate,
+                            responses, args.seed, False if args.no_report else None)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+
+    print(f"{args.cases} cases in {results['wall_seconds']:.1f}s "
+          f"({results['throughput_cases_per_hour']:.0f} cases/hour), peak RSS {results['peak_rss_mb']:.0f} MB, "
+          f"parse success {results['parse_success_rate']:.0%}")
+    print(f"{'stage':<20}{'count':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}")
+    for name, stats in results["stages"].items():
+        print(f"{name:<20}{stats['count']:>7}{stats['p50_ms']:>10.1f}{stats['p90_ms']:>10.1f}{stats['p99_ms']:>10.1f}")
+    for name in results["skipped"]:
+        print("skipped:", name)
+    print("Results written to", args.output)
+    if results["parse_success_rate"] is None or results["parse_success_rate"] < args.min_parse_success:
+        print(f"FAIL: parse success below {args.min_parse_success:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Cold-start benchmark for the Medical Diagnostic Assistant.
+
+Measures, each in a fresh interpreter:
+  * per-module import time of `Diag_Assist` (from `python -X importtime`),
+  * which heavy dependencies the import pulled in (they should be deferred),
+  * time to first render of the Streamlit page (via streamlit.testing AppTest).
+
+    python benchmark_startup.py --runs 5 --output startup.json --max-import-seconds 1.5
+
+Exits non-zero when a budget given on the command line is exceeded, so it can
+gate CI against startup regressions.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_FILE = os.path.join(APP_DIR, "Diag_Assist.py")
+# Modules that must not be loaded just by importing the app
+DEFERRED_MODULES = ["cv2", "numpy", "pdf2image", "pdfkit", "pydicom", "google.genai", "httpx", "requests"]
+
+IMPORT_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import Diag_Assist
+elapsed = time.perf_counter() - started
+print(json.dumps({"seconds": elapsed, "loaded": [m for m in %r if m in sys.modules]}))
+""" % (DEFERRED_MODULES,)
+
+RENDER_PROBE = """
+import json, time
+started = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+app = AppTest.from_file(%r, default_timeout=120)
+app.run()
+print(json.dumps({"seconds": time.perf_counter() - started, "exceptions": [str(e.value) for e in app.exception]}))
+""" % (APP_FILE,)
+
+
+# Function to run a probe in a fresh interpreter and return (its JSON output, stderr)
+def run_probe(code, extra_args=()):
+    result = subprocess.run(
+        [sys.executable, *extra_args, "-c", code],
+        cwd=APP_DIR, capture_output=True, text=True, check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+# Function to parse `-X importtime` output into {module: (self_us, cumulative_us)}
+def parse_importtime(stderr):
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def benchmark(runs=3, top=15):
+    """Returns a dict with import/render timings (median of `runs`) and the slowest imports."""
+    import_seconds, render_seconds = [], []
+    loaded, render_errors = set(), []
+    modules = {}
+    for _ in range(runs):
+        probe, stderr = run_probe(IMPORT_PROBE, ["-X", "importtime"])
+        import_seconds.append(probe["seconds"])
+        loaded.update(probe["loaded"])
+        modules = parse_importtime(stderr)  # Keep the last run's breakdown
+        render, _ = run_probe(RENDER_PROBE)
+        render_seconds.append(render["seconds"])
+        render_errors.extend(render["exceptions"])
+    slowest = sorted(modules.items(), key=lambda item: item[1][1], reverse=True)[:top]
+    return {
+        "import_seconds": statistics.median(import_seconds),
+        "first_render_seconds": statistics.median(render_seconds),
+        "runs": runs,
+        "eagerly_loaded_heavy_modules": sorted(loaded),
+        "render_exceptions": render_errors,
+        "slowest_imports": [
+            {"module": name, "self_ms": self_us / 1000, "cumulative_ms": cumulative_us / 1000}
+            for name, (self_us, cumulative_us) in slowest
+        ],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure import time and time-to-first-render of the app.")
+    parser.add_argument("--runs", type=int, default=3, help="Fresh interpreters per measurement (median is reported)")
+    parser.add_argument("--top", type=int, default=15, help="How many of the slowest imports to list")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    parser.add_argument("--max-import-seconds", type=float, help="Fail if importing the app takes longer")
+    parser.add_argument("--max-render-seconds", type=float, help="Fail if the first render takes longer")
+    args = parser.parse_args()
+
+    results = benchmark(args.runs, args.top)
+    print(f"Import Diag_Assist:   {results['import_seconds'] * 1000:8.1f} ms")
+    print(f"First render:         {results['first_render_seconds'] * 1000:8.1f} ms")
+    print("Slowest imports (cumulative):")
+    for entry in results["slowest_imports"]:
+        print(f"  {entry['cumulative_ms']:8.1f} ms  {entry['module']}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    failures = []
+    if results["eagerly_loaded_heavy_modules"]:
+        failures.append("heavy modules loaded at import: " + ", ".join(results["eagerly_loaded_heavy_modules"]))
+    if results["render_exceptions"]:
+        failures.append("first render raised: " + "; ".join(results["render_exceptions"]))
+    if args.max_import_seconds is not None and results["import_seconds"] > args.max_import_seconds:
+        failures.append(f"import took {results['import_seconds']:.2f}s (budget {args.max_import_seconds}s)")
+    if args.max_render_seconds is not None and results["first_render_seconds"] > args.max_render_seconds:
+        failures.append(f"first render took {results['first_render_seconds']:.2f}s (budget {args.max_render_seconds}s)")
+    for failure in failures:
+        print("FAIL:", failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,370 @@
+"""Offline stand-ins for the Gemini services the app uses.
+
+LocalGeminiClient mimics the parts of `genai.Client` the app calls
+(`models`, `aio.models`, `files`, `caches`) and replays recorded responses with
+configurable latency and a configurable rate of malformed output, so the
+pipeline can be run, tested and benchmarked without network access or an
+API key. Select it for the app with DIAG_GEMINI_BACKEND=local; the
+DIAG_LOCAL_* variables below tune it.
+"""
+import asyncio
+import datetime as dt
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+LOCAL_FILE_TTL = 48 * 60 * 60  # matches the Gemini file service
+LOCAL_CACHE_MIN_TOKENS = 4096  # the smallest context Gemini 2.0 Flash will cache
+# Rough token accounting, close to what the real service reports for Gemini 2.0:
+# images up to 384px are one 258-token tile, larger ones are cut into 768px tiles
+CHARS_PER_TOKEN = 4
+TOKENS_PER_IMAGE = 258
+IMAGE_TILE_SIZE = 768
+
+# A complete, schema-valid answer replayed when no recordings are given
+SAMPLE_RESPONSE = {
+    "patient_information": {"age": 54, "symptoms": "Productive cough and fever for 5 days", "relevant_details": "Smoker, 20 pack-years"},
+    "IMAGE_ANALYSIS": {"image_type": "Chest X-ray (PA view)", "image_analysis": "Right lower lobe consolidation with air bronchograms."},
+    "ans_to_ques": {"Answer": "Not applicable."},
+    "differential_diagnosis": [
+        {"diagnosis": "Community-acquired pneumonia", "probability": 70, "reasoning": "Fever, productive cough and lobar consolidation on the X-ray.", "severity": "Moderate", "risk_factors": "Smoking"},
+        {"diagnosis": "Acute bronchitis", "probability": 15, "reasoning": "Cough and fever, but bronchitis does not cause consolidation.", "severity": "Mild", "risk_factors": "Smoking"},
+        {"diagnosis": "Lung cancer with post-obstructive pneumonia", "probability": 10, "reasoning": "Heavy smoking history; no mass is visible.", "severity": "Severe", "risk_factors": "Smoking, age"},
+    ],
+    "alternative_diagnoses": [{"diagnosis": "Pulmonary embolism", "reasoning_against": "No pleuritic pain or tachycardia reported."}],
+    "follow_up_recommendations": ["Complete blood count", "Sputum culture", "Repeat chest X-ray in 6 weeks"],
+    "biases": [{"bias": "Single view radiograph.", "recommendation": "Obtain a lateral view."}],
+    "articles": ["https://www.mayoclinic.org/diseases-conditions/pneumonia"],
+    "confidence_level": 75,
+    "important_note": "This information is intended for informational and educational purposes only and does not constitute medical advice.",
+}
+
+# Replayed for follow-up questions: calls against a cached context or with earlier model turns
+FOLLOW_UP_RESPONSE = ("The consolidation is confined to the right lower lobe, which fits community-acquired pneumonia. "
+                      "A lateral view and a sputum culture would help confirm it.")
+
+
+# Function to answer a Google Search grounded reference lookup: the prompt ends with a JSON list of diagnoses
+def reference_answer(contents):
+    text = " ".join(item if isinstance(item, str) else (getattr(item, "text", None) or "") for item in contents)
+    try:
+        diagnoses = json.loads(text[text.rindex("["):])
+    except ValueError:
+        diagnoses = []
+    return {str(name): [f"https://medlineplus.gov/search/?query={urllib.parse.quote(str(name))}"] for name in diagnoses}
+
+
+# Function to damage a response the way real model output sometimes is
+def malform(text, rng):
+    kind = rng.choice(["truncate", "prose", "trailing_comma", "missing_comma", "python_literal"])
+    if kind == "truncate":
+        return text[: int(len(text) * rng.uniform(0.5, 0.95))]
+    if kind == "prose":
+        return "Here is the analysis you asked for:\n```json\n" + text + "\n```\nLet me know if you need more."
+    if kind == "trailing_comma":
+        return text.replace("]", ", ]", 1)
+    if kind == "missing_comma":
+        return text.replace('}, {', '} {', 1)
+    return text.replace("null", "None", 1) if "null" in text else text.replace(": 70", ": True", 1)
+
+
+# Function to estimate the prompt tokens of a request the way the service would count them;
+# `files` resolves file references to the bytes that were uploaded
+def estimate_tokens(contents, files=None):
+    tokens = 0
+    for item in contents if isinstance(contents, list) else [contents]:
+        if isinstance(item, str):
+            tokens += len(item) // CHARS_PER_TOKEN + 1
+        elif getattr(item, "parts", None) is not None:  # A Content turn
+            tokens += estimate_tokens(list(item.parts), files)
+        elif getattr(item, "text", None):
+            tokens += len(item.text) // CHARS_PER_TOKEN + 1
+        else:
+            tokens += media_tokens(item, files)
+    return tokens
+
+
+# Function to count the tokens of an inline or uploaded media part from its type and contents
+def media_tokens(part, files=None):
+    from PIL import Image
+
+    inline = getattr(part, "inline_data", None)
+    file_data = getattr(part, "file_data", None)
+    if inline is not None:
+        mime_type, data = inline.mime_type or "", inline.data
+    elif file_data is not None and files is not None and (file_data.file_uri or "").startswith("local://"):
+        mime_type, data = file_data.mime_type or "", files.read(file_data.file_uri)
+    else:
+        return TOKENS_PER_IMAGE  # Nothing to measure: count one tile
+    if mime_type.startswith("text/"):
+        return len(data) // CHARS_PER_TOKEN + 1
+    if mime_type == "application/pdf":  # Each page is billed as one image
+        return max(1, len(re.findall(rb"/Type\s*/Page\b", data))) * TOKENS_PER_IMAGE
+    if not mime_type.startswith("image/"):
+        return TOKENS_PER_IMAGE
+    with Image.open(io.BytesIO(data)) as image:  # Reads the header only
+        width, height = image.size
+    if width <= 384 and height <= 384:
+        return TOKENS_PER_IMAGE
+    return -(-width // IMAGE_TILE_SIZE) * -(-height // IMAGE_TILE_SIZE) * TOKENS_PER_IMAGE
+
+
+class LocalFileService:
+    """In-memory stand-in for client.files."""
+
+    def __init__(self):
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def upload(self, file, config=None):
+        from google.genai import types
+
+        config = config or {}
+        data = file.read()
+        digest = hashlib.sha256(data).hexdigest()
+        name = f"files/{digest[:16]}"
+        stored = types.File(
+            name=name,
+            display_name=config.get("display_name"),
+            mime_type=config.get("mime_type"),
+            size_bytes=len(data),
+            uri=f"local://{name}",
+            state="ACTIVE",
+            expiration_time=dt.datetime.now(dt.timezone.utc) + dt.timedelta(seconds=LOCAL_FILE_TTL),
+        )
+        with self._lock:
+            self._files[name] = (stored, data)
+        return stored
+
+    def get(self, name):
+        with self._lock:
+            return self._files[name][0]
+
+    def delete(self, name):
+        with self._lock:
+            self._files.pop(name, None)
+
+    def read(self, uri):
+        """Returns the bytes behind a local:// URI, so an offline model can resolve handles."""
+        with self._lock:
+            return self._files[uri[len("local://"):]][1]
+
+
+# Function to build a ClientError the way the SDK does: from an HTTP response carrying the service's error body
+def client_error(code, status, message):
+    import requests
+    from google.genai import errors
+
+    response = requests.Response()
+    response.status_code = code
+    response.reason = status
+    response._content = json.dumps({"error": {"code": code, "message": message, "status": status}}).encode()
+    return errors.ClientError(code, response)
+
+
+# Function to build the error the service returns for a missing or expired resource
+def not_found(message):
+    return client_error(404, "NOT_FOUND", message)
+
+
+class LocalCaches:
+    """In-memory stand-in for client.caches (explicit context caching)."""
+
+    def __init__(self, min_tokens=LOCAL_CACHE_MIN_TOKENS, files=None):
+        self.min_tokens = min_tokens
+        self.files = files
+        self._caches = {}
+        self._lock = threading.Lock()
+
+    def create(self, model, config=None):
+        from google.genai import types
+
+        config = types.CreateCachedContentConfig.model_validate(config or {})
+        tokens = (estimate_tokens(list(config.contents or []), self.files)
+                  + estimate_tokens(str(config.system_instruction or "")))
+        if tokens < self.min_tokens:
+            raise client_error(400, "INVALID_ARGUMENT", f"Cached content is too small: {tokens} < {self.min_tokens} tokens")
+        now = dt.datetime.now(dt.timezone.utc)
+        cached = types.CachedContent(
+            name=f"cachedContents/{os.urandom(8).hex()}",
+            display_name=config.display_name,
+            model=model,
+            create_time=now,
+            update_time=now,
+            expire_time=now + dt.timedelta(seconds=int(str(config.ttl or "3600s").rstrip("s"))),
+            usage_metadata=types.CachedContentUsageMetadata(total_token_count=tokens),
+        )
+        with self._lock:
+            self._caches[cached.name] = cached
+        return cached
+
+    def get(self, name, config=None):
+        with self._lock:
+            cached = self._caches.get(name)
+            if cached is None or cached.expire_time <= dt.datetime.now(dt.timezone.utc):
+                self._caches.pop(name, None)
+                raise not_found(f"CachedContent not found (or expired): {name}")
+            return cached
+
+    def update(self, name, config=None):
+        from google.genai import types
+
+        config = types.UpdateCachedContentConfig.model_validate(config or {})
+        cached = self.get(name)
+        now = dt.datetime.now(dt.timezone.utc)
+        updated = cached.model_copy(update={
+            "update_time": now,
+            "expire_time": now + dt.timedelta(seconds=int(str(config.ttl or "3600s").rstrip("s"))),
+        })
+        with self._lock:
+            self._caches[name] = updated
+        return updated
+
+    def delete(self, name, config=None):
+        with self._lock:
+            self._caches.pop(name, None)
+
+
+class LocalModels:
+    """Replays recorded responses with simulated latency; mirrors client.models."""
+
+    def __init__(self, responses, latency=0.5, latency_jitter=0.3, malformed_rate=0.0, seed=None, stream_chunks=8,
+                 caches=None, files=None):
+        self.responses = responses
+        self.caches = caches
+        self.files = files
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.malformed_rate = malformed_rate
+        self.stream_chunks = stream_chunks
+        self.calls = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _next(self, contents, config=None):
+        """Picks the response text, the simulated latency and the token counts for one call."""
+        contents = contents if isinstance(contents, list) else [contents]
+        cached_tokens = 0
+        sources = None
+        searched = any(getattr(tool, "google_search", None) is not None for tool in getattr(config, "tools", None) or [])
+        cached_content = getattr(config, "cached_content", None) if config is not None else None
+        if cached_content:
+            # Follow-ups against a cached case context: the context is billed as cached tokens
+            cached_tokens = self.caches.get(cached_content).usage_metadata.total_token_count
+        with self._lock:
+            self.calls += 1
+            if cached_content or any(getattr(item, "role", None) == "model" for item in contents):
+                text = FOLLOW_UP_RESPONSE
+            elif searched and isinstance(contents[0], str) and contents[0].startswith("Search for reference articles"):
+                answer = reference_answer(contents)
+                text = json.dumps(answer)
+                sources = [url for urls in answer.values() for url in urls]
+            else:
+                text = self.responses[(self.calls - 1) % len(self.responses)]
+                if self._rng.random() < self.malformed_rate:
+                    text = malform(text, self._rng)
+            # Log-normal latency: most calls near the median, with a long tail like the real service
+            latency = self.latency * self._rng.lognormvariate(0, self.latency_jitter) if self.latency else 0.0
+        return text, latency, (estimate_tokens(contents, self.files) + cached_tokens, cached_tokens, sources)
+
+    def _response(self, text, tokens):
+        from google.genai import types
+
+        prompt_tokens, cached_tokens, sources = tokens
+        grounding = None
+        if sources:
+            grounding = types.GroundingMetadata(grounding_chunks=[
+                types.GroundingChunk(web=types.GroundingChunkWeb(uri=url, title=urllib.parse.urlparse(url).netloc))
+                for url in sources
+            ])
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(text=text)]),
+                                        grounding_metadata=grounding)],
+            usage_metadata=types.GenerateContentResponseUsageMetadata(
+                prompt_token_count=prompt_tokens,
+                cached_content_token_count=cached_tokens or None,
+                candidates_token_count=len(text) // CHARS_PER_TOKEN + 1,
+                total_token_count=prompt_tokens + len(text) // CHARS_PER_TOKEN + 1,
+            ),
+        )
+
+    def generate_content(self, model, contents, config=None):
+        text, latency, tokens = self._next(contents, config)
+        time.sleep(latency)
+        return self._response(text, tokens)
+
+    def generate_content_stream(self, model, contents, config=None):
+        text, latency, tokens = self._next(contents, config)
+        size = max(1, len(text) // self.stream_chunks + 1)
+        for start in range(0, len(text), size):
+            time.sleep(latency / self.stream_chunks)
+            yield self._response(text[start:start + size], tokens)
+
+
+class LocalAsyncModels:
+    """Async view of LocalModels; mirrors client.aio.models."""
+
+    def __init__(self, models):
+        self._models = models
+
+    async def generate_content(self, model, contents, config=None):
+        text, latency, tokens = self._models._next(contents, config)
+        await asyncio.sleep(latency)
+        return self._models._response(text, tokens)
+
+    async def generate_content_stream(self, model, contents, config=None):
+        text, latency, tokens = self._models._next(contents, config)
+        chunks = self._models.stream_chunks
+        size = max(1, len(text) // chunks + 1)
+
+        async def stream():
+            for start in range(0, len(text), size):
+                await asyncio.sleep(latency / chunks)
+                yield self._models._response(text[start:start + size], tokens)
+
+        return stream()
+
+
+class _AsyncNamespace:
+    def __init__(self, models):
+        self.models = LocalAsyncModels(models)
+
+
+class LocalGeminiClient:
+    """Drop-in for genai.Client when running offline."""
+
+    def __init__(self, responses=None, latency=0.5, latency_jitter=0.3, malformed_rate=0.0, seed=None):
+        responses = responses or [json.dumps(SAMPLE_RESPONSE, indent=2)]
+        self.files = LocalFileService()
+        self.caches = LocalCaches(files=self.files)
+        self.models = LocalModels(responses, latency, latency_jitter, malformed_rate, seed, caches=self.caches,
+                                  files=self.files)
+        self.aio = _AsyncNamespace(self.models)
+
+    @classmethod
+    def from_env(cls):
+        """Builds a client from DIAG_LOCAL_RESPONSES (a JSONL file of {"text": ...} lines),
+        DIAG_LOCAL_LATENCY, DIAG_LOCAL_LATENCY_JITTER and DIAG_LOCAL_MALFORMED_RATE."""
+        path = os.environ.get("DIAG_LOCAL_RESPONSES")
+        return cls(
+            responses=load_recorded_responses(path) if path else None,
+            latency=float(os.environ.get("DIAG_LOCAL_LATENCY", "0.5")),
+            latency_jitter=float(os.environ.get("DIAG_LOCAL_LATENCY_JITTER", "0.3")),
+            malformed_rate=float(os.environ.get("DIAG_LOCAL_MALFORMED_RATE", "0")),
+        )
+
+
+# Function to load recorded responses: a JSONL file with one {"text": "..."} object per line
+def load_recorded_responses(path):
+    responses = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                responses.append(json.loads(line)["text"])
+    return responses
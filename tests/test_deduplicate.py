@@ -0,0 +1,39 @@
+from PIL import Image, ImageDraw
+
+import Diag_Assist
+
+
+def page(lines):
+    image = Image.new("RGB", (1275, 1650), "white")
+    draw = ImageDraw.Draw(image)
+    for row, line in enumerate(lines):
+        draw.text((100, 100 + row * 30), line, fill="black")
+    return image
+
+
+def entry(image):
+    return (image, Diag_Assist.image_to_part(image), "pdf page", Diag_Assist.make_thumbnail(image))
+
+
+def test_only_blank_and_identical_pages_are_removed():
+    panel = ["Na 140 mmol/L", "Cl 101 mmol/L", "CO2 24 mmol/L", "Glucose 98 mg/dL"]
+    first, changed = page(["K 4.1 mmol/L"] + panel), page(["K 4.7 mmol/L"] + panel)
+    images = [entry(first), entry(changed), entry(page(["Result: REACTIVE"])),
+              entry(Image.new("RGB", (1275, 1650), "white")), entry(first.copy())]
+
+    kept, removed, similar = Diag_Assist.deduplicate_images(images)
+
+    assert kept == images[:3]
+    assert removed == ["Image 4: blank page", "Image 5: identical to image 1"]
+    assert [(number, original) for number, original, _ in similar] == [(2, 1)]
+
+
+def test_near_duplicate_is_removed_only_when_left_out():
+    panel = ["Na 140 mmol/L", "Cl 101 mmol/L", "CO2 24 mmol/L", "Glucose 98 mg/dL"]
+    images = [entry(page(["K 4.1 mmol/L"] + panel)), entry(page(["K 4.7 mmol/L"] + panel))]
+    _, _, similar = Diag_Assist.deduplicate_images(images)
+
+    kept, removed, _ = Diag_Assist.deduplicate_images(images, {similar[0][2]})
+
+    assert len(kept) == 1
+    assert removed == ["Image 2: left out as a duplicate of image 1"]
@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+import Diag_Assist
+
+RESPONSE = '```json\n' + json.dumps({
+    "patient_information": {"age": 54, "symptoms": "cough, \"fever\"", "relevant_details": "smoker\nsince 1990"},
+    "differential_diagnosis": [
+        {"diagnosis": "Pneumonia {lobar}", "probability": 65, "reasoning": "consolidation [right]"},
+        {"diagnosis": "Bronchitis", "probability": 20, "reasoning": "cough"},
+    ],
+    "follow_up_recommendations": ["CBC", "Sputum culture"],
+    "articles": [],
+    "confidence_level": 75,
+}, indent=2) + '\n```'
+
+
+def parse(chunks):
+    parser = Diag_Assist.IncrementalJSONParser()
+    events = []
+    for chunk in chunks:
+        events.extend(parser.feed(chunk))
+    return events, parser.done
+
+
+def test_sections_and_items_are_reported_as_they_close():
+    events, done = parse([RESPONSE])
+
+    sections = {event[1]: event[2] for event in events if event[0] == "section"}
+    assert sections == json.loads(Diag_Assist.extract_json_body(RESPONSE))
+    items = [(event[1], event[2]) for event in events if event[0] == "item"]
+    assert items == [("differential_diagnosis", 0), ("differential_diagnosis", 1),
+                     ("follow_up_recommendations", 0), ("follow_up_recommendations", 1)]
+    assert done
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 16])
+def test_chunk_boundaries_do_not_change_the_events(size):
+    # Small chunks split keys, strings, escapes and numbers in the middle
+    whole, _ = parse([RESPONSE])
+    split, done = parse([RESPONSE[i:i + size] for i in range(0, len(RESPONSE), size)])
+
+    assert split == whole
+    assert done
+
+
+def test_a_number_split_across_chunks_is_reported_whole():
+    events, _ = parse(['{"confidence_level": 7', '5}'])
+
+    assert events == [("section", "confidence_level", 75)]
+
+
+def test_truncated_stream_reports_only_closed_sections():
+    cut = RESPONSE.index('"follow_up_recommendations"') + 40
+    events, done = parse([RESPONSE[:cut]])
+
+    assert [event[1] for event in events if event[0] == "section"] == ["patient_information", "differential_diagnosis"]
+    assert not done
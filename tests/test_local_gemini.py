@@ -0,0 +1,36 @@
+import io
+
+import pytest
+from google.genai import errors, types
+from PIL import Image
+
+import local_gemini
+
+
+def test_not_found_is_a_client_error():
+    error = local_gemini.not_found("CachedContent not found (or expired): cachedContents/x")
+
+    assert isinstance(error, errors.ClientError)
+    assert error.code == 404
+    assert error.status == "NOT_FOUND"
+    assert "cachedContents/x" in error.message
+
+
+def test_cache_create_counts_uploaded_files():
+    client = local_gemini.LocalGeminiClient(latency=0)
+    buffer = io.BytesIO()
+    Image.new("RGB", (2048, 2048), "gray").save(buffer, "PNG")
+    stored = client.files.upload(file=io.BytesIO(buffer.getvalue()), config={"mime_type": "image/png"})
+    part = types.Part.from_uri(file_uri=stored.uri, mime_type="image/png")
+
+    cached = client.caches.create(model="test-model", config={"contents": [types.Content(role="user", parts=[part] * 2)]})
+
+    assert cached.usage_metadata.total_token_count >= 2 * 9 * local_gemini.TOKENS_PER_IMAGE  # 3x3 tiles each
+
+
+def test_cache_create_rejects_small_contexts():
+    client = local_gemini.LocalGeminiClient(latency=0)
+
+    with pytest.raises(errors.ClientError) as raised:
+        client.caches.create(model="test-model", config={"contents": ["short"]})
+    assert raised.value.code == 400
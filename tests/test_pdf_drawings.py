@@ -0,0 +1,40 @@
+import math
+
+from PIL import Image, ImageDraw
+
+import Diag_Assist
+
+
+def report_page(table=False):
+    """A lab report at 1 px per point; returns the page and the boxes of its words."""
+    image = Image.new("L", (595, 842), 255)
+    draw = ImageDraw.Draw(image)
+    boxes = []
+    for row in range(40):
+        y = 60 + row * 14
+        for column, word in enumerate(["Haemoglobin", "13.2", "g/dL", "12.0-16.0"]):
+            boxes.append(draw.textbbox((50 + column * 120, y), word))
+            draw.text((50 + column * 120, y), word, fill=0)
+        if table:
+            draw.line((45, y - 2, 550, y - 2), fill=0)
+    if table:
+        for x in (45, 165, 285, 405, 550):
+            draw.line((x, 58, x, 618), fill=0)
+    return image, draw, boxes
+
+
+def test_text_and_table_rules_are_not_drawings():
+    for table in (False, True):
+        image, _, boxes = report_page(table)
+        assert Diag_Assist.drawn_fraction(image, boxes) <= Diag_Assist.PDF_MAX_DRAWN_FRACTION
+
+
+def test_tracings_and_charts_are_drawings():
+    image, draw, boxes = report_page()
+    draw.line([(50 + t, 720 + 25 * math.sin(t / 6)) for t in range(480)], fill=0)
+    assert Diag_Assist.drawn_fraction(image, boxes) > Diag_Assist.PDF_MAX_DRAWN_FRACTION
+
+    image, draw, boxes = report_page(table=True)
+    for bar in range(8):
+        draw.rectangle((60 + bar * 30, 780 - bar * 8, 80 + bar * 30, 800), fill=40)
+    assert Diag_Assist.drawn_fraction(image, boxes) > Diag_Assist.PDF_MAX_DRAWN_FRACTION
@@ -0,0 +1,35 @@
+from PIL import Image, ImageDraw
+
+import Diag_Assist
+
+
+def pdf_page(lines):
+    image = Image.new("RGB", (1275, 1650), "white")
+    draw = ImageDraw.Draw(image)
+    for row in range(lines):
+        draw.text((100, 100 + row * 30), "Sodium 140 mmol/L   Potassium 4.1 mmol/L   Chloride 101 mmol/L", fill="black")
+    return (image, Diag_Assist.image_to_part(image), "pdf page", Diag_Assist.make_thumbnail(image))
+
+
+def smallest_request_tokens(page_count):
+    """Prompt tokens of `page_count` pages at the planner's lowest resolution."""
+    calibration = Diag_Assist.get_token_calibration()
+    text = Diag_Assist.estimate_text_tokens(Diag_Assist.sys_ins) + Diag_Assist.estimate_text_tokens("case")
+    page = Diag_Assist.estimate_image_tokens(1275, 1650, Diag_Assist.PLANNER_IMAGE_DIMS[-1])
+    return calibration.apply(text) + page_count * calibration.apply(page)
+
+
+def test_nearly_empty_pages_are_dropped_only_to_fit_the_budget():
+    pages = [pdf_page(40), pdf_page(1), pdf_page(40), pdf_page(40)]
+
+    plan = Diag_Assist.plan_request("case", pages, budget=smallest_request_tokens(4))
+    assert plan.dropped == []
+
+    plan = Diag_Assist.plan_request("case", pages, budget=smallest_request_tokens(3), numbers=[1, 3, 4, 5])
+    assert plan.dropped == [1]
+    assert plan.dropped_pages() == "image 3"
+    assert len(plan.groups) == 1
+
+    plan = Diag_Assist.plan_request("case", pages, budget=smallest_request_tokens(2))
+    assert plan.dropped == [1]  # Pages with content are split over calls, never dropped
+    assert len(plan.groups) == 2
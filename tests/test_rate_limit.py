@@ -0,0 +1,16 @@
+import asyncio
+import time
+
+import Diag_Assist
+import local_gemini
+
+
+def test_every_request_waits_for_its_slot():
+    client = Diag_Assist.AsyncGeminiClient(local_gemini.LocalGeminiClient(latency=0), requests_per_minute=600)
+
+    async def calls():
+        await asyncio.gather(*(client.generate_content("test-model", ["case"], None) for _ in range(4)))
+
+    started = time.perf_counter()
+    asyncio.run(calls())
+    assert time.perf_counter() - started >= 0.3  # Starts 0.1 s apart; the first goes at once
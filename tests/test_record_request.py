@@ -0,0 +1,20 @@
+from google.genai import types
+
+import Diag_Assist
+
+
+def test_record_request_accepts_sdk_usage_metadata():
+    metrics = Diag_Assist.get_metrics()
+    usage = types.GenerateContentResponseUsageMetadata(
+        prompt_token_count=1200, candidates_token_count=300, cached_content_token_count=800, total_token_count=1500)
+
+    Diag_Assist.record_request("test-model", "ok", usage)
+
+    counters = metrics._counters
+    assert counters[("diag_requests_total", (("model", "test-model"), ("outcome", "ok")))] >= 1
+    for kind, count in (("prompt", 1200), ("output", 300), ("cached", 800)):
+        assert counters[("diag_tokens_total", (("kind", kind), ("model", "test-model")))] >= count
+
+
+def test_record_request_without_usage():
+    Diag_Assist.record_request("test-model", "error")
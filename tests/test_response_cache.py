@@ -0,0 +1,27 @@
+import Diag_Assist
+import local_gemini
+
+
+def offline(monkeypatch, tmp_path, responses=None):
+    client = local_gemini.LocalGeminiClient(responses, latency=0)
+    cache = Diag_Assist.ResponseCache(directory=str(tmp_path))
+    monkeypatch.setattr(Diag_Assist, "get_async_gemini_client", lambda: Diag_Assist.AsyncGeminiClient(client))
+    monkeypatch.setattr(Diag_Assist, "get_response_cache", lambda: cache)
+    return client, cache
+
+
+def test_unparseable_responses_are_not_cached(monkeypatch, tmp_path):
+    client, cache = offline(monkeypatch, tmp_path, ["I can't read this image."])
+
+    assert Diag_Assist.call_gemini(["case"], Diag_Assist.sys_ins) == "I can't read this image."
+    Diag_Assist.call_gemini(["case"], Diag_Assist.sys_ins)
+    assert client.models.calls == 2
+    assert cache.hits == 0
+
+
+def test_parseable_responses_are_cached(monkeypatch, tmp_path):
+    client, cache = offline(monkeypatch, tmp_path)
+
+    first = Diag_Assist.call_gemini(["case"], Diag_Assist.sys_ins)
+    assert Diag_Assist.call_gemini(["case"], Diag_Assist.sys_ins) == first
+    assert client.models.calls == 1
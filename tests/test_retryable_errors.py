@@ -0,0 +1,18 @@
+import asyncio
+
+import requests
+
+import Diag_Assist
+import local_gemini
+
+
+def test_network_failures_are_retryable():
+    for error in (requests.exceptions.ConnectionError("reset"), requests.exceptions.ReadTimeout("slow"),
+                  requests.exceptions.ChunkedEncodingError("cut"), asyncio.TimeoutError()):
+        assert Diag_Assist.is_retryable_error(error)
+
+
+def test_status_codes_decide_api_errors():
+    assert Diag_Assist.is_retryable_error(local_gemini.client_error(429, "RESOURCE_EXHAUSTED", "quota"))
+    assert not Diag_Assist.is_retryable_error(local_gemini.client_error(400, "INVALID_ARGUMENT", "bad request"))
+    assert not Diag_Assist.is_retryable_error(ValueError("not a network error"))
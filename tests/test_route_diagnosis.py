@@ -0,0 +1,37 @@
+import json
+
+import Diag_Assist
+import local_gemini
+
+
+def diagnose(monkeypatch, tmp_path, responses):
+    client = local_gemini.LocalGeminiClient(responses, latency=0)
+    cache = Diag_Assist.ResponseCache(directory=str(tmp_path))
+    monkeypatch.setattr(Diag_Assist, "get_async_gemini_client", lambda: Diag_Assist.AsyncGeminiClient(client))
+    monkeypatch.setattr(Diag_Assist, "get_response_cache", lambda: cache)
+    monkeypatch.setattr(Diag_Assist, "ROUTING_ENABLED", True)
+    monkeypatch.setattr(Diag_Assist, "ROUTING_SPECULATIVE", False)
+    job = Diag_Assist.Job(("session", "diagnosis"))
+    token = Diag_Assist.current_job.set(job)
+    try:
+        _, result, taken = Diag_Assist.route_diagnosis(["case"], use_cache=False)
+    finally:
+        Diag_Assist.current_job.reset(token)
+    return result, taken, job.messages
+
+
+def test_unparseable_triage_is_not_reported_when_escalation_succeeds(monkeypatch, tmp_path):
+    result, route, messages = diagnose(monkeypatch, tmp_path, ["I can't read this image.",
+                                                            json.dumps(local_gemini.SAMPLE_RESPONSE)])
+
+    assert result is not None
+    assert route["route"] == "escalated"
+    assert messages == []
+
+
+def test_triage_errors_are_reported_when_escalation_fails_too(monkeypatch, tmp_path):
+    result, route, messages = diagnose(monkeypatch, tmp_path, ["I can't read this image."])
+
+    assert result is None
+    assert len(messages) == 2  # One decode error from each model
+    assert all(level == "error" for level, _ in messages)
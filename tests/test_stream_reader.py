@@ -0,0 +1,50 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import Diag_Assist
+
+
+class BlockingStream:
+    """Reads its chunks like google-genai does: a blocking read inside __anext__."""
+
+    def __init__(self, chunks, delay):
+        self._chunks = iter(chunks)
+        self._delay = delay
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        time.sleep(self._delay)
+        try:
+            return next(self._chunks)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class BlockingStreamModels:
+    async def generate_content(self, model, contents, config):
+        return "instant"
+
+    async def generate_content_stream(self, model, contents, config):
+        return BlockingStream(["a", "b", "c"], delay=0.5)
+
+
+def test_blocking_stream_does_not_stall_other_calls():
+    client = Diag_Assist.AsyncGeminiClient(SimpleNamespace(aio=SimpleNamespace(models=BlockingStreamModels())))
+    chunks = []
+
+    async def instant_call():
+        await asyncio.sleep(0.1)  # Let the stream start reading first
+        await client.generate_content("test-model", ["case"], None)
+        return time.perf_counter()
+
+    async def calls():
+        return await asyncio.gather(client.generate_content_stream("test-model", ["case"], None, chunks.append),
+                                    instant_call())
+
+    started = time.perf_counter()
+    _, instant_done = asyncio.run(calls())
+    assert chunks == ["a", "b", "c"]
+    assert instant_done - started < 0.4  # A stream read on the loop would hold it for 0.5 s per chunk
@@ -0,0 +1,30 @@
+import io
+
+import Diag_Assist
+
+
+class CountingUpload(io.BytesIO):
+    """A Streamlit UploadedFile stand-in that counts how often its bytes are read."""
+
+    def __init__(self, data, file_id):
+        super().__init__(data)
+        self.file_id = file_id
+        self.size = len(data)
+        self.reads = 0
+
+    def getbuffer(self):
+        self.reads += 1
+        return super().getbuffer()
+
+
+def test_uploads_are_hashed_once_per_session(monkeypatch):
+    monkeypatch.setattr(Diag_Assist.runtime, "exists", lambda: True)
+    monkeypatch.setattr(Diag_Assist.st, "session_state", {})
+    upload = CountingUpload(b"scan" * 1000, "file-1")
+
+    keys = {Diag_Assist.upload_cache_key(upload, "image/png") for _ in range(5)}
+    assert len(keys) == 1
+    assert upload.reads == 1
+
+    replaced = CountingUpload(b"other scan", "file-2")
+    assert Diag_Assist.upload_cache_key(replaced, "image/png") not in keys
@@ -0,0 +1,17 @@
+import pytest
+
+import Diag_Assist
+
+
+@pytest.mark.parametrize("text_layer", [True, False])
+def test_pdf_conversion_errors_reach_the_caller(tmp_path, text_layer):
+    # Not a PDF, so poppler fails (or is missing) either way
+    pdf_path = tmp_path / "broken.pdf"
+    pdf_path.write_bytes(b"not a pdf")
+    queue = Diag_Assist.JobQueue(processes=1)
+    try:
+        future = queue.run_cpu("encode_pdf_pages", str(pdf_path), {"text_layer": text_layer}, 1, 1)
+        with pytest.raises(RuntimeError, match="Error converting PDF to images"):
+            future.result()
+    finally:
+        queue._processes.shutdown()
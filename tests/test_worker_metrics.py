@@ -0,0 +1,30 @@
+import io
+import socket
+
+from PIL import Image
+
+import Diag_Assist
+
+
+def test_worker_stages_are_recorded_by_the_parent(monkeypatch):
+    # Workers import the module afresh; a port already in use must not break them
+    taken = socket.socket()
+    taken.bind(("127.0.0.1", 0))
+    taken.listen()
+    monkeypatch.setenv("DIAG_METRICS_PORT", str(taken.getsockname()[1]))
+    metrics = Diag_Assist.Metrics()
+    monkeypatch.setattr(Diag_Assist, "get_metrics", lambda: metrics)
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), "gray").save(buffer, "PNG")
+
+    queue = Diag_Assist.JobQueue(processes=2)
+    try:
+        futures = [queue.run_cpu("encode_image_bytes", buffer.getvalue(), "image/png") for _ in range(4)]
+        assert all(len(future.result()) == 1 for future in futures)
+    finally:
+        queue._processes.shutdown()
+        taken.close()
+
+    exported = metrics.render_prometheus()
+    assert 'diag_stage_duration_seconds_count{stage="encode"} 4' in exported
+    assert 'diag_stage_duration_seconds_count{stage="decode"} 4' in exported